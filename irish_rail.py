@@ -17,237 +17,3240 @@
 #
 """Irish Rail data converter."""
 
-import csv
+import array
+import bisect
+import collections
+import contextlib
 import datetime
 import functools
+import heapq
+import http
+import importlib
+import importlib.util
+import io
 import logging
+import operator
+import os
+import os.path
+import pickle
+import sys
+import threading
+import time
+import unicodedata
+import urllib
 # import pdb
 
 import click
 # TODO: http://click.pocoo.org/5/setuptools/#setuptools-integration
-import prettytable
+try:
+  import resource  # Unix only, just for the peak RSS in --profile reports
+except ImportError:
+  resource = None
+
+
+def _LazyImport(module_name):
+  # like `import module_name`, but the module only really loads when one of its attributes is
+  # first used: most runs need none of these, and "list" and shell completion must start fast
+  module = sys.modules.get(module_name)
+  if module is not None:
+    return module
+  spec = importlib.util.find_spec(module_name)
+  spec.loader = importlib.util.LazyLoader(spec.loader)
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[module_name] = module
+  spec.loader.exec_module(module)
+  parent_name, _, child_name = module_name.rpartition('.')
+  if parent_name:
+    setattr(sys.modules[parent_name], child_name, module)  # so `parent.child.x` works
+  return module
+
+
+def _OptionalImport(module_name):
+  # like `import module_name`, or None if it is not installed; only called when really needed,
+  # as these are big (pyarrow, protobuf) or not in every Python (tomllib)
+  try:
+    return importlib.import_module(module_name)
+  except ImportError:
+    return None
+
+
+# rarely needed (or big) modules, only loaded on first use; see _LazyImport()
+cProfile = _LazyImport('cProfile')
+csv = _LazyImport('csv')
+gzip = _LazyImport('gzip')
+hashlib = _LazyImport('hashlib')
+html = _LazyImport('html')
+_LazyImport('http.server')
+json = _LazyImport('json')
+multiprocessing = _LazyImport('multiprocessing')
+prettytable = _LazyImport('prettytable')
+pstats = _LazyImport('pstats')
+shutil = _LazyImport('shutil')
+sqlite3 = _LazyImport('sqlite3')
+tracemalloc = _LazyImport('tracemalloc')
+_LazyImport('urllib.parse')
+_LazyImport('urllib.request')
+zipfile = _LazyImport('zipfile')
 
 __author__ = 'balparda@gmail.com (Daniel Balparda)'
 __version__ = (1, 0)
 
 
-# log format string
-_LOG_FORMAT = '%(asctime)-15s: %(module)s/%(funcName)s/%(lineno)d: %(message)s'
-_VERBOSITY_LEVELS = {
-    0: logging.ERROR,
-    1: logging.INFO,
-    2: logging.DEBUG,
-}
+# log format string
+_LOG_FORMAT = '%(asctime)-15s: %(module)s/%(funcName)s/%(lineno)d: %(message)s'
+_VERBOSITY_LEVELS = {
+    0: logging.ERROR,
+    1: logging.INFO,
+    2: logging.DEBUG,
+}
+
+# rail data dir
+_DATA_DIR = 'data/irish_rail/'
+_FEED_PATH = _DATA_DIR  # the feed in use, a directory (ending in os.sep) or a GTFS .zip; see --feed
+
+# some util consts and lambdas
+_DIRECTION = lambda bool_direction_id: 'SOUTH' if bool_direction_id else 'NORTH'
+_WEEK_TYPE = {
+    0: 'Mon-Fri',
+    1: 'Saturday',
+    2: 'Sunday',
+}
+_DATE_REPR = '%Y%m%d'
+_LOOK_AHEAD_IN_DAYS = 14
+_MAX_SEARCH_RESULTS = 10
+_ONE_DAY = datetime.timedelta(days=1)
+_DAY_SECONDS = 24 * 60 * 60
+_NEVER = 2 ** 31 - 1  # a time, in seconds, that is later than any other
+
+# compiled feed snapshot (see "compile" operation); bump the version on any payload change
+_SNAPSHOT_PATH = _DATA_DIR + 'feed.snapshot'
+_SNAPSHOT_VERSION = 8
+_FEED_FILES = (
+    'routes.txt', 'stops.txt', 'trips.txt', 'stop_times.txt', 'calendar.txt',
+    'calendar_dates.txt', 'transfers.txt')
+_OPTIONAL_FEED_FILES = {'transfers.txt'}
+_HASH_BLOCK_SIZE = 1 << 20
+
+# tiny index of the route and stop names (see _LoadNames()), so "list" and shell completion need
+# neither CSV parsing nor the whole snapshot; bump the version on any change
+_NAMES_PATH = _DATA_DIR + 'feed.names'
+_NAMES_VERSION = 1
+_NAMES_FILES = ('routes.txt', 'stops.txt')
+
+# SQLite feed store (see "import" operation and --db); every table is keyed by the feed version
+_DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS feeds (
+    version TEXT PRIMARY KEY, feed_path TEXT NOT NULL, imported_at TEXT NOT NULL,
+    sources TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS routes (
+    version TEXT NOT NULL, route_id TEXT NOT NULL, route_long_name TEXT NOT NULL,
+    PRIMARY KEY (version, route_id));
+CREATE TABLE IF NOT EXISTS stops (
+    version TEXT NOT NULL, stop_id TEXT NOT NULL, stop_name TEXT NOT NULL,
+    PRIMARY KEY (version, stop_id));
+CREATE TABLE IF NOT EXISTS trips (
+    version TEXT NOT NULL, trip_id TEXT NOT NULL, route_id TEXT NOT NULL,
+    service_id TEXT NOT NULL, direction_id INTEGER NOT NULL, PRIMARY KEY (version, trip_id));
+CREATE INDEX IF NOT EXISTS trips_route ON trips (version, route_id);
+CREATE INDEX IF NOT EXISTS trips_service ON trips (version, service_id);
+CREATE TABLE IF NOT EXISTS stop_times (
+    version TEXT NOT NULL, trip_id TEXT NOT NULL, arrival INTEGER NOT NULL,
+    departure INTEGER NOT NULL, stop_id TEXT NOT NULL, stop_sequence INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS stop_times_trip ON stop_times (version, trip_id);
+CREATE INDEX IF NOT EXISTS stop_times_stop ON stop_times (version, stop_id);
+CREATE TABLE IF NOT EXISTS calendar (
+    version TEXT NOT NULL, service_id TEXT NOT NULL, monday TEXT NOT NULL,
+    tuesday TEXT NOT NULL, wednesday TEXT NOT NULL, thursday TEXT NOT NULL, friday TEXT NOT NULL,
+    saturday TEXT NOT NULL, sunday TEXT NOT NULL, start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL, PRIMARY KEY (version, service_id));
+CREATE TABLE IF NOT EXISTS calendar_dates (
+    version TEXT NOT NULL, service_id TEXT NOT NULL, date TEXT NOT NULL,
+    exception_type INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS calendar_dates_service ON calendar_dates (version, service_id);
+CREATE TABLE IF NOT EXISTS transfers (
+    version TEXT NOT NULL, from_stop_id TEXT NOT NULL, to_stop_id TEXT NOT NULL,
+    min_transfer_time INTEGER NOT NULL);
+'''
+_DB_TABLES = (
+    'routes', 'stops', 'trips', 'stop_times', 'calendar', 'calendar_dates', 'transfers', 'feeds')
+_DB_BATCH_SIZE = 10000
+_FEED_DB = None  # like (sqlite3.Connection, feed_version) while --db is in use, see _SetFeedDB()
+_FEED_OPERATIONS = ('compile', 'import', 'refresh')  # the ones that read --feed even with --db
+
+# parallel parsing of big feed files (see _ParseTable())
+_PARSE_JOBS = 1
+_PARSE_KEYS = None  # the keys being parsed, for the forked workers
+_PARALLEL_PARSE_MIN_BYTES = 32 << 20
+_PARALLEL_PARSE_CHUNK_BYTES = 16 << 20
+
+# pipeline instrumentation (see --profile); while it is None every _Stage() is a shared no-op
+_PROFILER = None
+_NO_STAGE = contextlib.nullcontext({})  # the dict is a scratch stage record, thrown away
+_COLLAPSED_MAX_DEPTH = 64
+
+# departure boards
+_BOARD_DAYS_CACHED = 4  # service days kept indexed: today, the day before (after midnight), ...
+_MAX_DEPARTURES = 1000
+
+# realtime (GTFS-Realtime TripUpdates)
+_REALTIME_SOURCE = None  # a file or http(s) URL, see --realtime
+_REALTIME_TIMEOUT = 10  # seconds
+_CANCELLED = 'CANCELED'  # a cancelled trip, in _Delays.Update()
+
+# output
+_PARQUET_BATCH_ROWS = 1 << 16  # cells per row group
+
+
+class Error(Exception):
+  """Irish Rail base exception."""
+
+
+class _Profiler:
+  """Wall time, CPU time, rows and peak memory of every pipeline stage of one run (--profile).
+
+  Stages are named blocks of code, like `with _Stage('sort') as stage: ...`, that can be entered
+  many times (once per date, for example) and are added up; a stage sets `stage['rows']` to the
+  number of rows it produced. Optionally also runs cProfile over the whole run.
+  """
+
+  def __init__(self, trace_memory, with_cprofile):
+    self.stages = {}  # like {stage_name: {'calls': int, 'wall_seconds': float, ...}}, in order
+    self.trace_memory = trace_memory
+    self.cprofile = cProfile.Profile() if with_cprofile else None
+    if trace_memory:
+      tracemalloc.start()
+    self.start_wall, self.start_cpu = time.perf_counter(), time.process_time()
+    if self.cprofile is not None:
+      self.cprofile.enable()
+
+  @contextlib.contextmanager
+  def Stage(self, stage_name):
+    """Times the block of code it wraps as stage_name, adding up with its other runs."""
+    record = {'rows': 0}
+    if self.trace_memory:
+      tracemalloc.reset_peak()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+      yield record
+    finally:
+      stage = self.stages.setdefault(stage_name, {
+          'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0})
+      stage['calls'] += 1
+      stage['wall_seconds'] += time.perf_counter() - start_wall
+      stage['cpu_seconds'] += time.process_time() - start_cpu
+      stage['rows'] += record['rows']
+      if resource is not None:
+        stage['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB, on Linux
+      if self.trace_memory:
+        stage['tracemalloc_peak_bytes'] = max(
+            stage.get('tracemalloc_peak_bytes', 0), tracemalloc.get_traced_memory()[1])
+
+  def Finish(self, operation):  # like {'operation': ..., 'total': {...}, 'stages': self.stages}
+    """Stops profiling; the report of the whole run."""
+    if self.cprofile is not None:
+      self.cprofile.disable()
+    total = {'wall_seconds': time.perf_counter() - self.start_wall,
+             'cpu_seconds': time.process_time() - self.start_cpu}
+    if resource is not None:
+      total['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if self.trace_memory:
+      total['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+    return {'operation': operation, 'total': total, 'stages': self.stages}
+
+
+def _Stage(stage_name):  # like _Profiler.Stage(stage_name), or a no-op if not profiling
+  return _NO_STAGE if _PROFILER is None else _PROFILER.Stage(stage_name)
+
+
+def _CollapsedStacks(stats):
+  # like {'func1;func2;func3': int_self_microseconds}, for flamegraph.pl, from pstats.Stats;
+  # cProfile only knows caller->callee edges, so the time of a function is split among its
+  # callers in proportion to the cumulative time of each call edge
+  callees = {}  # like {caller_func: [callee_func1, ...]}
+  for func, (_, _, _, _, callers) in stats.stats.items():
+    for caller in callers:
+      callees.setdefault(caller, []).append(func)
+  func_repr = lambda func: '%s:%d:%s' % (os.path.basename(func[0]), func[1], func[2])
+  collapsed = {}
+  def _Walk(func, path, fraction):
+    _, _, self_time, _, _ = stats.stats[func]
+    path = path + (func_repr(func),)
+    self_us = int(self_time * fraction * 1000000)
+    if self_us:
+      key = ';'.join(path)
+      collapsed[key] = collapsed.get(key, 0) + self_us
+    if len(path) >= _COLLAPSED_MAX_DEPTH:
+      return
+    for callee in callees.get(func, ()):
+      callee_cumulative = stats.stats[callee][3]
+      edge_cumulative = stats.stats[callee][4][func][3]
+      if func_repr(callee) not in path and callee_cumulative:  # no recursion
+        _Walk(callee, path, fraction * edge_cumulative / callee_cumulative)
+  for func, (_, _, _, _, callers) in stats.stats.items():
+    if not callers:
+      _Walk(func, (), 1.0)
+  return collapsed
+
+
+def _SaveProfile(operation, report_path, stats_path, collapsed_path):
+  global _PROFILER  # pylint: disable=global-statement
+  profiler, _PROFILER = _PROFILER, None
+  report = profiler.Finish(operation)
+  with open(report_path, 'wt') as report_file:
+    json.dump(report, report_file, indent=2)
+    report_file.write('\n')
+  logging.info('Saved profile report %r', report_path)
+  if profiler.cprofile is None:
+    return
+  stats = pstats.Stats(profiler.cprofile)
+  if stats_path:
+    stats.dump_stats(stats_path)
+    logging.info('Saved cProfile stats %r', stats_path)
+  if collapsed_path:
+    with open(collapsed_path, 'wt') as collapsed_file:
+      for stack, microseconds in sorted(_CollapsedStacks(stats).items()):
+        collapsed_file.write('%s %d\n' % (stack, microseconds))
+    logging.info('Saved collapsed stacks %r', collapsed_path)
+
+
+def _TimeToSeconds(time_repr):  # like '25:10:00' -> 90600, as GTFS hours can go past 24
+  hour, minute, second = time_repr.split(':')
+  return int(hour) * 3600 + int(minute) * 60 + int(second)
+
+
+def _SecondsRepr(seconds):  # like 90600 -> '01:10'
+  return '%02d:%02d' % ((seconds // 3600) % 24, (seconds // 60) % 60)
+
+
+class _StopTimes:
+  """Compact, integer-encoded stop_times.txt, with the trips grouped into patterns.
+
+  Trip and stop IDs are dictionary-encoded into ints (`trip_ids` and `stop_ids` decode them) and
+  times are seconds since the start of the service day, so a "24:10:00" arrival stays after a
+  "23:50:00" one. Most trips of a route share their stops and differ only by start time, so the
+  stops of a trip are stored once per "pattern" (a unique sequence of stops) and its times once
+  per "profile" (a unique sequence of arrival and departure offsets from the trip start): a trip
+  is only its pattern code, its profile code and its start. The stops of pattern code `p` are
+  `pattern_offsets[p]:pattern_offsets[p + 1]` in `pattern_stops` and `pattern_sequences`, and the
+  trips following it are `pattern_trips[p]`; profiles are laid out in the same way.
+
+  There is also an inverted index of the patterns by stop: `visit_patterns[s]` and
+  `visit_positions[s]` are the pattern codes and the positions in them of every visit to stop code
+  `s`, so finding the trips that serve some stops only looks at each pattern once (see `Visits()`).
+
+  Realtime predictions, if any, are a sparse _Delays() overlay in `delays`: the times of a service
+  date include them only when asked for that date (see `Arrivals()`).
+  """
+
+  __slots__ = ('trip_ids', 'trip_codes', 'stop_ids', 'stop_codes', 'rows_count', 'trip_patterns',
+               'trip_profiles', 'starts', 'pattern_offsets', 'pattern_stops', 'pattern_sequences',
+               'pattern_trips', 'profile_offsets', 'profile_arrivals', 'profile_departures',
+               'visit_patterns', 'visit_positions', 'delays')
+
+  def __init__(self, rows):
+    # rows like iter((trip_id, int_arrival, int_departure, stop_id, int_stop_sequence), ...)
+    self.trip_ids, self.trip_codes, self.stop_ids, self.stop_codes = [], {}, [], {}
+    trip_rows = []  # like [[(int_stop_sequence, stop_code, int_arrival, int_departure), ...], ...]
+    for trip_id, arrival_time, departure_time, stop_id, stop_sequence in rows:
+      trip_code = self.trip_codes.get(trip_id)
+      if trip_code is None:
+        trip_id = sys.intern(trip_id)
+        trip_code = self.trip_codes[trip_id] = len(self.trip_ids)
+        self.trip_ids.append(trip_id)
+        trip_rows.append([])
+      stop_code = self.stop_codes.get(stop_id)
+      if stop_code is None:
+        stop_code = self.stop_codes[stop_id] = len(self.stop_ids)
+        self.stop_ids.append(stop_id)
+      trip_rows[trip_code].append((stop_sequence, stop_code, arrival_time, departure_time))
+    self.rows_count = sum(len(trip) for trip in trip_rows)
+    self.trip_patterns, self.trip_profiles, self.starts = (
+        array.array('i'), array.array('i'), array.array('i'))
+    self.pattern_offsets, self.profile_offsets = array.array('q', [0]), array.array('q', [0])
+    self.pattern_stops, self.pattern_sequences, self.pattern_trips = (
+        array.array('i'), array.array('i'), [])
+    self.profile_arrivals, self.profile_departures = array.array('i'), array.array('i')
+    self.visit_patterns = [array.array('i') for _ in self.stop_ids]
+    self.visit_positions = [array.array('i') for _ in self.stop_ids]
+    self.delays = None
+    patterns, profiles = {}, {}  # like {(stop_codes, sequences): pattern_code}, same for profiles
+    for trip_code, trip in enumerate(trip_rows):
+      trip.sort()  # making sure stops are sorted
+      sequences, stop_codes, arrivals, departures = zip(*trip)
+      trip_rows[trip_code], start = None, arrivals[0]  # free the rows as we go
+      pattern_code = patterns.setdefault((stop_codes, sequences), len(patterns))
+      if pattern_code == len(self.pattern_trips):  # a new one
+        for position, stop_code in enumerate(stop_codes):
+          self.visit_patterns[stop_code].append(pattern_code)
+          self.visit_positions[stop_code].append(position)
+        self.pattern_stops.extend(stop_codes)
+        self.pattern_sequences.extend(sequences)
+        self.pattern_offsets.append(len(self.pattern_stops))
+        self.pattern_trips.append(array.array('i'))
+      arrivals = tuple(arrival - start for arrival in arrivals)
+      departures = tuple(departure - start for departure in departures)
+      profile_code = profiles.setdefault((arrivals, departures), len(profiles))
+      if profile_code == len(self.profile_offsets) - 1:  # a new one
+        self.profile_arrivals.extend(arrivals)
+        self.profile_departures.extend(departures)
+        self.profile_offsets.append(len(self.profile_arrivals))
+      self.pattern_trips[pattern_code].append(trip_code)
+      self.trip_patterns.append(pattern_code)
+      self.trip_profiles.append(profile_code)
+      self.starts.append(start)
+    logging.debug('%d stop times in %d trips, %d patterns and %d time profiles', self.rows_count,
+                  len(self.trip_ids), len(patterns), len(profiles))
+
+  def __contains__(self, trip_id):
+    return trip_id in self.trip_codes
+
+  def __len__(self):
+    return len(self.trip_ids)
+
+  def Stops(self, trip_code):  # like memoryview(stop_codes), in stop sequence order
+    """The stops of trip_code, from its trip pattern."""
+    pattern_code = self.trip_patterns[trip_code]
+    begin, end = self.pattern_offsets[pattern_code], self.pattern_offsets[pattern_code + 1]
+    return memoryview(self.pattern_stops)[begin:end]
+
+  def Arrivals(self, trip_code, date=None):
+    """The arrival times of trip_code, with the realtime delays of date, if any."""
+    # like [int_arrival, ...], in stop sequence order; predicted if date has realtime delays
+    return self._Times(trip_code, self.profile_arrivals, 0, date)
+
+  def Departures(self, trip_code, date=None):
+    """The departure times of trip_code, with the realtime delays of date, if any."""
+    # like [int_departure, ...], in stop sequence order; predicted if date has realtime delays
+    return self._Times(trip_code, self.profile_departures, 1, date)
+
+  def _Times(self, trip_code, profile_times, delays_n, date):
+    profile_code, start = self.trip_profiles[trip_code], self.starts[trip_code]
+    begin, end = self.profile_offsets[profile_code], self.profile_offsets[profile_code + 1]
+    trip_delays = self.Delays(trip_code, date)
+    if trip_delays is None:
+      return [start + offset for offset in profile_times[begin:end]]
+    return [start + offset + delay
+            for offset, delay in zip(profile_times[begin:end], trip_delays[delays_n])]
+
+  def Delays(self, trip_code, date):
+    """The realtime delays of trip_code on date, if any."""
+    # like ((int_arrival_delay, ...), (int_departure_delay, ...)), or None if not delayed on date
+    if self.delays is None or date is None:
+      return None
+    return self.delays.trips.get((date, trip_code))
+
+  def Cancelled(self, trip_code, date):  # True if realtime says trip_code does not run on date
+    """True if realtime says trip_code does not run on date."""
+    return self.delays is not None and (date, trip_code) in self.delays.cancelled
+
+  def Trip(self, trip_id):  # like (stop_codes, int_stop_sequences, int_arrivals, int_departures)
+    """The scheduled stop times of trip_id."""
+    trip_code = self.trip_codes[trip_id]
+    pattern_code = self.trip_patterns[trip_code]
+    begin, end = self.pattern_offsets[pattern_code], self.pattern_offsets[pattern_code + 1]
+    return (self.Stops(trip_code), memoryview(self.pattern_sequences)[begin:end],
+            self.Arrivals(trip_code), self.Departures(trip_code))
+
+  def Start(self, trip_id):  # int_arrival at the first stop
+    """The scheduled start of trip_id."""
+    return self.starts[self.trip_codes[trip_id]]
+
+  def Visits(self, stop_ids):
+    """Where the trip patterns visit stop_ids."""
+    # like {pattern_code: [position1, position2, ...]}, positions in stop sequence order
+    visits = {}
+    for stop_code in sorted(self.stop_codes[s] for s in stop_ids if s in self.stop_codes):
+      for pattern_code, position in zip(
+          self.visit_patterns[stop_code], self.visit_positions[stop_code]):
+        visits.setdefault(pattern_code, []).append(position)
+    for positions in visits.values():
+      positions.sort()
+    return visits
+
+
+def _SetFeed(feed_path):  # makes feed_path (a directory or a GTFS .zip) the feed in use
+  global _FEED_PATH, _SNAPSHOT_PATH, _NAMES_PATH  # pylint: disable=global-statement
+  if os.path.isdir(feed_path):
+    _FEED_PATH = os.path.join(feed_path, '')
+    _SNAPSHOT_PATH, _NAMES_PATH = _FEED_PATH + 'feed.snapshot', _FEED_PATH + 'feed.names'
+  elif zipfile.is_zipfile(feed_path):
+    # every zip gets its own snapshot, so feed versions can be kept side by side
+    _FEED_PATH = feed_path
+    _SNAPSHOT_PATH = os.path.splitext(feed_path)[0] + '.snapshot'
+    _NAMES_PATH = os.path.splitext(feed_path)[0] + '.names'
+  else:
+    raise Error('Feed %r is not a directory or a GTFS .zip file' % feed_path)
+  _LoadSnapshot.cache_clear()
+  logging.info('Feed: %r', _FEED_PATH)
+
+
+def _FeedIsZip():
+  return not _FEED_PATH.endswith(('/', os.sep))
+
+
+def _ZipMember(zip_file, file_name):  # like zipfile.ZipInfo(), or None if not in the archive
+  try:
+    return zip_file.getinfo(file_name)
+  except KeyError:
+    # some publishers put the files in a folder inside the archive
+    for zip_info in zip_file.infolist():
+      if os.path.basename(zip_info.filename) == file_name:
+        return zip_info
+    return None
+
+
+def _FeedFileExists(file_name):
+  if not _FeedIsZip():
+    return os.path.exists(_FEED_PATH + file_name)
+  with zipfile.ZipFile(_FEED_PATH) as zip_file:
+    return _ZipMember(zip_file, file_name) is not None
+
+
+@contextlib.contextmanager
+def _OpenFeedFile(file_name):
+  # like a text file for file_name in the feed, decoded as it is read (also from the .zip, with
+  # no extraction) and with the BOM (if any) removed; it yields once, as its last statement, so
+  # when a generator that reads from it (like _FeedRows()) is dropped half way, the exit of the
+  # with closes everything (pylint W0135)
+  with contextlib.ExitStack() as stack:
+    if not _FeedIsZip():
+      feed_file = stack.enter_context(
+          open(_FEED_PATH + file_name, 'rt', encoding='utf-8-sig', newline=''))
+    else:
+      zip_file = stack.enter_context(zipfile.ZipFile(_FEED_PATH))
+      zip_info = _ZipMember(zip_file, file_name)
+      if zip_info is None:
+        raise FileNotFoundError('%r not found in %r' % (file_name, _FEED_PATH))
+      feed_file = io.TextIOWrapper(
+          stack.enter_context(zip_file.open(zip_info)), encoding='utf-8-sig', newline='')
+    yield feed_file
+
+
+def _RowValuesGetter(file_name, header_row, columns, optional_columns):
+  # like (int_index_of_columns[0], row_values(csv_row) -> (value1, value2, ...)) for the header
+  header = {column.strip(): i for i, column in enumerate(header_row)}
+  for column in columns:
+    if column not in header and column not in optional_columns:
+      raise Error('Column %r not found in %s' % (column, file_name))
+  if all(column in header for column in columns):
+    row_values = operator.itemgetter(*(header[column] for column in columns))
+    if len(columns) == 1:
+      row_values = lambda row, get=row_values: (get(row),)
+  else:
+    indexes = [header.get(column) for column in columns]
+    row_values = lambda row: tuple('' if i is None else row[i] for i in indexes)
+  return (header.get(columns[0]), row_values)
+
+
+def _FeedRows(file_name, columns, optional_columns=()):
+  # like iter((value1, value2, ...), ...), with the values of columns in every row of file_name;
+  # columns are found by the header, so the publisher can add or move them; missing
+  # optional_columns come as ''
+  with _OpenFeedFile(file_name) as feed_file:
+    feed_reader = csv.reader(feed_file)
+    _, row_values = _RowValuesGetter(file_name, next(feed_reader, []), columns, optional_columns)
+    for row in feed_reader:
+      if row:  # skip empty lines
+        yield row_values(row)
+
+
+def _FileChunks(file_path, chunks_count):
+  # like (header_bytes, [(begin, end), ...]), the byte ranges of the rows after the header, cut
+  # so that every range is made of whole lines; the cuts are at raw newlines, so they are only
+  # between rows if no quoted value has a line break in it (_ParseChunk() detects when one does)
+  with open(file_path, 'rb') as feed_file:
+    header_line = feed_file.readline()
+    begin, size = feed_file.tell(), os.fstat(feed_file.fileno()).st_size
+    bounds = [begin]
+    for chunk_n in range(1, chunks_count):
+      feed_file.seek(max(begin + (size - begin) * chunk_n // chunks_count, bounds[-1]))
+      feed_file.readline()  # move on to the start of the next line
+      if feed_file.tell() >= size:
+        break
+      if feed_file.tell() > bounds[-1]:
+        bounds.append(feed_file.tell())
+    bounds.append(size)
+  return (header_line, list(zip(bounds, bounds[1:])))
+
+
+def _ParseChunk(chunk):
+  # like [convert_row((value1, value2, ...)), ...] for the rows in one _FileChunks() byte range
+  # that have columns[0] in keys (or all rows if keys is None); runs in the _ParseTable() pool;
+  # None if the range has an odd number of quotes: then it ends inside a quoted value (that has a
+  # line break), if the range before it did not, and its rows can't be parsed on their own
+  file_path, header_line, begin, end, columns, optional_columns, convert_row = chunk
+  keys = _PARSE_KEYS
+  key_index, row_values = _RowValuesGetter(
+      os.path.basename(file_path), next(csv.reader([header_line.decode('utf-8-sig')])), columns,
+      optional_columns)
+  with open(file_path, 'rb') as feed_file:
+    feed_file.seek(begin)
+    text = feed_file.read(end - begin).decode('utf-8')
+  if text.count('"') % 2:
+    return None
+  lines = None  # the lines of text (only '\n' ends one), once they are known to be whole rows
+  if keys is not None and key_index == 0:
+    # fast filter on the raw line, for the usual case of the key as the first column: lines that
+    # clearly don't have a desired key are skipped before even being parsed as CSV
+    lines = []
+    for line in text.split('\n'):
+      if line.count('"') % 2:
+        lines = None  # a quoted value with a line break: lines are not rows, parse them all
+        break
+      raw_key = line.partition(',')[0]
+      if raw_key[:1] == '"':
+        if len(raw_key) < 2 or raw_key[-1] != '"':
+          lines.append(line)  # a quoted key with commas in it: let the CSV parser decide
+          continue
+        raw_key = raw_key[1:-1]
+      if raw_key in keys:
+        lines.append(line)
+  rows = []
+  for row in csv.reader(io.StringIO(text, newline='') if lines is None else lines):
+    if row:  # skip empty lines
+      values = row_values(row)
+      if keys is None or values[0] in keys:
+        rows.append(convert_row(values))
+  return rows
+
+
+def _ParseTable(file_name, columns, convert_row, keys=None, optional_columns=()):
+  # like iter(convert_row((value1, value2, ...)), ...), like _FeedRows() but only for rows with
+  # columns[0] in keys (all rows if keys is None); big files in a directory feed are parsed in
+  # parallel, in newline-aligned chunks, by _PARSE_JOBS processes (from a chunk that cuts a quoted
+  # value on, in this one); rows come in file order
+  global _PARSE_KEYS  # pylint: disable=global-statement
+  file_path = _FEED_PATH + file_name
+  if (_PARSE_JOBS <= 1 or _FeedIsZip() or 'fork' not in multiprocessing.get_all_start_methods()
+      or os.path.getsize(file_path) < _PARALLEL_PARSE_MIN_BYTES):
+    # a single process; also for .zip members, that can only be read from the start
+    for values in _FeedRows(file_name, columns, optional_columns=optional_columns):
+      if keys is None or values[0] in keys:
+        yield convert_row(values)
+    return
+  header_line, chunks = _FileChunks(
+      file_path, max(_PARSE_JOBS * 4, os.path.getsize(file_path) // _PARALLEL_PARSE_CHUNK_BYTES))
+  logging.info('Parsing %r in %d chunks with %d processes', file_name, len(chunks), _PARSE_JOBS)
+  _PARSE_KEYS = keys  # workers are forked with it, instead of getting a copy in every chunk
+  rest_begin = None  # where a chunk cut a quoted value in two, if one did
+  try:
+    with multiprocessing.get_context('fork').Pool(_PARSE_JOBS) as pool:
+      for (begin, _), rows in zip(chunks, pool.imap(_ParseChunk, [
+          (file_path, header_line, begin, end, columns, optional_columns, convert_row)
+          for begin, end in chunks])):
+        if rows is None:
+          rest_begin = begin
+          break
+        yield from rows
+  finally:
+    _PARSE_KEYS = None
+  if rest_begin is not None:
+    # the chunks before it were whole rows, so the file can be read on from there, in order
+    logging.warning('%r has line breaks in quoted values: parsing it from byte %d in one process',
+                    file_name, rest_begin)
+    _, row_values = _RowValuesGetter(
+        file_name, next(csv.reader([header_line.decode('utf-8-sig')])), columns, optional_columns)
+    with open(file_path, 'rb') as feed_file:
+      feed_file.seek(rest_begin)
+      for row in csv.reader(io.TextIOWrapper(feed_file, encoding='utf-8', newline='')):
+        if row:  # skip empty lines
+          values = row_values(row)
+          if keys is None or values[0] in keys:
+            yield convert_row(values)
+
+
+def _FileHash(file_path):
+  sha = hashlib.sha256()
+  with open(file_path, 'rb') as data_file:
+    for block in iter(lambda: data_file.read(_HASH_BLOCK_SIZE), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+def _SourceKeys(with_hashes, file_names=_FEED_FILES):
+  # like {file_name: (size, stamp, hash_or_None)}; missing optional files are None; the stamp
+  # is the mtime_ns (and the hash the sha256) of a file, or the CRC32 (both) of a .zip member
+  sources = {}
+  if _FeedIsZip():
+    with zipfile.ZipFile(_FEED_PATH) as zip_file:
+      for file_name in file_names:
+        zip_info = _ZipMember(zip_file, file_name)
+        if zip_info is None:
+          if file_name not in _OPTIONAL_FEED_FILES:
+            raise FileNotFoundError('%r not found in %r' % (file_name, _FEED_PATH))
+          sources[file_name] = None
+          continue
+        sources[file_name] = (zip_info.file_size, zip_info.CRC, '%08x' % zip_info.CRC)
+    return sources
+  for file_name in file_names:
+    file_path = _FEED_PATH + file_name
+    if file_name in _OPTIONAL_FEED_FILES and not os.path.exists(file_path):
+      sources[file_name] = None
+      continue
+    file_stat = os.stat(file_path)
+    sources[file_name] = (file_stat.st_size, file_stat.st_mtime_ns,
+                          _FileHash(file_path) if with_hashes else None)
+  return sources
+
+
+def _SourcesChange(sources):
+  # like "source 'stops.txt' changed size", or None if sources (like _SourceKeys(True)) are still
+  # the same as the feed files
+  try:
+    current_keys = _SourceKeys(False, tuple(sources))
+  except (FileNotFoundError, zipfile.BadZipFile) as err:
+    return 'sources are gone: %s' % err
+  for file_name, source_key in sources.items():
+    current_key = current_keys.get(file_name)
+    if source_key is None or current_key is None:  # optional file
+      if source_key != current_key:
+        return 'source %r appeared or is gone' % file_name
+      continue
+    size, stamp, sha = source_key
+    if current_key[0] != size:
+      return 'source %r changed size' % file_name
+    # same size but touched: only the content hash can tell if it really changed
+    if current_key[1] != stamp and (
+        current_key[2] if _FeedIsZip() else _FileHash(_FEED_PATH + file_name)) != sha:
+      return 'source %r changed contents' % file_name
+  return None
+
+
+def _IsSnapshotCurrent(header):
+  if header.get('version') != _SNAPSHOT_VERSION:
+    logging.warning('Feed snapshot has version %r, expected %r', header.get('version'),
+                    _SNAPSHOT_VERSION)
+    return False
+  sources_change = _SourcesChange(header['sources'])
+  if sources_change is not None:
+    logging.warning('Feed snapshot %s', sources_change)
+    return False
+  return True
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+  """Finds our classes here whether the snapshot was pickled by __main__ or by an importer."""
+
+  def find_class(self, module, name):
+    if module in ('__main__', __name__):
+      return globals()[name]
+    return super().find_class(module, name)
+
+
+@functools.lru_cache(maxsize=None)
+def _LoadSnapshot():
+  # like {'routes': _LoadRoutes(), 'stops': ..., 'trips': ..., 'stop_times': ..., ...} or None
+  if not os.path.exists(_SNAPSHOT_PATH):
+    logging.info('No feed snapshot in %r: reading CSV files (use "compile" to speed this up)',
+                 _SNAPSHOT_PATH)
+    return None
+  with open(_SNAPSHOT_PATH, 'rb') as snapshot_file:
+    # the header is pickled separately so we don't load the payload of a stale snapshot
+    if not _IsSnapshotCurrent(_SnapshotUnpickler(snapshot_file).load()):
+      logging.warning('Feed snapshot %r is stale: reading CSV files (use "compile" to refresh it)',
+                      _SNAPSHOT_PATH)
+      return None
+    logging.info('Loading feed snapshot %r', _SNAPSHOT_PATH)
+    return _SnapshotUnpickler(snapshot_file).load()
+
+
+def _SourceHashes(sources):  # like {file_name: sha256_or_None} for sources like _SourceKeys(True)
+  return {file_name: None if source_key is None else source_key[2]
+          for file_name, source_key in sources.items()}
+
+
+def _LoadRefreshBase(base_path, feed_hashes):
+  # like _LoadSnapshot(), but for the copy that "refresh" keeps of the feed its timetables were
+  # produced from, or None if there is none or it is not the feed of feed_hashes (the manifest's)
+  if not feed_hashes or not os.path.exists(base_path):
+    return None
+  with open(base_path, 'rb') as snapshot_file:
+    header = _SnapshotUnpickler(snapshot_file).load()
+    if header.get('version') != _SNAPSHOT_VERSION:
+      logging.warning('Refresh base feed %r has version %r, expected %r: ignoring it', base_path,
+                      header.get('version'), _SNAPSHOT_VERSION)
+      return None
+    if _SourceHashes(header['sources']) != feed_hashes:
+      logging.warning('Refresh base feed %r is not the feed of the manifest: ignoring it',
+                      base_path)
+      return None
+    logging.info('Loading refresh base feed %r', base_path)
+    return _SnapshotUnpickler(snapshot_file).load()
+
+
+def _CompileSnapshot():
+  # source keys are taken *before* parsing so a concurrent feed update makes the snapshot stale
+  header = {'version': _SNAPSHOT_VERSION, 'sources': _SourceKeys(True)}
+  timetable = _ParseTimetable(None)
+  payload = {
+      'routes': _ParseRoutes(),
+      'stops': _ParseStops(),
+      'trips': _ParseTrips(),
+      'stop_times': timetable,
+      'connections': _BuildConnections(timetable),
+      'calendar': _ServiceCalendar(_ParseCalendar(), *_ParseCalendarDates()),
+      'transfers': _ParseTransfers(),
+  }
+  temp_path = _SNAPSHOT_PATH + '.tmp'
+  with open(temp_path, 'wb') as snapshot_file:
+    pickle.dump(header, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(payload, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(temp_path, _SNAPSHOT_PATH)  # atomic: readers see either the old or the new one
+  _LoadSnapshot.cache_clear()
+  logging.info('Saved feed snapshot %r', _SNAPSHOT_PATH)
+  _SaveNames({file_name: header['sources'][file_name] for file_name in _NAMES_FILES},
+             payload['routes'], payload['stops'])
+  return header['sources']
+
+
+def _SaveNames(sources, routes, stops_names):
+  # sources like _SourceKeys(True, _NAMES_FILES), taken before parsing routes and stops_names
+  temp_path = _NAMES_PATH + '.tmp'
+  with open(temp_path, 'wb') as names_file:
+    pickle.dump({'version': _NAMES_VERSION, 'sources': sources, 'routes': routes,
+                 'stops': stops_names}, names_file, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(temp_path, _NAMES_PATH)
+  logging.info('Saved names index %r', _NAMES_PATH)
+
+
+def _LoadNames():
+  # like (_LoadRoutes(), _LoadStops()), but from the names index while it is current, and only
+  # parsing routes.txt and stops.txt (then saving the index) when it is not; never warns, as
+  # shell completion calls it with no logging set up
+  if _FEED_DB is not None:
+    return (_QueryRoutes(), _QueryStops())
+  try:
+    with open(_NAMES_PATH, 'rb') as names_file:
+      names = pickle.load(names_file)
+    sources_change = ('has version %r, expected %r' % (names.get('version'), _NAMES_VERSION)
+                      if names.get('version') != _NAMES_VERSION else
+                      _SourcesChange(names['sources']))
+    if sources_change is None:
+      return (names['routes'], names['stops'])
+    logging.info('Names index %r %s', _NAMES_PATH, sources_change)
+  except FileNotFoundError:
+    logging.info('No names index in %r', _NAMES_PATH)
+  except (OSError, EOFError, pickle.UnpicklingError) as err:
+    logging.info('Names index %r is unreadable: %s', _NAMES_PATH, err)
+  sources = _SourceKeys(True, _NAMES_FILES)
+  routes, stops_names = _ParseRoutes(), _ParseStops()
+  try:
+    _SaveNames(sources, routes, stops_names)
+  except OSError as err:  # like a read-only feed directory: it all works, just not as fast
+    logging.info('Names index %r not saved: %s', _NAMES_PATH, err)
+  return (routes, stops_names)
+
+
+def _OpenFeedDB(db_path):  # like sqlite3.Connection, with the tables and indexes created
+  db = sqlite3.connect(db_path, check_same_thread=False)  # the server reloads from a thread
+  db.executescript(_DB_SCHEMA)
+  return db
+
+
+def _FeedVersions(db):  # like [(version, feed_path, imported_at), ...], oldest import first
+  return db.execute(
+      'SELECT version, feed_path, imported_at FROM feeds ORDER BY imported_at, version').fetchall()
+
+
+def _SetFeedDB(db_path, feed_version):
+  # makes the _Load*() functions query feed_version (the last imported if empty) in db_path
+  global _FEED_DB  # pylint: disable=global-statement
+  if not os.path.exists(db_path):
+    raise Error('Feed database %r not found: use "import" to create it' % db_path)
+  db = _OpenFeedDB(db_path)
+  versions = [version for version, _, _ in _FeedVersions(db)]
+  if not versions:
+    raise Error('Feed database %r is empty: use "import" to add a feed' % db_path)
+  if not feed_version:
+    feed_version = versions[-1]
+  elif feed_version not in versions:
+    raise Error('Feed version %r not in %r; available: %s' % (
+        feed_version, db_path, ', '.join(repr(v) for v in versions)))
+  _FEED_DB = (db, feed_version)
+  logging.info('Feed database: %r, version %r', db_path, feed_version)
+
+
+def _ImportFeed(db_path, feed_version):
+  # imports the feed in use (see _SetFeed()) into db_path as feed_version, replacing it if there
+  db = _OpenFeedDB(db_path)
+  sources = _SourceKeys(False)
+  # rows, like {table_name: iter((value1, value2, ...), ...)}, in the _DB_SCHEMA column order
+  transfers = _ParseTransfers()
+  tables_rows = {
+      'routes': _FeedRows('routes.txt', ('route_id', 'route_long_name')),
+      'stops': _FeedRows('stops.txt', ('stop_id', 'stop_name')),
+      'trips': ((trip_id, route_id, service_id, int(bool_direction_id))
+                for trip_id, (route_id, service_id, bool_direction_id) in _ParseTable(
+                    'trips.txt', ('trip_id', 'route_id', 'service_id', 'direction_id'), _TripRow,
+                    optional_columns=('direction_id',))),
+      'stop_times': _ParseTable(
+          'stop_times.txt',
+          ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'),
+          _TimetableRow),
+      'calendar': _ParseCalendar(),
+      'calendar_dates': ((service_id, date, int(exception_type))
+                         for service_id, date, exception_type in _FeedRows(
+                             'calendar_dates.txt', ('service_id', 'date', 'exception_type'))),
+      'transfers': ((from_stop_id, to_stop_id, min_transfer_time)
+                    for (from_stop_id, to_stop_id), min_transfer_time in transfers.items()),
+  }
+  with db:  # a single transaction: readers never see a half imported version
+    for table_name in _DB_TABLES:
+      db.execute('DELETE FROM %s WHERE version = ?' % table_name, (feed_version,))
+    for table_name, rows in tables_rows.items():
+      rows_count = 0
+      rows = ((feed_version,) + tuple(row) for row in rows)
+      while True:
+        batch = [row for _, row in zip(range(_DB_BATCH_SIZE), rows)]
+        if not batch:
+          break
+        db.executemany('INSERT INTO %s VALUES (%s)' % (
+            table_name, ', '.join('?' * len(batch[0]))), batch)
+        rows_count += len(batch)
+      logging.info('Imported %d rows into %r', rows_count, table_name)
+    db.execute('INSERT INTO feeds VALUES (?, ?, ?, ?)', (
+        feed_version, os.path.abspath(_FEED_PATH),
+        datetime.datetime.now().isoformat(timespec='seconds'), json.dumps(sources)))
+  db.execute('ANALYZE')  # so the query planner knows the indexes are selective
+  logging.info('Imported feed %r into %r as version %r', _FEED_PATH, db_path, feed_version)
+  return db
+
+
+def _QueryRoutes():  # like _ParseRoutes(), from _FEED_DB
+  db, feed_version = _FEED_DB
+  return dict(db.execute(
+      'SELECT route_id, route_long_name FROM routes WHERE version = ?', (feed_version,)))
+
+
+def _QueryStops():  # like _ParseStops(), from _FEED_DB
+  db, feed_version = _FEED_DB
+  return dict(db.execute(
+      'SELECT stop_id, stop_name FROM stops WHERE version = ?', (feed_version,)))
+
+
+def _QueryTrips(desired_route_ids):  # like _ParseTrips(), from _FEED_DB; None for all routes
+  db, feed_version = _FEED_DB
+  if desired_route_ids is None:
+    rows = db.execute('SELECT trip_id, route_id, service_id, direction_id FROM trips '
+                      'WHERE version = ?', (feed_version,))
+  else:
+    desired_route_ids = sorted(desired_route_ids)
+    rows = db.execute(
+        'SELECT trip_id, route_id, service_id, direction_id FROM trips '
+        'WHERE version = ? AND route_id IN (%s)' % ', '.join('?' * len(desired_route_ids)),
+        [feed_version] + desired_route_ids)
+  return _InternTrips((trip_id, (route_id, service_id, bool(direction_id)))
+                      for trip_id, route_id, service_id, direction_id in rows)
+
+
+def _QueryTimetable(desired_trips):  # like _ParseTimetable(), from _FEED_DB
+  db, feed_version = _FEED_DB
+  if desired_trips is None:
+    return _StopTimes(db.execute(
+        'SELECT trip_id, arrival, departure, stop_id, stop_sequence FROM stop_times '
+        'WHERE version = ?', (feed_version,)))
+  # the trips can be many thousands: they go in a temporary table, joined using the trip index
+  with db:
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS desired_trips (trip_id TEXT PRIMARY KEY)')
+    db.execute('DELETE FROM desired_trips')
+    db.executemany('INSERT INTO desired_trips VALUES (?)', ((t,) for t in desired_trips))
+    return _StopTimes(db.execute(
+        'SELECT s.trip_id, s.arrival, s.departure, s.stop_id, s.stop_sequence '
+        'FROM desired_trips AS d CROSS JOIN stop_times AS s '  # CROSS: d is the outer loop
+        'ON s.version = ? AND s.trip_id = d.trip_id', (feed_version,)))
+
+
+def _QueryServiceCalendar():  # like _LoadServiceCalendar(), from _FEED_DB
+  db, feed_version = _FEED_DB
+  calendar_rows = db.execute(
+      'SELECT service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, '
+      'start_date, end_date FROM calendar WHERE version = ?', (feed_version,)).fetchall()
+  date_inclusions, date_exclusions = {}, {}
+  for service_id, date, exception_type in db.execute(
+      'SELECT service_id, date, exception_type FROM calendar_dates WHERE version = ?',
+      (feed_version,)):
+    dates = date_inclusions if exception_type == 1 else date_exclusions
+    dates.setdefault(service_id, set()).add(_ParseDate(date))
+  return _ServiceCalendar(calendar_rows, date_inclusions, date_exclusions)
+
+
+def _QueryTransfers():  # like _ParseTransfers(), from _FEED_DB
+  db, feed_version = _FEED_DB
+  return {(from_stop_id, to_stop_id): min_transfer_time
+          for from_stop_id, to_stop_id, min_transfer_time in db.execute(
+              'SELECT from_stop_id, to_stop_id, min_transfer_time FROM transfers '
+              'WHERE version = ?', (feed_version,))}
+
+
+def _PrintFeedVersions(db_path, db):
+  versions_obj = prettytable.PrettyTable(['Feed Version', 'Imported', 'From'])
+  for version, feed_path, imported_at in _FeedVersions(db):
+    versions_obj.add_row([version, imported_at, feed_path])
+  click.echo()
+  click.echo('Feed versions in %s' % db_path)
+  click.echo()
+  click.echo(versions_obj)
+  click.echo()
+
+
+def _ParseRoutes():  # like {route_id: route_long_name}
+  return dict(_FeedRows('routes.txt', ('route_id', 'route_long_name')))
+
+
+def _NormalizeName(name):  # like 'Sandycove And Glasthule' -> 'sandycove and glasthule'
+  name = unicodedata.normalize('NFKD', name)
+  name = ''.join(c if c.isalnum() else ' ' for c in name if not unicodedata.combining(c))
+  return ' '.join(name.casefold().split())
+
+
+def _Trigrams(normalized_name):  # like 'tara st' -> {'  t', ' ta', 'tar', ..., 'st '}
+  padded = '  %s ' % normalized_name
+  return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _NameIndex:
+  """Case and accent insensitive index of official names (of stops or routes) to their IDs.
+
+  Exact lookups are a dict access on the normalized name, prefix search is a bisect over the
+  sorted normalized names and fuzzy search ranks names by trigram similarity (Jaccard), looking
+  only at names that share at least one trigram with the query.
+  """
+
+  __slots__ = ('id_names', 'ids', 'names', 'sorted_keys', 'trigrams')
+
+  _FUZZY_MIN_SIMILARITY = 0.25
+
+  def __init__(self, id_names):  # id_names like {stop_id: stop_name} or {route_id: route_name}
+    self.id_names = id_names
+    self.ids, self.names, self.trigrams = {}, {}, {}
+    for item_id, name in id_names.items():
+      key = _NormalizeName(name)
+      self.ids.setdefault(key, set()).add(item_id)
+      self.names.setdefault(key, name)
+    self.sorted_keys = sorted(self.ids)
+    for key in self.sorted_keys:
+      for trigram in _Trigrams(key):
+        self.trigrams.setdefault(trigram, []).append(key)
+
+  def Lookup(self, name):  # like {id1, id2, ...}, empty if not found
+    """The IDs with that name, case and accent insensitive."""
+    return set(self.ids.get(_NormalizeName(name), ()))
+
+  def OfficialName(self, name):  # like 'Tara St' for 'tara st', or None if not found
+    """The official spelling of name."""
+    return self.names.get(_NormalizeName(name))
+
+  def Prefix(self, prefix):  # like [official_name1, ...] starting with prefix, sorted
+    """The official names that start like prefix."""
+    key = _NormalizeName(prefix)
+    keys = []
+    for i in range(bisect.bisect_left(self.sorted_keys, key), len(self.sorted_keys)):
+      if not self.sorted_keys[i].startswith(key):
+        break
+      keys.append(self.sorted_keys[i])
+    return [self.names[k] for k in keys]
+
+  def Fuzzy(self, name, max_results):  # like [(similarity, official_name1), ...], best first
+    """The official names most like name, by shared trigrams."""
+    query_trigrams = _Trigrams(_NormalizeName(name))
+    shared = collections.Counter(
+        key for trigram in query_trigrams for key in self.trigrams.get(trigram, ()))
+    scored = []
+    for key, shared_count in shared.items():
+      similarity = shared_count / (len(query_trigrams) + len(_Trigrams(key)) - shared_count)
+      if similarity >= self._FUZZY_MIN_SIMILARITY:
+        scored.append((-similarity, key))
+    return [(-negative_similarity, self.names[key])
+            for negative_similarity, key in sorted(scored)[:max_results]]
+
+  def Search(self, query, max_results):
+    """The exact, prefix and fuzzy matches of query."""
+    # like [(match_kind, official_name, {id1, ...}), ...], exact then prefix then fuzzy matches
+    found, results = set(), []
+    candidates = [('exact', self.names[k]) for k in (_NormalizeName(query),) if k in self.ids]
+    candidates.extend(('prefix', n) for n in self.Prefix(query))
+    candidates.extend(('fuzzy %.2f' % similarity, n) for similarity, n in self.Fuzzy(
+        query, max_results))
+    for match_kind, name in candidates:
+      if name not in found and len(results) < max_results:
+        found.add(name)
+        results.append((match_kind, name, self.Lookup(name)))
+    return results
+
+  def Suggestion(self, name):  # like ' (did you mean "Tara St"?)' or ''
+    """A hint for an error message about name."""
+    suggestions = [n for _, n in self.Fuzzy(name, 3)] or self.Prefix(name)[:3]
+    return ' (did you mean %s?)' % ' or '.join(
+        '%r' % n for n in suggestions) if suggestions else ''
+
+
+def _LoadRoutes():  # like {route_id: route_long_name}
+  if _FEED_DB is not None:
+    return _QueryRoutes()
+  snapshot = _LoadSnapshot()
+  return dict(snapshot['routes']) if snapshot is not None else _ParseRoutes()
+
+
+def _RouteIDByName(routes_index, desired_route):  # routes_index like _NameIndex(_LoadRoutes())
+  route_ids = routes_index.Lookup(desired_route)
+  if not route_ids:
+    raise Error('Route %r not found%s: use "list" or "search" commands to see available routes' % (
+        desired_route, routes_index.Suggestion(desired_route)))
+  return route_ids
+
+
+def _ParseStops():  # like {stop_id: stop_name}
+  return dict(_FeedRows('stops.txt', ('stop_id', 'stop_name')))
+
+
+def _LoadStops():  # like {stop_id: stop_name}
+  if _FEED_DB is not None:
+    return _QueryStops()
+  snapshot = _LoadSnapshot()
+  # a copy, as the caller will monkey-patch fake stops into it
+  return dict(snapshot['stops']) if snapshot is not None else _ParseStops()
+
+
+def _StopIDsByName(stops_index, desired_stop_name):  # stops_index like _NameIndex(_LoadStops())
+  stop_ids = stops_index.Lookup(desired_stop_name)
+  if not stop_ids:
+    raise Error('Stop %r not found%s: use "list" or "search" commands to see available stops' % (
+        desired_stop_name, stops_index.Suggestion(desired_stop_name)))
+  return stop_ids
+
+
+def _TripRow(values):  # like ('trip_id', ('route_id', 'service_id', bool_direction_id))
+  trip_id, route_id, service_id, direction_id = values
+  return (trip_id, (route_id, service_id, bool(int(direction_id or '0'))))
+
+
+def _InternTrips(trip_rows):
+  # like {trip_id: (route_id, service_id, bool_direction_id)} for trip_rows like _TripRow()s; the
+  # trips of a route, service and direction all share one tuple, and trip IDs are interned so
+  # _StopTimes() shares them too (also in snapshots, as pickle keeps shared objects shared)
+  records = {}
+  return {sys.intern(trip_id): records.setdefault(record, record) for trip_id, record in trip_rows}
+
+
+def _ParseTrips():  # like {trip_id: (route_id, service_id, bool_direction_id)}
+  return _InternTrips(_ParseTable(
+      'trips.txt', ('trip_id', 'route_id', 'service_id', 'direction_id'), _TripRow,
+      optional_columns=('direction_id',)))
+
+
+def _LoadTrips():  # like {trip_id: (route_id, service_id, bool_direction_id)}
+  if _FEED_DB is not None:
+    return _QueryTrips(None)
+  snapshot = _LoadSnapshot()
+  return snapshot['trips'] if snapshot is not None else _ParseTrips()
+
+
+def _TripsForRoute(all_trips, desired_route_ids, service_exclusions):
+  # like {trip_id: (service_id, bool_direction_id)}; all_trips like _LoadTrips()
+  return {trip_id: (service_id, bool_direction_id)
+          for trip_id, (route_id, service_id, bool_direction_id) in all_trips.items()
+          if route_id in desired_route_ids and service_id not in service_exclusions}
+
+
+def _LoadTripsForRoute(desired_route_ids, service_exclusions):
+  # like {trip_id: (service_id, bool_direction_id)}
+  if _FEED_DB is not None:  # the database has an index by route
+    return _TripsForRoute(_QueryTrips(desired_route_ids), desired_route_ids, service_exclusions)
+  return _TripsForRoute(_LoadTrips(), desired_route_ids, service_exclusions)
+
+
+def _TimetableRow(values):
+  # like ('trip_id', int_arrival, int_departure, 'stop_id', int_stop_sequence)
+  trip_id, arrival_time, departure_time, stop_id, stop_sequence = values
+  return (trip_id, _TimeToSeconds(arrival_time), _TimeToSeconds(departure_time), stop_id,
+          int(stop_sequence))
+
+
+def _ParseTimetable(desired_trips):  # like _StopTimes(); if desired_trips is None loads all
+  # rows of a trip can be anywhere in the file (and in any chunk): _StopTimes() groups them
+  # by trip and sorts them by stop sequence
+  return _StopTimes(_ParseTable(
+      'stop_times.txt', ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'),
+      _TimetableRow, keys=desired_trips))
+
+
+def _LoadTimetableForTrips(desired_trips):
+  # like _StopTimes(), with at least the desired_trips in it (all if desired_trips is None), and
+  # with the --realtime delays, if any
+  if _FEED_DB is not None:
+    timetable = _QueryTimetable(desired_trips)
+  else:
+    snapshot = _LoadSnapshot()
+    # the snapshot has all trips, but there is no point in copying: access is by trip anyway
+    timetable = snapshot['stop_times'] if snapshot is not None else _ParseTimetable(desired_trips)
+  if _REALTIME_SOURCE is not None:
+    # like the server's later updates: a realtime feed that is down just means no delays yet
+    try:
+      logging.info('Realtime updates changed %d trips',
+                   _ApplyTripUpdates(timetable, _ReadRealtime(_REALTIME_SOURCE)))
+    except (Error, OSError, ValueError) as err:
+      logging.error('Realtime update failed, going on with no delays: %s', err)
+  return timetable
+
+
+def _AllDatesInPeriod(initial_date, final_date):
+  dt = initial_date
+  while dt <= final_date:
+    yield dt
+    dt += _ONE_DAY
+
+
+def _ParseTransfers():
+  # like {(from_stop_id, to_stop_id): int_min_transfer_seconds} for the *possible* transfers
+  if not _FeedFileExists('transfers.txt'):
+    return {}  # this file is optional in GTFS
+  transfers = {}
+  for from_stop_id, to_stop_id, transfer_type, min_transfer_time in _FeedRows(
+      'transfers.txt', ('from_stop_id', 'to_stop_id', 'transfer_type', 'min_transfer_time'),
+      optional_columns=('min_transfer_time',)):
+    transfer_type = int(transfer_type or '0')
+    if transfer_type == 3:
+      continue  # transfer not possible
+    # 0 (recommended) and 1 (timed) have no minimum time; 2 has min_transfer_time
+    transfers[(from_stop_id, to_stop_id)] = (
+        int(min_transfer_time or '0') if transfer_type == 2 else 0)
+  return transfers
+
+
+def _LoadTransfers():  # like _ParseTransfers()
+  if _FEED_DB is not None:
+    return _QueryTransfers()
+  snapshot = _LoadSnapshot()
+  return snapshot['transfers'] if snapshot is not None else _ParseTransfers()
+
+
+def _ParseDate(date_repr):  # like '20180910' -> datetime.date(2018, 9, 10)
+  return datetime.datetime.strptime(date_repr, _DATE_REPR).date()
+
+
+class _ServiceCalendar:
+  """Active days of every service, as one int bitset per service over the feed validity window.
+
+  Bit `i` of `days[service_id]` is set if the service runs on `first_date + i days`, with the
+  calendar_dates.txt inclusions and exclusions already applied; `dated[service_id]` has the
+  days of its calendar.txt period, whatever the weekday, with the same inclusions and exclusions.
+  Every date query is then a couple of big-int operations per service, with no date objects
+  created.
+  """
+
+  __slots__ = ('first_date', 'last_date', 'periods', 'weekdays', 'days', 'dated')
+
+  def __init__(self, calendar_rows, date_inclusions, date_exclusions):
+    # calendar_rows like _ParseCalendar();
+    # date_inclusions/date_exclusions like _ParseCalendarDates()
+    self.periods, self.weekdays, self.days, self.dated = {}, {}, {}, {}
+    for (service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday,
+         start_date, end_date) in calendar_rows:
+      self.periods[service_id] = (_ParseDate(start_date), _ParseDate(end_date))
+      self.weekdays[service_id] = tuple(
+          bool(int(d)) for d in (monday, tuesday, wednesday, thursday, friday, saturday, sunday))
+    all_dates = [d for period in self.periods.values() for d in period]
+    all_dates.extend(d for dates in date_inclusions.values() for d in dates)
+    if not all_dates:
+      raise Error('No services found in calendar.txt!')
+    self.first_date, self.last_date = min(all_dates), max(all_dates)
+    # bits for each weekday (0 == Monday) over the whole window, so we never loop over dates
+    window_days = (self.last_date - self.first_date).days + 1
+    weekly = sum(1 << i for i in range(0, window_days, 7))
+    first_weekday = self.first_date.weekday()
+    weekday_bits = [(weekly << ((weekday - first_weekday) % 7)) & ((1 << window_days) - 1)
+                    for weekday in range(7)]
+    for service_id, (start_date, end_date) in self.periods.items():
+      scheduled = 0
+      for weekday, bool_runs in enumerate(self.weekdays[service_id]):
+        if bool_runs:
+          scheduled |= weekday_bits[weekday]
+      dated = self._Mask(start_date, end_date)
+      days = scheduled & dated
+      for date in date_inclusions.get(service_id, ()):
+        days |= 1 << self._Index(date)
+        dated |= 1 << self._Index(date)
+      for date in date_exclusions.get(service_id, ()):
+        days &= ~(1 << self._Index(date))
+        dated &= ~(1 << self._Index(date))
+      self.dated[service_id], self.days[service_id] = dated, days
+
+  def _Index(self, date):
+    return (date - self.first_date).days
+
+  def _Mask(self, first_date, last_date):  # bits of the date range, clipped to the window
+    first_date, last_date = max(first_date, self.first_date), min(last_date, self.last_date)
+    if first_date > last_date:
+      return 0
+    return ((1 << ((last_date - first_date).days + 1)) - 1) << self._Index(first_date)
+
+  def Running(self, date):  # like {service_id1, ...} that run on date
+    """The services that run on date."""
+    return self.RunningAny(date, date)
+
+  def RunningAny(self, first_date, last_date):  # like {service_id1, ...} that run on some day
+    """The services that run on any day of the period."""
+    mask = self._Mask(first_date, last_date)
+    return {service_id for service_id, days in self.days.items() if days & mask}
+
+  def RunningEvery(self, first_date, last_date):  # like {service_id1, ...} that run on all days
+    """The services that run on every day of the period."""
+    if first_date < self.first_date or last_date > self.last_date:
+      return set()  # no service runs outside the window
+    mask = self._Mask(first_date, last_date)
+    return {service_id for service_id, days in self.days.items() if days & mask == mask}
+
+  def Disrupted(self, first_date, last_date):
+    """The services with some day of the period outside their dates."""
+    # like {service_id1, ...} with some day in range outside their period (plus inclusions, minus
+    # exclusions), whatever the weekday; days outside the window are outside every period
+    if first_date < self.first_date or last_date > self.last_date:
+      return set(self.dated)
+    mask = self._Mask(first_date, last_date)
+    return {service_id for service_id, dated in self.dated.items() if mask & ~dated}
+
+
+def _ParseCalendarDates():
+  # like ({service_id: {included_date1, ...}}, {service_id: {excluded_date1, ...}})
+  date_inclusions, date_exclusions = {}, {}
+  for service_id, date, exception_type in _FeedRows(
+      'calendar_dates.txt', ('service_id', 'date', 'exception_type')):
+    date, exception_type = _ParseDate(date), int(exception_type)
+    if exception_type == 1:
+      date_inclusions.setdefault(service_id, set()).add(date)
+    elif exception_type == 2:
+      date_exclusions.setdefault(service_id, set()).add(date)
+    else:
+      raise Error('Unexpected exception_type in calendar_dates.txt!')
+  return (date_inclusions, date_exclusions)
+
+
+def _ParseCalendar():
+  # like [(service_id, monday, ..., sunday, start_date, end_date), ...], all as strings
+  return list(_FeedRows('calendar.txt', (
+      'service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+      'start_date', 'end_date')))
+
+
+def _LoadServiceCalendar():  # like _ServiceCalendar()
+  if _FEED_DB is not None:
+    return _QueryServiceCalendar()
+  snapshot = _LoadSnapshot()
+  if snapshot is not None:
+    return snapshot['calendar']
+  return _ServiceCalendar(_ParseCalendar(), *_ParseCalendarDates())
+
+
+def _ServiceDates(calendar, timetable_date):
+  # like {service_id: (bool_working_days, bool_saturday, bool_sunday, bool_irregular)}
+  # service_exclusions like {service_id1, service_id2, ...}
+  # check if the schedule is current
+  for start_date, end_date in calendar.periods.values():
+    if not start_date <= timetable_date <= end_date:
+      raise Error(
+          'Current date (%s) is outside dates in calendar.txt (%s to %s)! '
+          'You need to refresh Irish Rail data!' %
+          (timetable_date.strftime(_DATE_REPR),
+           start_date.strftime(_DATE_REPR), end_date.strftime(_DATE_REPR)))
+  # services that don't run as scheduled in the next _LOOK_AHEAD_IN_DAYS are filtered out
+  service_exclusions = calendar.Disrupted(
+      timetable_date, timetable_date + datetime.timedelta(days=_LOOK_AHEAD_IN_DAYS))
+  for service_id in sorted(service_exclusions):
+    logging.warning(
+        'Removing service_id %r because not all days in next %d are in this period',
+        service_id, _LOOK_AHEAD_IN_DAYS)
+  # figure out working day (Mon-Fri) schedule and irregular schedules
+  service_dates = {}
+  for service_id, (monday, tuesday, wednesday, thursday, friday,
+                   saturday, sunday) in calendar.weekdays.items():
+    bool_working_days = monday and tuesday and wednesday and thursday and friday
+    bool_irregular = (
+        (not bool_working_days and not saturday and not sunday) or  # no useful cathegories found
+        (not bool_working_days and                                  # not all weekdays
+         any((monday, tuesday, wednesday, thursday, friday))))
+    service_dates[service_id] = (bool_working_days, saturday, sunday, bool_irregular)
+  return (service_dates, service_exclusions)
+
+
+def _CalendarWindow(calendar):
+  # like (first_date, last_date), the dates that are in every calendar.txt period, so the only
+  # ones _ServiceDates() accepts (None if there are no periods)
+  if not calendar.periods:
+    return None
+  return (max(start_date for start_date, _ in calendar.periods.values()),
+          min(end_date for _, end_date in calendar.periods.values()))
+
+
+def _LoadServiceDates(timetable_date):  # like _ServiceDates()
+  return _ServiceDates(_LoadServiceCalendar(), timetable_date)
+
+
+class _Feed:
+  """The whole loaded feed, for operations that answer many queries from a single load."""
+
+  __slots__ = ('routes', 'stops', 'routes_index', 'stops_index', 'trips', 'timetable', 'calendar',
+               'transfers', 'source_keys', '_board')
+
+  def __init__(self, routes, stops, trips, timetable, calendar, transfers, source_keys):
+    self.routes = routes  # like _LoadRoutes()
+    self.stops = stops  # like _LoadStops()
+    self.routes_index, self.stops_index = _NameIndex(routes), _NameIndex(stops)
+    self.trips = trips  # like _LoadTrips()
+    self.timetable = timetable  # like _LoadTimetableForTrips()
+    self.calendar = calendar  # like _LoadServiceCalendar()
+    self.transfers = transfers  # like _LoadTransfers()
+    self.source_keys = source_keys  # like _SourceKeys(False), taken before loading; None for a DB
+    self._board = None
+
+  def Board(self):  # like _DepartureBoard(self), created on first use
+    """The departure board of this feed."""
+    if self._board is None:
+      self._board = _DepartureBoard(self)
+    return self._board
+
+  def StopCodes(self, stop_name):  # like {stop_code1, ...}, for all IDs with that name
+    """The stop codes of the station stop_name."""
+    return {self.timetable.stop_codes[stop_id]
+            for stop_id in _StopIDsByName(self.stops_index, stop_name)
+            if stop_id in self.timetable.stop_codes}
+
+
+def _LoadFeed(desired_route_ids=None):  # like _Feed(); if desired_route_ids is None loads all
+  with _Stage('feed_load') as stage:
+    source_keys = _SourceKeys(False) if _FEED_DB is None else None
+    if _FEED_DB is not None:  # the database has an index by route
+      trips = _QueryTrips(desired_route_ids)
+    else:
+      trips = _LoadTrips()
+      if desired_route_ids is not None:
+        trips = {trip_id: trip for trip_id, trip in trips.items() if trip[0] in desired_route_ids}
+    feed = _Feed(_LoadRoutes(), _LoadStops(), trips,
+                 _LoadTimetableForTrips(None if desired_route_ids is None else set(trips)),
+                 _LoadServiceCalendar(), _LoadTransfers(), source_keys)
+    stage['rows'] = feed.timetable.rows_count
+    return feed
+
+
+def _OutputName(route_names):  # like 'DART_Commuter_Service'
+  return ('_'.join(route_names)).replace(' ', '_').replace('/', '_')
+
+
+def _TimetableSpec(
+    routes_index, routes_list, stops_list, aliases_list, fakes_list, date_to_use, end_date,
+    allow_irregulars, idcol_out, max_trips, output_name=None):
+  # like {'name': output_name, 'routes': {route_name, ...}, 'route_ids': {route_id, ...},
+  #       'stops': {stop_name, ...}, 'aliases': {stop_name: alias},
+  #       'fakes': {alias: (stop_name, int_delta_minutes)}, 'dates': (first_date, last_date),
+  #       'irregular': bool, 'idcol': bool, 'max_trips': int}
+  desired_rout_names, desired_route_ids = set(), set()
+  for route_name in {r.strip() for r in routes_list if r.strip()}:
+    desired_route_ids.update(_RouteIDByName(routes_index, route_name))
+    desired_rout_names.add(routes_index.OfficialName(route_name))  # so outputs are named the same
+  stops_set = {s.strip() for s in stops_list if s.strip()}
+  if not desired_rout_names or len(stops_set) < 2:
+    raise Error('Timetables need at least one route and two stops')
+  # compute dates: we produce the timetables for every day in the [date_to_use, end_date] period
+  date_to_use, end_date = date_to_use.strip(), end_date.strip()
+  first_date = _ParseDate(date_to_use) if date_to_use else datetime.date.today()
+  last_date = _ParseDate(end_date) if end_date else first_date
+  if last_date < first_date:
+    raise Error('End date (%s) is before start date (%s)' % (
+        last_date.strftime(_DATE_REPR), first_date.strftime(_DATE_REPR)))
+  return {
+      'name': output_name or _OutputName(desired_rout_names),
+      'routes': desired_rout_names,
+      'route_ids': desired_route_ids,
+      'stops': stops_set,
+      'aliases': {s.strip(): a.strip() for s, a in aliases_list if s.strip()},
+      'fakes': {a.strip(): (s.strip(), int(d)) for a, s, d in fakes_list if s.strip()},
+      'dates': (first_date, last_date),
+      'irregular': bool(allow_irregulars),
+      'idcol': bool(idcol_out),
+      'max_trips': int(max_trips),
+  }
+
+
+def _LogSpec(spec):
+  logging.info('Routes: %s', ', '.join(repr(n) for n in sorted(spec['routes'])))
+  logging.info('Stations: %s', ', '.join(repr(n) for n in sorted(spec['stops'])))
+  logging.info('Aliases: %s', ', '.join(
+      '%r=%r' % (n, spec['aliases'][n]) for n in sorted(spec['aliases'])))
+  logging.info('Fake Stations: %s', ', '.join(
+      '%r=%r/%dmin' % (n, spec['fakes'][n][0], spec['fakes'][n][1]) for n in sorted(spec['fakes'])))
+  logging.info('Dates: %s to %s', *(d.strftime(_DATE_REPR) for d in spec['dates']))
+
+
+def _BuildSpecTables(spec, stops_index, trips, timetable, calendar):
+  # yields (timetable_date, output_tables) for every date in spec; see _BuildOutputTables()
+  for timetable_date in _AllDatesInPeriod(*spec['dates']):
+    logging.info('Date: %s', timetable_date.strftime(_DATE_REPR))
+    yield (timetable_date,
+           _BuildOutputTables(spec, stops_index, trips, timetable, calendar, timetable_date))
+
+
+def _FeedSpecTables(feed, spec):  # like list(_BuildSpecTables()), for spec over a _Feed()
+  trips = _TripsForRoute(feed.trips, spec['route_ids'], set())
+  return list(_BuildSpecTables(spec, feed.stops_index, trips, feed.timetable, feed.calendar))
+
+
+def _SpecOutputTables(spec, stops_index, trips, timetable, calendar):
+  # yields _OutputTable() for every date (and direction) in spec, each date built only when its
+  # first table is reached, and with its rows made only as they are read; memory is not constant:
+  # it holds the sorted _TripsMatrix() of every direction of the date (all its trips, with a time
+  # for every stop), that _TableWidths() goes over before the first row, but never the rows
+  for timetable_date in _AllDatesInPeriod(*spec['dates']):
+    logging.info('Date: %s', timetable_date.strftime(_DATE_REPR))
+    matrices, translate_stop_name = _BuildOutputMatrices(
+        spec, stops_index, trips, timetable, calendar, timetable_date)
+    # no 'table_format' stage here: the rows are made as the writers read them, in 'output'
+    yield from _MatrixTables(spec['routes'], timetable_date, matrices, translate_stop_name,
+                             spec['idcol'], spec['max_trips'])
+
+
+def _BuildOutputTables(spec, stops_index, trips, timetable, calendar, timetable_date):
+  # like {bool_direction_id: [header_tuple, row_tuple_1, row_tuple_2, ...]}
+  matrices, translate_stop_name = _BuildOutputMatrices(
+      spec, stops_index, trips, timetable, calendar, timetable_date)
+  with _Stage('table_format') as stage:
+    output_tables = _AssembleRows(matrices, translate_stop_name, spec['idcol'], spec['max_trips'])
+    stage['rows'] = sum(len(trips_table) - 1 for trips_table in output_tables.values())
+  return output_tables
+
+
+def _BuildOutputMatrices(spec, stops_index, trips, timetable, calendar, timetable_date):
+  # like ({bool_direction_id: _TripsMatrix()}, translate_stop_name), sorted
+  # trips like _LoadTripsForRoute(), but without service exclusions, as those depend on the date
+  with _Stage('service_filter') as stage:
+    # get the calendar and drop the trips of the services that are excluded on this date
+    service_dates, service_exclusions = _ServiceDates(calendar, timetable_date)
+    trips = {trip_id: trip for trip_id, trip in trips.items() if trip[0] not in service_exclusions}
+    stage['rows'] = len(trips)
+  with _Stage('table_assembly') as stage:
+    interesting_stops_ids, fake_stops, desired_stops_count, translate_stop_name = (
+        _ResolveStations(spec, stops_index))
+    output_dict = _SelectTrips(
+        trips, timetable, timetable_date, service_dates, interesting_stops_ids, fake_stops,
+        spec['irregular'])
+    matrices = _PadStops(output_dict, desired_stops_count)
+    stage['rows'] = sum(len(matrix.trips) for matrix in matrices.values())
+  with _Stage('sort') as stage:
+    _SortTrips(matrices)
+    stage['rows'] = sum(len(matrix.trips) for matrix in matrices.values())
+  return (matrices, translate_stop_name)
+
+
+def _ResolveStations(spec, stops_index):
+  # like ({stop_id1, fake_name1, ...}, {stop_id: (fake_name, rel_min)}, int_desired_stops_count,
+  #       translate_stop_name(stop_id) -> name_to_output)
+  stops_set, aliases_dict, fakes_dict = spec['stops'], spec['aliases'], spec['fakes']
+  stops_names = dict(stops_index.id_names)  # we will monkey-patch the fake stops into it
+  # get stops and find the interesting ones; note one stop name can translate to multiple IDs
+  station_aliases = {
+      stop_id: stop_alias
+      for stop_name, stop_alias in aliases_dict.items()
+      for stop_id in _StopIDsByName(stops_index, stop_name) if stop_alias}
+  translate_stop_name = lambda stop_id: station_aliases.get(stop_id, None) or stops_names[stop_id]
+  interesting_stops = {stop_name: _StopIDsByName(stops_index, stop_name) for stop_name in stops_set}
+  desired_stops_count = len(stops_set)
+  interesting_stops_ids = {stop_id for stops in interesting_stops.values() for stop_id in stops}
+  # add "fake stops" and then monkey-patch the fake stops into the structures above
+  fake_stops = {stop_id: (fake_name, rel_min)  # pylint: disable=not-an-iterable
+                for fake_name, (rel_stop_name, rel_min) in fakes_dict.items()
+                for stop_id in _StopIDsByName(stops_index, rel_stop_name)}
+  for fake_name, rel_min in fake_stops.values():
+    interesting_stops[fake_name] = {fake_name}  # NOTE: for fake stops the ID and name are the same!
+    stops_names[fake_name] = fake_name
+    interesting_stops_ids.add(fake_name)
+    if not rel_min:
+      raise Error(
+          'Fake stations cannot have zero delay from an actual station (on %r)' % fake_name)
+  desired_stops_count += len(fakes_dict)
+  return (interesting_stops_ids, fake_stops, desired_stops_count, translate_stop_name)
+
+
+def _SelectTrips(trips, timetable, timetable_date, service_dates, interesting_stops_ids,
+                 fake_stops, allow_irregulars):
+  # now we calculate the data to be output, which is like:
+  #   {bool_direction_id: [
+  #       {'id': trip_id, 'week': week_type,
+  #        'start': (stop_id, int_arrival), 'end': (stop_id, int_arrival),
+  #        'stops': [(stop_id, int_arrival), ...more stops...]}, ...more trips...]}
+  # with the trips of each direction grouped by week type and then sorted by trip start;
+  # only the trip patterns that visit at least 2 of our stops are looked at, found by the stop
+  # index, and then only the trips of those patterns; the realtime delays and cancellations, if
+  # any, are for timetable_date, so only the rows of its week type have them (the Sunday row of
+  # a trip in a Monday timetable is for the Sundays)
+  date_week_index = max(timetable_date.weekday() - 4, 0)  # the _WEEK_TYPE of timetable_date
+
+  def _TripStops(stop_codes, arrivals, positions, bool_direction_id):
+    # like ((stop_id, int_arrival), (stop_id, int_arrival), [(stop_id, int_arrival), ...]), the
+    # 'start', 'end' and 'stops' of a trip, for its arrivals
+    from_station = (timetable.stop_ids[stop_codes[0]], arrivals[0])
+    to_station = (timetable.stop_ids[stop_codes[-1]], arrivals[-1])
+    trip_stops = []
+    for position in positions:
+      stop_id, arrival_time = timetable.stop_ids[stop_codes[position]], arrivals[position]
+      # we have a stop to add, but it might have a fake stop associated to it, so here
+      # is where we will add it as if it was part of the line's schedule; we have to be
+      # careful to add it either before or after the master station
+      fake_name, rel_min = fake_stops.get(stop_id, (None, None))
+      if fake_name is not None and (bool_direction_id == (rel_min > 0)):
+        # fake stop before master
+        trip_stops.append((fake_name, arrival_time - abs(rel_min) * 60))
+      trip_stops.append((stop_id, arrival_time))  # master stop
+      if fake_name is not None and (bool_direction_id != (rel_min > 0)):
+        # fake stop after master
+        trip_stops.append((fake_name, arrival_time + abs(rel_min) * 60))
+    return (from_station, to_station, trip_stops)
+
+  selected = []  # like [(int_start, trip_id, trip_code, positions), ...]
+  for pattern_code, positions in timetable.Visits(interesting_stops_ids).items():
+    if len(positions) < 2:
+      continue
+    for trip_code in timetable.pattern_trips[pattern_code]:
+      trip_id = timetable.trip_ids[trip_code]
+      if trip_id not in trips:
+        continue
+      if not allow_irregulars and service_dates[trips[trip_id][0]][3]:
+        logging.debug('Skipping trip %s because it has an irregular schedule', trip_id)
+        continue
+      selected.append((timetable.starts[trip_code], trip_id, trip_code, positions))
+  selected.sort()  # we sort by trip start
+  groups = {(bool_direction_id, week_index): []
+            for bool_direction_id in (False, True) for week_index in _WEEK_TYPE}
+  for _, trip_id, trip_code, positions in selected:
+    service_id, bool_direction_id = trips[trip_id]
+    week_schedule = service_dates[service_id]
+    delayed = timetable.Delays(trip_code, timetable_date) is not None
+    trip_rows = {}  # like {bool_with_delays: _TripStops()}, each made only once
+    for week_index in sorted(_WEEK_TYPE):
+      if not week_schedule[week_index]:
+        continue
+      if week_index == date_week_index and timetable.Cancelled(trip_code, timetable_date):
+        logging.debug('Skipping trip %s because it was cancelled', trip_id)
+        continue
+      with_delays = delayed and week_index == date_week_index
+      if with_delays not in trip_rows:
+        trip_rows[with_delays] = _TripStops(
+            timetable.Stops(trip_code),
+            timetable.Arrivals(trip_code, timetable_date if with_delays else None), positions,
+            bool_direction_id)
+      from_station, to_station, trip_stops = trip_rows[with_delays]
+      # each week type gets its own copy of the stops, as they are padded in place later
+      groups[(bool_direction_id, week_index)].append({
+          'id': trip_id, 'week': week_index,
+          'start': from_station, 'end': to_station, 'stops': list(trip_stops)})
+  return {bool_direction_id: [trip for week_index in sorted(_WEEK_TYPE)
+                              for trip in groups[(bool_direction_id, week_index)]]
+          for bool_direction_id in (False, True)}
+
+
+class _TripsMatrix:
+  """Arrival times of the trips of one direction at the timetable stops, as a dense matrix.
+
+  `times[i * len(stops) + j]` is the arrival of `trips[i]` at `stops[j]`, or _NEVER if the trip
+  does not stop there. The stops are in the order of the first trip that has all of them (the
+  `template`), and every other trip has to visit its stops in that same order.
+  """
+
+  __slots__ = ('stops', 'trips', 'times', 'template')
+
+  def __init__(self, trips_table, desired_stops_count):
+    # trips_table like _SelectTrips()[bool_direction_id]; the 'stops' of the trips are not used
+    # after this, as the times are in the matrix
+    self.trips = trips_table
+    # find first trip who's stop list has all the desired stops to use as a template
+    for trip_n, trip in enumerate(trips_table):
+      if len(trip['stops']) == desired_stops_count:
+        # this is it!
+        self.stops, self.template = tuple(s[0] for s in trip['stops']), trip_n
+        break
+    else:
+      raise Error('No trip was found that had all desired stops!')
+    # fill in the times in a single pass over every trip, matching its stops to the template in
+    # order; if a stop can't be found from where the last one was, the trip has its stops in
+    # another order (can only be a trip with inverted directionality)
+    stops_count = len(self.stops)
+    self.times = array.array('i', [_NEVER]) * (len(trips_table) * stops_count)
+    for trip_n, trip in enumerate(trips_table):
+      row, stop_n = trip_n * stops_count, 0
+      for stop_id, arrival_time in trip['stops']:
+        while stop_n < stops_count and self.stops[stop_n] != stop_id:
+          stop_n += 1
+        if stop_n >= stops_count:
+          raise Error('Found trip with iverted directionality: %s' % trip['id'])
+        self.times[row + stop_n] = arrival_time
+        stop_n += 1
+
+  def Row(self, trip_n):  # like memoryview([int_arrival_or_NEVER, ...]), one for each stop
+    """The arrival times of trip trip_n, one for each stop."""
+    stops_count = len(self.stops)
+    return memoryview(self.times)[trip_n * stops_count:(trip_n + 1) * stops_count]
+
+  def Sort(self):
+    """Sorts the trips by week type and then by their times, see _CmpTripsByFirstSharedTime()."""
+    # when every trip has a time at every stop, comparing by week type and then by the first
+    # different time is comparing whole rows, so a plain key sort; with missing times the
+    # comparator skips the stops either trip does not have, which is not a total order (the
+    # result depends on the order the trips come in), so only the comparator itself can give
+    # the same table; equal trips keep their order either way
+    rows = [self.Row(trip_n) for trip_n in range(len(self.trips))]
+    if _NEVER in self.times:
+      order = sorted(range(len(self.trips)), key=functools.cmp_to_key(
+          lambda a, b: _CmpTripsByFirstSharedTime(
+              (self.trips[a]['week'], rows[a]), (self.trips[b]['week'], rows[b]))))
+    else:
+      keys = [(trip['week'], row.tolist()) for trip, row in zip(self.trips, rows)]
+      order = sorted(range(len(self.trips)), key=keys.__getitem__)
+    self.template = order.index(self.template)
+    self.trips = [self.trips[trip_n] for trip_n in order]
+    sorted_times = array.array('i')
+    for trip_n in order:
+      sorted_times.extend(rows[trip_n])
+    self.times = sorted_times
+
+
+def _CmpTripsByFirstSharedTime(a, b):
+  # a and b like (week, _TripsMatrix.Row()); compares by week type and then by the times at the
+  # first stop where both trips have a time and the times differ (0 if there is none)
+  (week_a, row_a), (week_b, row_b) = a, b
+  if week_a != week_b:
+    return 1 if week_a > week_b else -1
+  for time_a, time_b in zip(row_a, row_b):
+    if time_a != _NEVER and time_b != _NEVER and time_a != time_b:
+      return 1 if time_a > time_b else -1
+  return 0
+
+
+def _PadStops(output_dict, desired_stops_count):  # like {bool_direction_id: _TripsMatrix()}
+  # having the data to output we generate the output
+  # first we have to find out the order of the stations for each direction and make sure this
+  # is consistent across all data, with missing stations as _NEVER times
+  return {bool_direction_id: _TripsMatrix(output_dict[bool_direction_id], desired_stops_count)
+          for bool_direction_id in sorted(output_dict)}
+
+
+def _SortTrips(matrices):
+  # now we can re-sort so we have the first available stop
+  for matrix in matrices.values():
+    matrix.Sort()
+
+
+class _OutputTable:
+  """One table to output, a direction of a timetable on a date, with its rows made as they are read.
+
+  `rows` is an iterator of row tuples (the header is not in it), so writers can stream tables of
+  any size without their rows ever being all in memory (the trips matrix they are made from is);
+  `widths` are the widths of the longest value in each column, header included, for writers that
+  align columns before seeing the rows.
+  """
+
+  __slots__ = ('route_names', 'date', 'bool_direction_id', 'header', 'widths', 'rows')
+
+  def __init__(self, route_names, date, bool_direction_id, header, widths, rows):
+    self.route_names, self.date, self.bool_direction_id = route_names, date, bool_direction_id
+    self.header, self.widths, self.rows = header, widths, rows
+
+  def Title(self):  # like 'DART NORTH table for 20180915'
+    """The title of this table, with its routes, direction and date."""
+    return '%s %s table for %s' % (
+        '/'.join(self.route_names), _DIRECTION(self.bool_direction_id),
+        self.date.strftime(_DATE_REPR))
+
+
+def _TableHeader(matrix, translate_stop_name, idcol_out):  # like ('Days', 'Origin', ...)
+  header = ['Trip ID', 'Days', 'Origin'] if idcol_out else ['Days', 'Origin']
+  for stop_id in matrix.stops:
+    header.append(translate_stop_name(stop_id))
+  header.append('Destination')
+  return tuple(header)
+
+
+def _TableTrips(matrix, max_trips):  # like matrix.trips, but capped at max_trips (if not 0)
+  if max_trips and len(matrix.trips) > max_trips:
+    logging.warning('Trips count was capped at %d, but there were more.', max_trips)
+    return matrix.trips[:max_trips]
+  return matrix.trips
+
+
+def _TableRows(matrix, translate_stop_name, idcol_out, max_trips):
+  # yields the row tuples of matrix, one at a time, like ('Saturday', 'Howth', '08:34', ...)
+  for trip_n, trip in enumerate(_TableTrips(matrix, max_trips)):
+    # add type and start
+    row = [trip['id']] if idcol_out else []
+    row.append(_WEEK_TYPE[trip['week']])
+    row.append(translate_stop_name(trip['start'][0]))
+    # add stops data
+    row.extend('X' if arrival_time == _NEVER else _SecondsRepr(arrival_time)
+               for arrival_time in matrix.Row(trip_n))
+    # add end data
+    row.append(translate_stop_name(trip['end'][0]))
+    yield tuple(row)
+
+
+def _TableWidths(matrix, translate_stop_name, idcol_out, max_trips, header):
+  # like [int_width, ...], the widths of the rows _TableRows() will make, without making them
+  trips = _TableTrips(matrix, max_trips)
+  widths = [len(name) for name in header]
+  columns = [lambda trip: trip['id']] if idcol_out else []
+  columns.append(lambda trip: _WEEK_TYPE[trip['week']])
+  columns.append(lambda trip: translate_stop_name(trip['start'][0]))
+  for n, column in enumerate(columns):
+    widths[n] = max([widths[n]] + [len(column(trip)) for trip in trips])
+  widths[-1] = max([widths[-1]] + [len(translate_stop_name(trip['end'][0])) for trip in trips])
+  # times are all 'HH:MM', so a stop column is only narrower if it is all 'X'
+  stops_count, has_times = len(matrix.stops), [False] * len(matrix.stops)
+  for trip_n in range(len(trips)):
+    for stop_n, arrival_time in enumerate(matrix.Row(trip_n)):
+      has_times[stop_n] = has_times[stop_n] or arrival_time != _NEVER
+  for stop_n in range(stops_count):
+    widths[len(columns) + stop_n] = max(
+        widths[len(columns) + stop_n], len(_SecondsRepr(0)) if has_times[stop_n] else len('X'))
+  return widths
+
+
+def _MatrixTables(route_names, timetable_date, matrices, translate_stop_name, idcol_out,
+                  max_trips):
+  # like [_OutputTable(), ...], one for each direction, the rows still to be made
+  direction_tables = []
+  for bool_direction_id in sorted(matrices):
+    matrix = matrices[bool_direction_id]
+    header = _TableHeader(matrix, translate_stop_name, idcol_out)
+    direction_tables.append(_OutputTable(
+        route_names, timetable_date, bool_direction_id, header,
+        _TableWidths(matrix, translate_stop_name, idcol_out, max_trips, header),
+        _TableRows(matrix, translate_stop_name, idcol_out, max_trips)))
+  return direction_tables
+
+
+def _AssembleRows(matrices, translate_stop_name, idcol_out, max_trips):
+  # like {bool_direction_id: [header_tuple, row_tuple_1, row_tuple_2, ...]}, all in memory
+  return {bool_direction_id: [_TableHeader(matrix, translate_stop_name, idcol_out)] + list(
+              _TableRows(matrix, translate_stop_name, idcol_out, max_trips))
+          for bool_direction_id, matrix in sorted(matrices.items())}
+
+
+def _ListTables(route_names, timetable_date, output_tables):
+  # like [_OutputTable(), ...] for output_tables like _AssembleRows()
+  return [_OutputTable(
+      route_names, timetable_date, bool_direction_id, trips_table[0],
+      [max(len(row[n]) for row in trips_table) for n in range(len(trips_table[0]))],
+      iter(trips_table[1:])) for bool_direction_id, trips_table in sorted(output_tables.items())]
+
+
+class _OutputWriter:
+  """Base of the output writers: they get the tables a row at a time, see _WriteTables()."""
+
+  binary = False  # True for writers that want output_file in bytes, not in text
+
+  def Begin(self, table):
+    """Starts table, before its rows."""
+
+  def Row(self, table, row):
+    """Writes row, a tuple of the values in one row of table."""
+    raise NotImplementedError
+
+  def End(self, table):
+    """Ends table, after its last row."""
+
+  def Close(self):
+    """Ends the output, after the last table."""
+
+
+class _TextWriter(_OutputWriter):
+  """Aligned text tables that look like prettytable's, but written a row at a time."""
+
+  def __init__(self, output_file):
+    self.output_file, self._border = output_file, None
+
+  def _Line(self, values, widths):
+    return '| ' + ' | '.join(str(v).center(w) for v, w in zip(values, widths)) + ' |\n'
+
+  def Begin(self, table):
+    self._border = '+' + '+'.join('-' * (width + 2) for width in table.widths) + '+\n'
+    self.output_file.write('\n%s\n\n%s%s%s' % (
+        table.Title(), self._border, self._Line(table.header, table.widths), self._border))
+
+  def Row(self, table, row):
+    self.output_file.write(self._Line(row, table.widths))
+
+  def End(self, table):
+    self.output_file.write(self._border + '\n')
+
+
+class _CSVWriter(_OutputWriter):
+  """All tables in one CSV, each with its header, and the date and direction added as columns."""
+
+  def __init__(self, output_file):
+    self.csv_writer, self._prefix = csv.writer(output_file, quoting=csv.QUOTE_MINIMAL), None
+
+  def Begin(self, table):
+    self._prefix = (table.date.strftime(_DATE_REPR), _DIRECTION(table.bool_direction_id))
+    self.csv_writer.writerow(('Date', 'Direction') + tuple(table.header))
+
+  def Row(self, table, row):
+    self.csv_writer.writerow(self._prefix + tuple(row))
+
+
+class _CSVFilesWriter(_OutputWriter):
+  """Each table in its own CSV file, see _CSVPath(); this is --csv-out."""
+
+  def __init__(self, output_name):
+    self.output_name, self._csv_writer = output_name, None
+    self._csv_file = contextlib.ExitStack()  # the file of the table being written, if any
+
+  def Begin(self, table):
+    output_path = _CSVPath(self.output_name, table.bool_direction_id, table.date)
+    logging.info('Saving %r', output_path)
+    self._csv_writer = csv.writer(
+        self._csv_file.enter_context(open(output_path, 'wt', newline='')),
+        quoting=csv.QUOTE_MINIMAL)
+    self._csv_writer.writerow(table.header)
+
+  def Row(self, table, row):
+    self._csv_writer.writerow(row)
+
+  def End(self, table):
+    self._csv_file.close()
+    self._csv_writer = None
+
+  def Close(self):
+    self._csv_file.close()  # if a table was left half done
+
+
+class _JSONLinesWriter(_OutputWriter):
+  """One JSON object per row, like {"date": ..., "direction": ..., "row": [[column, value], ...]}.
+
+  The row is a list of pairs, not an object, as the same alias can head more than one column.
+  """
+
+  def __init__(self, output_file):
+    self.output_file, self._prefix = output_file, None
+
+  def Begin(self, table):
+    self._prefix = '{"date": %s, "direction": %s, "row": ' % (
+        json.dumps(table.date.strftime(_DATE_REPR)),
+        json.dumps(_DIRECTION(table.bool_direction_id)))
+
+  def Row(self, table, row):
+    self.output_file.write(self._prefix + json.dumps(list(zip(table.header, row))) + '}\n')
+
+
+class _HTMLWriter(_OutputWriter):
+  """A standalone HTML page with one <table> per table."""
+
+  def __init__(self, output_file):
+    self.output_file = output_file
+    self.output_file.write(
+        '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>Timetables</title></head>\n'
+        '<body>\n')
+
+  def Begin(self, table):
+    self.output_file.write('<h2>%s</h2>\n<table>\n<thead><tr>%s</tr></thead>\n<tbody>\n' % (
+        html.escape(table.Title()),
+        ''.join('<th>%s</th>' % html.escape(name) for name in table.header)))
+
+  def Row(self, table, row):
+    self.output_file.write(
+        '<tr>%s</tr>\n' % ''.join('<td>%s</td>' % html.escape(value) for value in row))
+
+  def End(self, table):
+    self.output_file.write('</tbody>\n</table>\n')
+
+  def Close(self):
+    self.output_file.write('</body>\n</html>\n')
+
+
+class _ParquetWriter(_OutputWriter):
+  """Parquet, with pyarrow, in long form (a record per table cell), as tables differ in columns.
+
+  Records are (date, direction, row, column, value) and are written in row groups of
+  _PARQUET_BATCH_ROWS, so memory stays bounded.
+  """
+
+  binary = True
+
+  def __init__(self, output_file):
+    # _OpenOutput() already checked for them, see _OUTPUT_PACKAGES
+    pyarrow, pyarrow_parquet = _OptionalImport('pyarrow'), _OptionalImport('pyarrow.parquet')
+    self.pyarrow = pyarrow
+    self.schema = pyarrow.schema([
+        ('date', pyarrow.string()), ('direction', pyarrow.string()), ('row', pyarrow.int32()),
+        ('column', pyarrow.string()), ('value', pyarrow.string())])
+    self.parquet_writer = pyarrow_parquet.ParquetWriter(output_file, self.schema)
+    self._batch, self._row_n = {name: [] for name in self.schema.names}, 0
+
+  def Begin(self, table):
+    self._row_n = 0
+
+  def Row(self, table, row):
+    date_repr, direction = table.date.strftime(_DATE_REPR), _DIRECTION(table.bool_direction_id)
+    for column, value in zip(table.header, row):
+      for name, field in zip(self.schema.names, (date_repr, direction, self._row_n, column, value)):
+        self._batch[name].append(field)
+    self._row_n += 1
+    if len(self._batch['row']) >= _PARQUET_BATCH_ROWS:
+      self._Flush()
+
+  def _Flush(self):
+    if self._batch['row']:
+      self.parquet_writer.write_table(self.pyarrow.table(self._batch, schema=self.schema))
+      self._batch = {name: [] for name in self.schema.names}
+
+  def Close(self):
+    self._Flush()
+    self.parquet_writer.close()
+
+
+_OUTPUT_WRITERS = {
+    'text': _TextWriter,
+    'csv': _CSVWriter,
+    'jsonl': _JSONLinesWriter,
+    'html': _HTMLWriter,
+    'parquet': _ParquetWriter,
+}
+# like {output_format: (package, module1, ...)}, the optional modules an output format needs
+_OUTPUT_PACKAGES = {
+    'parquet': ('pyarrow', 'pyarrow', 'pyarrow.parquet'),
+}
+
+
+def _OutputFormat(output_path, output_format):  # like 'csv', from --format or the file extension
+  if output_format:
+    return output_format
+  extension = os.path.splitext(output_path[:-3] if output_path.endswith('.gz') else output_path)[1]
+  return {'.csv': 'csv', '.jsonl': 'jsonl', '.html': 'html', '.htm': 'html',
+          '.parquet': 'parquet'}.get(extension.lower(), 'text')
+
+
+@contextlib.contextmanager
+def _OpenOutput(output_path, output_format, compress):
+  # yields a _OUTPUT_WRITERS[output_format]() over output_path ('-' is stdout), gzipped if compress
+  writer_class = _OUTPUT_WRITERS[output_format]
+  if compress and writer_class.binary:
+    raise Error('%s output is already compressed: no gzip for it' % output_format)
+  # before opening output_path, so a missing package does not leave it empty (or truncated)
+  package_name, *module_names = _OUTPUT_PACKAGES.get(output_format, (None,))
+  if any(_OptionalImport(module_name) is None for module_name in module_names):
+    raise Error('%s output needs the %s package; install it or use another --format' % (
+        output_format.capitalize(), package_name))
+  with contextlib.ExitStack() as stack:
+    if output_path == '-':
+      sys.stdout.flush()  # whatever was printed before goes first
+      output_file = sys.stdout.buffer
+    else:
+      output_file = stack.enter_context(open(output_path, 'wb'))
+    if compress:
+      output_file = stack.enter_context(gzip.GzipFile(fileobj=output_file, mode='wb'))
+    if not writer_class.binary:
+      output_file = io.TextIOWrapper(output_file, encoding='utf-8', newline='')
+      # closing the wrapper would close stdout, so it is flushed and detached instead
+      stack.callback(output_file.detach)
+      stack.callback(output_file.flush)
+    writer = writer_class(output_file)
+    yield writer
+    writer.Close()
+
+
+def _WriteTables(output_tables_iter, writers):
+  # streams every _OutputTable() of output_tables_iter to all writers at once, a row at a time;
+  # returns the number of rows written
+  rows_count = 0
+  for table in output_tables_iter:
+    for writer in writers:
+      writer.Begin(table)
+    for row in table.rows:
+      for writer in writers:
+        writer.Row(table, row)
+      rows_count += 1
+    for writer in writers:
+      writer.End(table)
+  return rows_count
+
+
+def _CSVPath(output_name, bool_direction_id, timetable_date):  # like 'DART_NORTH_20180915.csv'
+  return '%s_%s_%s.csv' % (
+      output_name, _DIRECTION(bool_direction_id), timetable_date.strftime(_DATE_REPR))
+
+
+def _WriteCSVs(output_name, timetable_date, output_tables):
+  # output_tables like _AssembleRows()
+  csv_writer = _CSVFilesWriter(output_name)
+  _WriteTables(_ListTables((), timetable_date, output_tables), [csv_writer])
+  csv_writer.Close()
+
 
-# rail data dir
-_DATA_DIR = 'data/irish_rail/'
+def _PrintTables(desired_rout_names, timetable_date, output_tables):
+  # output_tables like _AssembleRows()
+  text_writer = _TextWriter(sys.stdout)
+  _WriteTables(_ListTables(desired_rout_names, timetable_date, output_tables), [text_writer])
+  text_writer.Close()
 
-# some util consts and lambdas
-_DIRECTION = lambda bool_direction_id: 'SOUTH' if bool_direction_id else 'NORTH'
-_WEEK_TYPE = {
-    0: 'Mon-Fri',
-    1: 'Saturday',
-    2: 'Sunday',
-}
-_DATE_REPR = '%Y%m%d'
-_LOOK_AHEAD_IN_DAYS = 14
-_ONE_DAY = datetime.timedelta(days=1)
 
+def _PrintNames(header, names):
+  # like a one column prettytable of the sorted names, but made here, as importing prettytable
+  # (and its wcwidth) takes longer than all the rest of a "list" run
+  names = sorted(set(names))
+  width = max([len(header)] + [len(name) for name in names])
+  border = '+' + '-' * (width + 2) + '+'
+  click.echo()
+  click.echo('\n'.join(
+      [border, '| %s |' % header.center(width), border] +
+      ['| %s |' % name.center(width) for name in names] + [border]))
 
-class Error(Exception):
-  """Irish Rail base exception."""
 
+def _PrintRoutes(routes):
+  _PrintNames('Official Route Name', routes.values())
 
-def _LoadRoutes():  # like {route_id: route_long_name}
-  with open(_DATA_DIR + 'routes.txt', 'rt', newline='') as csv_file:
-    routes_reader = csv.reader(csv_file)
-    next(routes_reader)  # we must skip the first line as it has the header!
-    return {route_id: route_long_name for route_id, _, _, route_long_name, _ in routes_reader}
 
+def _PrintStops(stops_names):
+  _PrintNames('Official Station Name', stops_names.values())
 
-def _RouteIDByName(routes, desired_route):
-  route_ids = set()
-  for route_id, route_long_name in routes.items():
-    if route_long_name == desired_route:
-      route_ids.add(route_id)
-  if not route_ids:
-    raise Error('Route %r not found: use "list" command to see available routes' % desired_route)
-  return route_ids
 
+def _PrintSearch(kind, names_index, queries):
+  for query in queries:
+    click.echo()
+    click.echo('%s search for %r' % (kind, query))
+    results = names_index.Search(query, _MAX_SEARCH_RESULTS)
+    if not results:
+      click.echo('Nothing found')
+      continue
+    q_obj = prettytable.PrettyTable(['Match', 'Official %s Name' % kind, 'IDs'])
+    q_obj.align = 'l'
+    for match_kind, name, item_ids in results:
+      q_obj.add_row([match_kind, name, ', '.join(sorted(item_ids))])
+    click.echo(q_obj)
 
-def _LoadStops():  # like {stop_id: stop_name}
-  with open(_DATA_DIR + 'stops.txt', 'rt', newline='') as csv_file:
-    stops_reader = csv.reader(csv_file)
-    next(stops_reader)  # we must skip the first line as it has the header!
-    return {stop_id: stop_name for stop_id, stop_name, _, _ in stops_reader}
 
+# batch _Feed(), set before forking the batch pool so the workers share it copy-on-write
+_BATCH_FEED = None
+_BATCH_SPEC_KEYS = {
+    'name', 'routes', 'stops', 'aliases', 'fakes', 'date', 'end_date', 'irregular', 'idcol',
+    'max_trips'}
 
-def _StopIDsByName(stops, desired_stop_name):
-  stop_ids = set()
-  for stop_id, stop_name in stops.items():
-    if stop_name == desired_stop_name:
-      stop_ids.add(stop_id)
-  if not stop_ids:
-    raise Error('Stop %r not found: use "list" command to see available stops' % desired_stop_name)
-  return stop_ids
 
+def _LoadBatchConfig(config_path):  # like [{'routes': [...], 'stops': [...], ...}, ...]
+  if config_path.lower().endswith('.toml'):
+    tomllib = _OptionalImport('tomllib')
+    if tomllib is None:
+      raise Error('TOML batch configs need Python 3.11+ (tomllib); use JSON instead')
+    with open(config_path, 'rb') as config_file:
+      config = tomllib.load(config_file)
+  else:
+    with open(config_path, 'rt') as config_file:
+      config = json.load(config_file)
+  if not isinstance(config, dict) or not isinstance(config.get('timetables'), list):
+    raise Error('Batch config %r must have a "timetables" list' % config_path)
+  return config['timetables']
 
-def _LoadTripsForRoute(desired_route_ids, service_exclusions):
-  # like {trip_id: (service_id, bool_direction_id)}
-  with open(_DATA_DIR + 'trips.txt', 'rt', newline='') as csv_file:
-    trips_reader = csv.reader(csv_file)
-    next(trips_reader)  # we must skip the first line as it has the header!
-    return {trip_id: (service_id, bool(int(direction_id)))
-            for route_id, service_id, trip_id, _, _, direction_id in trips_reader
-            if route_id in desired_route_ids and service_id not in service_exclusions}
 
+def _SpecFromConfig(routes_index, spec_config):  # like _TimetableSpec()
+  if not isinstance(spec_config, dict):
+    raise Error('Batch timetable entries must be tables/objects, got %r' % spec_config)
+  unknown_keys = set(spec_config) - _BATCH_SPEC_KEYS
+  if unknown_keys:
+    raise Error('Unknown batch timetable keys: %s' % ', '.join(sorted(unknown_keys)))
+  try:
+    return _TimetableSpec(
+        routes_index, spec_config.get('routes', []), spec_config.get('stops', []),
+        spec_config.get('aliases', []), spec_config.get('fakes', []),
+        spec_config.get('date', ''), spec_config.get('end_date', ''),
+        spec_config.get('irregular', False), spec_config.get('idcol', False),
+        spec_config.get('max_trips', 0), output_name=spec_config.get('name'))
+  except (TypeError, ValueError) as err:
+    raise Error('Invalid batch timetable %r: %s' % (spec_config, err)) from err
 
-def _LoadTimetableForTrips(desired_trips):
-  # like {trip_id: [(int_stop_sequence, stop_id, arrival_time), (), ...]}
-  with open(_DATA_DIR + 'stop_times.txt', 'rt', newline='') as csv_file:
-    timetable_reader = csv.reader(csv_file)
-    next(timetable_reader)  # we must skip the first line as it has the header!
-    # read the timetable
-    timetable = {}
-    for trip_id, arrival_time, _, stop_id, stop_sequence, _, _, _, _ in timetable_reader:
-      if trip_id in desired_trips:
-        hour, minute, _ = arrival_time.split(':')
-        timetable.setdefault(trip_id, []).append(
-            (int(stop_sequence), stop_id, datetime.time(int(hour) % 24, int(minute))))
-    # make sure stops are sorted before returning
-    for stops in timetable.values():  # pylint: disable=not-an-iterable
-      stops.sort()
-    return timetable
-
-
-def _GetTripStarts(trips, timetable):  # like {start_time: {trip_id_1, trip_id_2, ...}}
-  trip_starts = {}
-  for trip_id in trips:
-    start_time = timetable[trip_id][0][2]
-    trip_starts.setdefault(start_time, set()).add(trip_id)
-  return trip_starts
 
+def _BatchWorker(spec):
+  # like (spec_name, error_message or None); saves the CSVs of spec, streaming them, so only the
+  # trips of one date are in memory (not the formatted tables), and nothing is sent to the parent
+  csv_writer = _CSVFilesWriter(spec['name'])
+  try:
+    trips = _TripsForRoute(_BATCH_FEED.trips, spec['route_ids'], set())
+    _WriteTables(_SpecOutputTables(spec, _BATCH_FEED.stops_index, trips, _BATCH_FEED.timetable,
+                                   _BATCH_FEED.calendar), [csv_writer])
+  except Error as err:
+    return (spec['name'], str(err))
+  finally:
+    csv_writer.Close()
+  return (spec['name'], None)
 
-def _AllDatesInPeriod(initial_date, final_date):
-  dt = initial_date
-  while dt <= final_date:
-    yield dt
-    dt += _ONE_DAY
 
+def _BatchSpecs(routes_index, spec_configs):
+  # like ([(spec_config, _TimetableSpec()), ...], {spec_name: None or error_message}); specs are
+  # parsed one by one, so errors in one of them don't stop the others
+  specs, results = [], {}
+  for spec_n, spec_config in enumerate(spec_configs):
+    try:
+      spec = _SpecFromConfig(routes_index, spec_config)
+      if spec['name'] in results:
+        raise Error('Duplicate output name %r: add a unique "name" to the entry' % spec['name'])
+    except Error as err:
+      logging.error('Batch timetable #%d failed: %s', spec_n + 1, err)
+      results['#%d' % (spec_n + 1)] = str(err)
+      continue
+    results[spec['name']] = None
+    specs.append((spec_config, spec))
+  return (specs, results)
 
-def _LoadServiceDates(timetable_datetime):
-  # like {service_id: (bool_working_days, bool_saturday, bool_sunday, bool_irregular)}
-  # service_exclusions like {service_id1, service_id2, ...}
-  # start by reading and storing all the exclusion dates for all services
-  date_inclusions, date_exclusions = {}, {}
-  with open(_DATA_DIR + 'calendar_dates.txt', 'rt', newline='') as csv_file:
-    exclusions_reader = csv.reader(csv_file)
-    next(exclusions_reader)  # we must skip the first line as it has the header!
-    for service_id, date, exception_type in exclusions_reader:
-      date, exception_type = datetime.datetime.strptime(date, _DATE_REPR), int(exception_type)
-      if exception_type == 1:
-        date_inclusions.setdefault(service_id, set()).add(date)
-      elif exception_type == 2:
-        date_exclusions.setdefault(service_id, set()).add(date)
-      else:
-        raise Error('Unexpected exception_type in calendar_dates.txt!')
-  # determine next _LOOK_AHEAD_IN_DAYS of schedule days to use in filtering services
-  look_ahead_days = set(_AllDatesInPeriod(
-      timetable_datetime, timetable_datetime + datetime.timedelta(days=_LOOK_AHEAD_IN_DAYS)))
-  # now read calendar to get all services and determine exclusions
-  with open(_DATA_DIR + 'calendar.txt', 'rt', newline='') as csv_file:
-    calendar_reader = csv.reader(csv_file)
-    next(calendar_reader)  # we must skip the first line as it has the header!
-    # read the weekday spread per service
-    service_dates, service_exclusions = {}, set()
-    for (service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday,
-         start_date, end_date) in calendar_reader:
-      # check if the schedule is current
-      start_date = datetime.datetime.strptime(start_date, _DATE_REPR)
-      end_date = datetime.datetime.strptime(end_date, _DATE_REPR)
-      if not start_date <= timetable_datetime <= end_date:
-        raise Error(
-            'Current date (%s) is outside dates in calendar.txt (%s to %s)! '
-            'You need to refresh Irish Rail data!' %
-            (timetable_datetime.strftime(_DATE_REPR),
-             start_date.strftime(_DATE_REPR), end_date.strftime(_DATE_REPR)))
-      # generate all dates in period
-      period_dates = set(_AllDatesInPeriod(start_date, end_date)).union(
-          date_inclusions.get(service_id, set())) - date_exclusions.get(service_id, set())
-      if any(d not in period_dates for d in look_ahead_days):
-        logging.warning(
-            'Removing service_id %r because not all days in next %d are in this period',
-            service_id, _LOOK_AHEAD_IN_DAYS)
-        service_exclusions.add(service_id)
-      # convert all to bool
-      monday, tuesday, wednesday, thursday, friday, saturday, sunday = (
-          bool(int(monday)), bool(int(tuesday)), bool(int(wednesday)), bool(int(thursday)),
-          bool(int(friday)), bool(int(saturday)), bool(int(sunday)))
-      # figure out working day (Mon-Fri) schedule and irregular schedules
-      bool_working_days = monday and tuesday and wednesday and thursday and friday
-      bool_irregular = (
-          (not bool_working_days and not saturday and not sunday) or  # no useful cathegories found
-          (not bool_working_days and                                  # not all weekdays
-           any((monday, tuesday, wednesday, thursday, friday))))
-      service_dates[service_id] = (bool_working_days, saturday, sunday, bool_irregular)
-    return (service_dates, service_exclusions)
-
-
-def _CmpStopsByFirstAvailableTime(a, b):
-  # first we compare by 'week' type
-  if a['week'] != b['week']:
-    return 1 if a['week'] > b['week'] else -1
-  # then we compare by stop times
-  for i, (_, time_a) in enumerate(a['stops']):
-    time_b = b['stops'][i][1]
-    # skip the None times and the ones that are equal
-    if time_a and time_b and time_a != time_b:
-      # this is the one to compare by
-      return 1 if time_a > time_b else -1
-  # they were all missing or equal (happens: a and b can be the same)
-  return 0
 
+def _RunBatchSpecs(specs, results, jobs):  # saves the CSVs of all specs, errors go in results
+  global _BATCH_FEED  # pylint: disable=global-statement
+  if not specs:
+    return
+  # load the feed once, for the union of all the routes
+  _BATCH_FEED = _LoadFeed({route_id for spec in specs for route_id in spec['route_ids']})
+  jobs = min(jobs, len(specs))
+  if jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    # workers are forked *after* loading the feed, so they all share the parent's copy of it
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+      _SaveBatchResults(pool.imap(_BatchWorker, specs), results)
+  else:
+    _SaveBatchResults(map(_BatchWorker, specs), results)
+  _BATCH_FEED = None
 
-def _WriteCSVs(desired_rout_names, timetable_date_to_use, output_tables):
-  route_path = ('_'.join(desired_rout_names)).replace(' ', '_').replace('/', '_')
-  for bool_direction_id in sorted(output_tables):
-    trips_table = output_tables[bool_direction_id]
-    output_path = '%s_%s_%s.csv' % (
-        route_path, _DIRECTION(bool_direction_id), timetable_date_to_use.strftime(_DATE_REPR))
-    logging.info('Saving %r', output_path)
-    with open(output_path, 'wt', newline='') as csv_file:
-      route_writer = csv.writer(csv_file, quoting=csv.QUOTE_MINIMAL)
-      for row in trips_table:
-        route_writer.writerow(row)
 
+def _RunBatch(routes_index, config_path, jobs):  # like {spec_name: error_message_or_None}
+  specs, results = _BatchSpecs(routes_index, _LoadBatchConfig(config_path))
+  _RunBatchSpecs([spec for _, spec in specs], results, jobs)
+  return results
 
-def _PrintTables(desired_rout_names, output_tables):
-  for bool_direction_id in sorted(output_tables):
-    trips_table = output_tables[bool_direction_id]
-    pt_obj = prettytable.PrettyTable(trips_table[0])
-    for row in trips_table[1:]:
-      pt_obj.add_row(row)
-    click.echo()
-    click.echo('%s %s table' % ('/'.join(desired_rout_names), _DIRECTION(bool_direction_id)))
-    click.echo()
-    click.echo(pt_obj)
-    click.echo()
 
+def _SaveBatchResults(worker_results, results):
+  for spec_name, error_message in worker_results:
+    if error_message is not None:
+      logging.error('Batch timetable %r failed: %s', spec_name, error_message)
+      results[spec_name] = error_message
 
-def _PrintRoutes(routes):
+
+def _PrintBatchResults(results):
   click.echo()
-  r_obj = prettytable.PrettyTable(['Official Route Name'])
-  for name in sorted({n for n in routes.values()}):
-    r_obj.add_row([name])
+  r_obj = prettytable.PrettyTable(['Timetable', 'Result'])
+  r_obj.align = 'l'
+  for spec_name, error_message in results.items():
+    r_obj.add_row([spec_name, 'OK' if error_message is None else 'ERROR: ' + error_message])
   click.echo(r_obj)
 
 
-def _PrintStops(stops_names):
+def _TripSignatures(snapshot):  # like {trip_id: hash of its trip data and stop times}
+  timetable, signatures = snapshot['stop_times'], {}
+  for trip_id, trip in snapshot['trips'].items():
+    trip_stops = ()
+    if trip_id in timetable:
+      stop_codes, sequences, arrivals, departures = timetable.Trip(trip_id)
+      trip_stops = tuple(zip(
+          (timetable.stop_ids[c] for c in stop_codes), sequences, arrivals, departures))
+    signatures[trip_id] = hash((trip, trip_stops))  # both feeds are hashed in this process
+  return signatures
+
+
+def _ServiceSignatures(calendar):  # like {service_id: hash of its calendar and running dates}
+  signatures, first_day = {}, calendar.first_date.toordinal()
+  for service_id, days in calendar.days.items():
+    # the running dates as (first day, bits from it), so windows can start on different dates
+    low_bit = (days & -days).bit_length() - 1 if days else 0
+    signatures[service_id] = hash((
+        calendar.periods[service_id], calendar.weekdays[service_id], first_day + low_bit,
+        days >> low_bit))
+  return signatures
+
+
+def _DictChanges(old, new):  # like ({added_key, ...}, {removed_key, ...}, {changed_key, ...})
+  return (new.keys() - old.keys(), old.keys() - new.keys(),
+          {k for k in old.keys() & new.keys() if old[k] != new[k]})
+
+
+def _TripStopIDs(snapshot, trip_ids):  # like {stop_id, ...} visited by any of trip_ids
+  timetable = snapshot['stop_times']
+  return {timetable.stop_ids[c] for trip_id in trip_ids if trip_id in timetable
+          for c in timetable.Trip(trip_id)[0]}
+
+
+def _FeedDiff(previous, current):
+  # like {'trips': ({added}, {removed}, {changed}), 'services': (...), 'stops': (...),
+  #       'routes': (...), 'route_ids': {affected_route_id, ...}, 'stop_ids': {affected_stop_id},
+  #       'window': bool} for two _LoadSnapshot(); affected routes and stops are the ones a
+  # timetable depends on; 'window' is True if _CalendarWindow() changed, and with it the dates
+  # every timetable (of any route) can be made for
+  diff = {
+      'trips': _DictChanges(_TripSignatures(previous), _TripSignatures(current)),
+      'services': _DictChanges(
+          _ServiceSignatures(previous['calendar']), _ServiceSignatures(current['calendar'])),
+      'stops': _DictChanges(previous['stops'], current['stops']),
+      'routes': _DictChanges(previous['routes'], current['routes']),
+  }
+  added_trips, removed_trips, changed_trips = diff['trips']
+  changed_services = set().union(*diff['services'])
+  route_ids = set().union(*diff['routes'])
+  for snapshot, trip_ids in ((previous, removed_trips | changed_trips),
+                             (current, added_trips | changed_trips)):
+    route_ids.update(snapshot['trips'][trip_id][0] for trip_id in trip_ids)
+    # a trip with a changed service changes the timetables of its route
+    route_ids.update(route_id for route_id, service_id, _ in snapshot['trips'].values()
+                     if service_id in changed_services)
+  diff['route_ids'] = route_ids
+  diff['stop_ids'] = (
+      set().union(*diff['stops']) |
+      _TripStopIDs(previous, removed_trips | changed_trips) |
+      _TripStopIDs(current, added_trips | changed_trips))
+  diff['window'] = _CalendarWindow(previous['calendar']) != _CalendarWindow(current['calendar'])
+  return diff
+
+
+def _DiffSummary(diff, current):  # like {'trips': {'added': int, ...}, ..., 'routes': [names]}
+  if diff is None:
+    return None
+  summary = {kind: dict(zip(('added', 'removed', 'changed'), (len(keys) for keys in diff[kind])))
+             for kind in ('trips', 'services', 'stops', 'routes')}
+  summary['changed_routes'] = sorted(
+      {current['routes'].get(route_id, route_id) for route_id in diff['route_ids']})
+  summary['changed_stops'] = sorted(
+      {current['stops'].get(stop_id, stop_id) for stop_id in diff['stop_ids']})
+  summary['calendar_window'] = diff['window']
+  return summary
+
+
+def _SpecKey(spec_config, spec):  # like '{"dates": [...], "spec": {...}}', to compare runs
+  return json.dumps({'spec': spec_config, 'dates': [d.strftime(_DATE_REPR) for d in spec['dates']]},
+                    sort_keys=True)
+
+
+def _SpecStopIDs(stops_index, spec):  # like {stop_id, ...} for all the stops spec depends on
+  stop_names = set(spec['stops']) | set(spec['aliases'])
+  stop_names.update(stop_name for stop_name, _ in spec['fakes'].values())
+  return {stop_id for stop_name in stop_names for stop_id in stops_index.Lookup(stop_name)}
+
+
+def _SpecChanged(diff, stops_index, spec):  # True if diff (a _FeedDiff()) can change spec's tables
+  return bool(diff['window'] or spec['route_ids'] & diff['route_ids'] or
+              _SpecStopIDs(stops_index, spec) & diff['stop_ids'])
+
+
+def _EntryCurrent(entry, spec_config, spec):
+  # True if the manifest entry (or None) is for spec as it is now configured, and its files are
+  # all still there
+  return (entry is not None and entry.get('key') == _SpecKey(spec_config, spec) and
+          all(os.path.exists(f) for f in entry.get('files', ())))
+
+
+def _SpecFiles(spec):  # like ['DART_NORTH_20180915.csv', ...], the CSVs a spec can produce
+  return [_CSVPath(spec['name'], bool_direction_id, timetable_date)
+          for timetable_date in _AllDatesInPeriod(*spec['dates'])
+          for bool_direction_id in (False, True)]
+
+
+def _LoadManifest(manifest_path):  # like {'timetables': {spec_name: {...}}, 'last_refresh': ...}
+  if not os.path.exists(manifest_path):
+    return {'timetables': {}, 'last_refresh': None}
+  with open(manifest_path, 'rt') as manifest_file:
+    manifest = json.load(manifest_file)
+  if not isinstance(manifest, dict) or not isinstance(manifest.get('timetables'), dict):
+    raise Error('Refresh manifest %r is invalid: delete it to regenerate everything' %
+                manifest_path)
+  return manifest
+
+
+def _SaveManifest(manifest_path, manifest):
+  temp_path = manifest_path + '.tmp'
+  with open(temp_path, 'wt') as manifest_file:
+    json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    manifest_file.write('\n')
+  os.replace(temp_path, manifest_path)
+
+
+def _RunRefresh(config_path, manifest_path, jobs):
+  # like (_DiffSummary(), {spec_name: 'regenerated', 'unchanged' or 'ERROR: ...'}); compiles the
+  # current feed into the snapshot and regenerates the timetables whose inputs changed since the
+  # feed the manifest timetables were produced from (all of them if that feed is not known); a
+  # copy of that feed's snapshot is kept next to the manifest, as "compile" can replace the other
+  manifest, base_path = _LoadManifest(manifest_path), manifest_path + '.feed'
+  previous = _LoadRefreshBase(base_path, manifest.get('feed'))
+  sources = _CompileSnapshot()
+  shutil.copyfile(_SNAPSHOT_PATH, base_path + '.tmp')  # the base for the next refresh
+  current = _LoadSnapshot()
+  diff = None if previous is None else _FeedDiff(previous, current)
+  previous = None  # not needed anymore, and it can be big
+  summary = _DiffSummary(diff, current)
+  stops_index = _NameIndex(current['stops'])
+  specs, results = _BatchSpecs(_NameIndex(current['routes']), _LoadBatchConfig(config_path))
+  regenerate, statuses = [], {}
+  for spec_config, spec in specs:
+    entry = manifest['timetables'].get(spec['name'])
+    if (diff is None or not _EntryCurrent(entry, spec_config, spec) or
+        _SpecChanged(diff, stops_index, spec)):
+      regenerate.append((spec_config, spec))
+    else:
+      statuses[spec['name']] = 'unchanged'
+  logging.info('Regenerating %d of %d timetables', len(regenerate), len(specs))
+  _RunBatchSpecs([spec for _, spec in regenerate], results, jobs)
+  for spec_config, spec in regenerate:
+    if results[spec['name']] is None:
+      statuses[spec['name']] = 'regenerated'
+      manifest['timetables'][spec['name']] = {
+          'key': _SpecKey(spec_config, spec),
+          'files': [f for f in _SpecFiles(spec) if os.path.exists(f)]}  # some have no trips
+    else:
+      manifest['timetables'].pop(spec['name'], None)  # so it is retried next time
+  for spec_name, error_message in results.items():
+    if error_message is not None:
+      statuses[spec_name] = 'ERROR: ' + error_message
+  manifest['last_refresh'] = {
+      'date': datetime.datetime.now().isoformat(timespec='seconds'), 'diff': summary,
+      'regenerated': sorted(n for n, status in statuses.items() if status == 'regenerated')}
+  # the base first: if we stop in between, the manifest's feed won't match it, and all regenerate
+  os.replace(base_path + '.tmp', base_path)
+  manifest['feed'] = _SourceHashes(sources)
+  _SaveManifest(manifest_path, manifest)
+  return (summary, statuses)
+
+
+def _PrintRefresh(summary, statuses):
+  click.echo()
+  if summary is None:
+    click.echo('No base feed for the manifest timetables: all timetables regenerated')
+  else:
+    d_obj = prettytable.PrettyTable(['Feed Changes', 'Added', 'Removed', 'Changed'])
+    for kind in ('trips', 'services', 'stops', 'routes'):
+      d_obj.add_row(
+          [kind.capitalize()] + [summary[kind][c] for c in ('added', 'removed', 'changed')])
+    click.echo(d_obj)
+    click.echo()
+    click.echo('Changed routes: %s' % (', '.join(summary['changed_routes']) or '-'))
+    click.echo('Changed stops: %s' % (', '.join(summary['changed_stops']) or '-'))
+    if summary['calendar_window']:
+      click.echo('Dates in all calendar.txt periods changed: all timetables regenerated')
+  click.echo()
+  r_obj = prettytable.PrettyTable(['Timetable', 'Result'])
+  r_obj.align = 'l'
+  for spec_name, status in statuses.items():
+    r_obj.add_row([spec_name, status])
+  click.echo(r_obj)
+
+
+class _TimetableServer:
+  """HTTP server for the "print" query over an in-memory _Feed(), with an LRU result cache.
+
+  The feed is swapped atomically by the reload thread: each request takes a reference to the
+  feed it started with, so in-flight requests finish on the old feed and new ones see the new
+  one; cache keys include the feed generation, so old results are never served for a new feed.
+
+  A mixin over http.server.ThreadingHTTPServer, see _NewTimetableServer().
+  """
+
+  daemon_threads = True
+  handler_class = None  # set by _NewTimetableServer()
+
+  def __init__(self, server_address, cache_size, reload_interval, realtime_interval):
+    super().__init__(server_address, self.handler_class)
+    # like (feed_generation, _Feed()), always replaced as a whole, so a reader gets a feed and
+    # its generation in one read
+    self.generation_feed, self.realtime_generation = (0, _LoadFeed()), 0
+    self.cache, self.cache_size = collections.OrderedDict(), cache_size
+    self.cache_lock, self.cache_hits, self.cache_misses = threading.Lock(), 0, 0
+    self.reload_interval, self.realtime_interval = reload_interval, realtime_interval
+    self._reload_stop = threading.Event()
+
+  def Feed(self):  # like (feed_generation, _Feed())
+    """The feed in use, with its generation."""
+    return self.generation_feed
+
+  def CachedResponse(self, cache_key, build_response):
+    """The response for cache_key, from the cache or built (and cached) now."""
+    # like (content_type, bytes_body), from cache or calling build_response() and caching it
+    with self.cache_lock:
+      response = self.cache.get(cache_key)
+      if response is not None:
+        self.cache.move_to_end(cache_key)
+        self.cache_hits += 1
+        return response
+      self.cache_misses += 1
+    response = build_response()  # outside the lock: concurrent misses build in parallel
+    with self.cache_lock:
+      self.cache[cache_key] = response
+      while len(self.cache) > self.cache_size:
+        self.cache.popitem(last=False)
+    return response
+
+  def WatchFeed(self):
+    """Reloads the feed when its files change, until the server stops."""
+    # polls _FEED_PATH and reloads once the files changed *and* stopped changing for one interval
+    if _FEED_DB is not None:
+      logging.info('Serving from the feed database: no reloads')
+      return
+    last_seen_keys = self.Feed()[1].source_keys
+    while not self._reload_stop.wait(self.reload_interval):
+      try:
+        source_keys = _SourceKeys(False)
+      except (FileNotFoundError, zipfile.BadZipFile):
+        continue  # files are being replaced
+      feed_generation, feed = self.Feed()
+      if source_keys == feed.source_keys or source_keys != last_seen_keys:
+        last_seen_keys = source_keys
+        continue
+      logging.info('Feed files changed: reloading')
+      _LoadSnapshot.cache_clear()
+      try:
+        new_feed = _LoadFeed()
+      except (Error, OSError, ValueError) as err:
+        logging.error('Feed reload failed, still serving the previous feed: %s', err)
+        continue
+      self.generation_feed = (feed_generation + 1, new_feed)
+      with self.cache_lock:
+        self.cache.clear()
+      logging.info('Feed reloaded (generation %d)', feed_generation + 1)
+
+  def WatchRealtime(self):
+    """Applies the realtime updates to the feed, until the server stops."""
+    # polls _REALTIME_SOURCE and applies it to the feed in use; only changed trips are touched
+    while not self._reload_stop.wait(self.realtime_interval):
+      try:
+        message = _ReadRealtime(_REALTIME_SOURCE)
+        _, feed = self.Feed()
+        changed_count = _ApplyTripUpdates(feed.timetable, message)
+      except (Error, OSError, ValueError) as err:
+        logging.error('Realtime update failed, keeping the previous delays: %s', err)
+        continue
+      if changed_count:
+        # new generation first, so results built with the old delays are cached under the old one
+        self.realtime_generation += 1
+        with self.cache_lock:
+          self.cache.clear()
+        logging.info('Realtime updates changed %d trips', changed_count)
+
+  def serve_forever(self, poll_interval=0.5):
+    """Serves requests, with the feed (and realtime) watchers running, until shutdown()."""
+    watcher = threading.Thread(target=self.WatchFeed, name='feed-watcher', daemon=True)
+    watcher.start()
+    if _REALTIME_SOURCE is not None:
+      threading.Thread(target=self.WatchRealtime, name='realtime-watcher', daemon=True).start()
+    try:
+      # pylint can't see the http.server class this is mixed into, see _NewTimetableServer()
+      super().serve_forever(poll_interval=poll_interval)  # pylint: disable=no-member
+    finally:
+      self._reload_stop.set()
+
+
+class _TimetableRequestHandler:
+  """GET /timetable?route=...&stop=...&stop=...[&alias=STOP|ALIAS][&fake=ALIAS|STOP|MIN]
+  [&date=YYYYMMDD][&irregular=1][&idcol=1][&max_trips=N][&format=json|csv];
+  GET /departures?stop=...[&to=STOP][&route=...][&date=YYYYMMDD][&time=HH:MM][&count=N];
+  GET /status. A mixin over http.server.BaseHTTPRequestHandler, see _NewTimetableServer()."""
+
+  # pylint can't see the BaseHTTPRequestHandler members we use (path, server, wfile,
+  # send_response(), ...), as that class is only mixed in later: pylint: disable=no-member
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    """Answers a GET request."""
+    url = urllib.parse.urlsplit(self.path)
+    if url.path == '/status':
+      self._Reply(200, *self._StatusResponse())
+      return
+    if url.path == '/departures':  # not cached: the queries are cheaper than the cache lookups
+      try:
+        _, feed = self.server.Feed()
+        response = _DeparturesResponse(
+            feed, urllib.parse.parse_qs(url.query, keep_blank_values=True))
+      except Error as err:
+        self._Reply(400, *_JSONResponse({'error': str(err)}))
+        return
+      self._Reply(200, *response)
+      return
+    if url.path != '/timetable':
+      self._Reply(404, *_JSONResponse({'error': 'Unknown path %r' % url.path}))
+      return
+    feed_generation, feed = self.server.Feed()
+    try:
+      params = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+      spec, output_format = _SpecFromQuery(feed.routes_index, params)
+      # normalized key, so the order of the parameters does not matter
+      cache_key = (
+          feed_generation, self.server.realtime_generation, output_format,
+          tuple(sorted(spec['route_ids'])), tuple(sorted(spec['stops'])),
+          tuple(sorted(spec['aliases'].items())), tuple(sorted(spec['fakes'].items())),
+          spec['dates'], spec['irregular'], spec['idcol'], spec['max_trips'])
+      response = self.server.CachedResponse(
+          cache_key, lambda: _TimetableResponse(feed, spec, output_format))
+    except Error as err:
+      self._Reply(400, *_JSONResponse({'error': str(err)}))
+      return
+    self._Reply(200, *response)
+
+  def _StatusResponse(self):
+    feed_generation, feed = self.server.Feed()
+    return _JSONResponse({
+        'feed_generation': feed_generation,
+        'realtime_generation': self.server.realtime_generation,
+        'realtime_trips': 0 if feed.timetable.delays is None else (
+            len(feed.timetable.delays.trips) + len(feed.timetable.delays.cancelled)),
+        'feed_files': {name: list(key[:2]) for name, key in feed.source_keys.items()},
+        'cache_entries': len(self.server.cache),
+        'cache_hits': self.server.cache_hits,
+        'cache_misses': self.server.cache_misses,
+    })
+
+  def _Reply(self, status, content_type, body):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    """Logs the request through logging, instead of stderr."""
+    logging.info('%s: ' + format, self.address_string(), *args)
+
+
+def _NewTimetableServer(server_address, cache_size, reload_interval, realtime_interval):
+  # like _TimetableServer(), mixed into the http.server classes only now, as importing those
+  # (and the email and http.client packages they need) is most of the startup time of other runs
+  handler_class = type('TimetableRequestHandler', (
+      _TimetableRequestHandler, http.server.BaseHTTPRequestHandler), {})
+  server_class = type('TimetableServer', (
+      _TimetableServer, http.server.ThreadingHTTPServer), {'handler_class': handler_class})
+  return server_class(server_address, cache_size, reload_interval, realtime_interval)
+
+
+def _SpecFromQuery(routes_index, params):  # like (_TimetableSpec(), 'json' or 'csv')
+  get_one = lambda name, default: (params.get(name) or [default])[-1].strip()
+  output_format = get_one('format', 'json').lower()
+  if output_format not in ('json', 'csv'):
+    raise Error('Unknown format %r: use "json" or "csv"' % output_format)
+  split_param = lambda name, size: [
+      tuple(v.split('|', size - 1)) for v in params.get(name, []) if v.count('|') >= size - 1]
+  try:
+    return (_TimetableSpec(
+        routes_index, params.get('route', []), params.get('stop', []), split_param('alias', 2),
+        split_param('fake', 3), get_one('date', ''), '', get_one('irregular', '') == '1',
+        get_one('idcol', '') == '1', int(get_one('max_trips', '0'))), output_format)
+  except ValueError as err:
+    raise Error('Invalid query: %s' % err) from err
+
+
+def _JSONResponse(data):  # like (content_type, bytes_body)
+  return ('application/json; charset=utf-8', json.dumps(data).encode('utf-8'))
+
+
+def _DeparturesResponse(feed, params):  # like (content_type, bytes_body)
+  get_one = lambda name, default: (params.get(name) or [default])[-1].strip()
+  stop_name, destination_name = get_one('stop', ''), get_one('to', '') or None
+  if not stop_name:
+    raise Error('Give a stop to list its departures')
+  try:
+    date_repr, time_repr = get_one('date', ''), get_one('time', '')
+    date = _ParseDate(date_repr) if date_repr else datetime.date.today()
+    start_time = _TimeToSeconds((time_repr + ':00') if time_repr else
+                                datetime.datetime.now().strftime('%H:%M:%S'))
+    count = min(max(int(get_one('count', '10')), 1), _MAX_DEPARTURES)
+  except ValueError as err:
+    raise Error('Invalid query: %s' % err) from err
+  route_names = [r.strip() for r in params.get('route', []) if r.strip()]
+  route_ids = set().union(*(_RouteIDByName(feed.routes_index, r) for r in route_names)) if (
+      route_names) else None
+  return _JSONResponse({
+      'stop': stop_name, 'to': destination_name, 'date': date.strftime(_DATE_REPR),
+      'departures': _Departures(
+          feed.Board(), stop_name, date, start_time, count, route_ids, destination_name),
+  })
+
+
+def _TimetableResponse(feed, spec, output_format):  # like (content_type, bytes_body)
+  ((timetable_date, output_tables),) = _FeedSpecTables(feed, spec)  # one date only
+  if output_format == 'json':
+    return _JSONResponse({
+        'routes': sorted(spec['routes']),
+        'date': timetable_date.strftime(_DATE_REPR),
+        'tables': {_DIRECTION(bool_direction_id): [list(row) for row in trips_table]
+                   for bool_direction_id, trips_table in sorted(output_tables.items())},
+    })
+  # CSV has both directions, one after the other, with an added 'Direction' column
+  csv_buffer = io.StringIO(newline='')
+  csv_writer = csv.writer(csv_buffer, quoting=csv.QUOTE_MINIMAL)
+  for bool_direction_id, trips_table in sorted(output_tables.items()):
+    csv_writer.writerow(('Direction',) + trips_table[0])
+    for row in trips_table[1:]:
+      csv_writer.writerow((_DIRECTION(bool_direction_id),) + row)
+  return ('text/csv; charset=utf-8', csv_buffer.getvalue().encode('utf-8'))
+
+
+def _BuildConnections(timetable):
+  # like (int_departures, int_arrivals, dep_stop_codes, arr_stop_codes, trip_codes), each an
+  # array with one entry per pair of consecutive stops of every trip, sorted by departure
+  connections = []  # like [(int_departure, int_arrival, dep_stop_code, arr_stop_code, trip_code)]
+  for trip_code in range(len(timetable)):
+    stop_codes = timetable.Stops(trip_code)
+    arrivals, departures = timetable.Arrivals(trip_code), timetable.Departures(trip_code)
+    for i in range(len(stop_codes) - 1):
+      connections.append((departures[i], arrivals[i + 1], stop_codes[i], stop_codes[i + 1],
+                          trip_code))
+  connections.sort()
+  return tuple(array.array('i', column) for column in (
+      zip(*connections) if connections else [()] * 5))
+
+
+def _LoadConnections(timetable):  # like _BuildConnections(), for the full timetable
+  snapshot = _LoadSnapshot()
+  if snapshot is not None and snapshot['stop_times'] is timetable:
+    return snapshot['connections']
+  return _BuildConnections(timetable)
+
+
+class _JourneyPlanner:
+  """Connection Scan Algorithm (CSA) journey planner over all the trips of a _Feed().
+
+  Each pair of consecutive stops of a trip is a "connection"; connections are kept in columns
+  sorted by departure time, so an earliest arrival query is a single forward scan from the first
+  connection at or after the departure time, stopping as soon as departures are later than the
+  best arrival found. Trips that run past midnight are also scanned, shifted by a day, on the
+  next service day. Profile queries ("all best journeys departing between T1 and T2") do one
+  scan per distinct departure from the origin, latest first, and keep only the journeys that
+  arrive earlier than every journey departing later.
+  """
+
+  __slots__ = ('feed', 'dep_times', 'arr_times', 'dep_stops', 'arr_stops', 'trips',
+               'trip_services', 'footpaths', 'change_times', '_active_trips')
+
+  def __init__(self, feed, connections):  # connections like _LoadConnections(feed.timetable)
+    self.feed, timetable = feed, feed.timetable
+    self.dep_times, self.arr_times, self.dep_stops, self.arr_stops, self.trips = connections
+    self.trip_services = [
+        feed.trips[trip_id][1] if trip_id in feed.trips else None for trip_id in timetable.trip_ids]
+    # footpaths like {from_stop_code: [(to_stop_code, int_seconds), ...]}; from == to is a
+    # minimum change time at that stop, kept in change_times like {stop_code: int_seconds}
+    self.footpaths, self.change_times = {}, {}
+    for (from_stop_id, to_stop_id), seconds in feed.transfers.items():
+      from_code = timetable.stop_codes.get(from_stop_id)
+      to_code = timetable.stop_codes.get(to_stop_id)
+      if from_code is None or to_code is None:
+        continue
+      if from_code == to_code:
+        self.change_times[from_code] = seconds
+      else:
+        self.footpaths.setdefault(from_code, []).append((to_code, seconds))
+    self._active_trips = {}  # like {date: bytearray_of_bool_by_trip_code}
+
+  def ActiveTrips(self, date):  # like bytearray(), 1 for each trip_code that runs on date
+    """Which trips run on date, by trip_code."""
+    active = self._active_trips.get(date)
+    if active is None:
+      running = self.feed.calendar.Running(date)
+      active = self._active_trips[date] = bytearray(
+          service_id in running for service_id in self.trip_services)
+    return active
+
+  def _Scan(self, date, start_time):
+    # yields connection (int_departure, index, day_shift) from start_time on, in departure order;
+    # day_shift 1 is a connection of the day before that runs after midnight
+    today, yesterday = self.ActiveTrips(date), self.ActiveTrips(date - _ONE_DAY)
+    first_today = bisect.bisect_left(self.dep_times, start_time)
+    first_yesterday = bisect.bisect_left(self.dep_times, start_time + _DAY_SECONDS)
+    return heapq.merge(
+        ((self.dep_times[i], i, 0) for i in range(first_today, len(self.dep_times))
+         if today[self.trips[i]]),
+        ((self.dep_times[i] - _DAY_SECONDS, i, 1)
+         for i in range(first_yesterday, len(self.dep_times)) if yesterday[self.trips[i]]))
+
+  def EarliestArrival(self, origin_codes, target_codes, date, depart_time):
+    """The journey that gets earliest to target_codes, leaving origin_codes at depart_time."""
+    # like [leg1, leg2, ...] or None; legs like ('trip', trip_id, from_stop_code, int_departure,
+    # to_stop_code, int_arrival) or ('walk', None, from_stop_code, int_start, to_stop_code, int_end)
+    arrival, ready, journey, boarded = {}, {}, {}, {}
+    for stop_code in origin_codes:
+      arrival[stop_code] = ready[stop_code] = depart_time
+      for to_code, seconds in self.footpaths.get(stop_code, ()):
+        if depart_time + seconds < ready.get(to_code, _NEVER):
+          arrival[to_code] = ready[to_code] = depart_time + seconds
+          journey[to_code] = ('walk', stop_code, depart_time)
+    best_arrival = min((arrival[c] for c in target_codes if c in arrival), default=_NEVER)
+    for dep_time, i, day_shift in self._Scan(date, depart_time):
+      if dep_time >= best_arrival:
+        break
+      trip_key = (self.trips[i], day_shift)
+      if trip_key not in boarded:
+        if ready.get(self.dep_stops[i], _NEVER) > dep_time:
+          continue  # can't get on this trip
+        boarded[trip_key] = i
+      arr_time, arr_stop = self.arr_times[i] - day_shift * _DAY_SECONDS, self.arr_stops[i]
+      if arr_time >= arrival.get(arr_stop, _NEVER):
+        continue
+      arrival[arr_stop] = arr_time
+      journey[arr_stop] = ('trip', boarded[trip_key], i, day_shift)
+      ready[arr_stop] = min(ready.get(arr_stop, _NEVER),
+                            arr_time + self.change_times.get(arr_stop, 0))
+      for to_code, seconds in self.footpaths.get(arr_stop, ()):
+        if arr_time + seconds < arrival.get(to_code, _NEVER):
+          arrival[to_code] = ready[to_code] = arr_time + seconds
+          journey[to_code] = ('walk', arr_stop, arr_time)
+          if to_code in target_codes:
+            best_arrival = min(best_arrival, arrival[to_code])
+      if arr_stop in target_codes:
+        best_arrival = min(best_arrival, arr_time)
+    if best_arrival == _NEVER:
+      return None
+    # walk the journey pointers back from the best target
+    stop_code = min((c for c in target_codes if c in arrival), key=lambda c: arrival[c])
+    legs = []
+    while stop_code not in origin_codes:
+      pointer = journey[stop_code]
+      if pointer[0] == 'walk':
+        _, from_code, start_time = pointer
+        legs.append(('walk', None, from_code, start_time, stop_code, arrival[stop_code]))
+        stop_code = from_code
+      else:
+        _, enter_i, exit_i, day_shift = pointer
+        shift = day_shift * _DAY_SECONDS
+        legs.append((
+            'trip', self.feed.timetable.trip_ids[self.trips[enter_i]],
+            self.dep_stops[enter_i], self.dep_times[enter_i] - shift,
+            self.arr_stops[exit_i], self.arr_times[exit_i] - shift))
+        stop_code = self.dep_stops[enter_i]
+    if not legs:
+      return None  # origin and target are the same
+    legs.reverse()
+    return legs
+
+  def Profile(self, origin_codes, target_codes, date, first_time, last_time):
+    """The journeys departing in [first_time, last_time] that no later departure beats.
+
+    This is not the one-pass profile CSA: it runs a full EarliestArrival() for every distinct
+    departure time from the origin (and the stops a walk from it) in the window, latest first, so
+    it costs about that many earliest arrival queries; fine for the windows of a few hours of a
+    "plan", but wider windows or busier origins take proportionally longer.
+    """
+    # like [journey1, journey2, ...], see EarliestArrival(); all Pareto-optimal journeys departing
+    # in [first_time, last_time], in departure order
+    walk_offsets = {c: 0 for c in origin_codes}
+    for stop_code in origin_codes:
+      for to_code, seconds in self.footpaths.get(stop_code, ()):
+        walk_offsets[to_code] = min(walk_offsets.get(to_code, _NEVER), seconds)
+    depart_times = set()
+    for dep_time, i, _ in self._Scan(date, first_time):
+      if dep_time > last_time + max(walk_offsets.values()):
+        break
+      walk_seconds = walk_offsets.get(self.dep_stops[i])
+      if walk_seconds is not None and first_time <= dep_time - walk_seconds <= last_time:
+        depart_times.add(dep_time - walk_seconds)
+    journeys, best_arrival = [], _NEVER
+    for depart_time in sorted(depart_times, reverse=True):
+      journey = self.EarliestArrival(origin_codes, target_codes, date, depart_time)
+      if journey is None:
+        continue
+      if journey[-1][5] < best_arrival:
+        journeys.append(journey)
+        best_arrival = journey[-1][5]
+    journeys.reverse()
+    return journeys
+
+
+def _PrintJourneys(planner, origin_name, target_name, date, journeys):
+  click.echo()
+  click.echo('Journeys from %r to %r on %s' % (origin_name, target_name, date.strftime(_DATE_REPR)))
+  click.echo()
+  if not journeys:
+    click.echo('No journey found')
+    return
+  stop_name = lambda stop_code: planner.feed.stops[planner.feed.timetable.stop_ids[stop_code]]
+  j_obj = prettytable.PrettyTable(['Depart', 'Arrive', 'Duration', 'Changes', 'Journey'])
+  j_obj.align['Journey'] = 'l'
+  for legs in journeys:
+    legs_repr = []
+    for leg_kind, trip_id, from_code, start_time, to_code, end_time in legs:
+      if leg_kind == 'walk':
+        legs_repr.append('walk %dmin %s -> %s' % (
+            (end_time - start_time) // 60, stop_name(from_code), stop_name(to_code)))
+      else:
+        legs_repr.append('%s %s %s -> %s %s' % (
+            planner.feed.routes[planner.feed.trips[trip_id][0]], _SecondsRepr(start_time),
+            stop_name(from_code), _SecondsRepr(end_time), stop_name(to_code)))
+    j_obj.add_row([
+        _SecondsRepr(legs[0][3]), _SecondsRepr(legs[-1][5]),
+        '%dmin' % ((legs[-1][5] - legs[0][3]) // 60),
+        sum(1 for leg in legs if leg[0] == 'trip') - 1, '\n'.join(legs_repr)])
+  click.echo(j_obj)
+
+
+class _DepartureBoard:
+  """Per-stop, per-service-day departures of a _Feed(), for "next trains from S" queries.
+
+  The first query for a service day indexes it: for every stop code, the departures of all the
+  trips that run that day (but not from their last stop), sorted, in 3 columns (int_departures,
+  trip_codes, positions in the trip). A query is then a binary search per stop, reading forward
+  only until enough departures pass the filters. Trips of the day before that depart after
+  midnight are merged in, shifted by a day, like _JourneyPlanner() does.
+
+  The index has the scheduled times, and realtime delays (see _Delays()) are applied while
+  reading it: the search starts earlier by the biggest delay, and stops once no later departure
+  (less the biggest advance) can beat the ones found.
+  """
+
+  __slots__ = ('feed', '_days', '_days_lock')
+
+  def __init__(self, feed):
+    self.feed = feed
+    self._days = collections.OrderedDict()  # like {date: _Day()}, LRU
+    self._days_lock = threading.Lock()  # the server queries from many threads
+
+  def _Day(self, date):  # like [(int_departures, trip_codes, positions) for each stop_code]
+    with self._days_lock:
+      day = self._days.get(date)
+      if day is not None:
+        self._days.move_to_end(date)
+        return day
+    timetable, running = self.feed.timetable, self.feed.calendar.Running(date)
+    stop_departures = [[] for _ in timetable.stop_ids]
+    for trip_code, trip_id in enumerate(timetable.trip_ids):
+      trip = self.feed.trips.get(trip_id)
+      if trip is None or trip[1] not in running:
+        continue
+      stop_codes, departures = timetable.Stops(trip_code), timetable.Departures(trip_code)
+      for position in range(len(stop_codes) - 1):  # no departures from the last stop
+        stop_departures[stop_codes[position]].append((departures[position], trip_code, position))
+    day = []
+    for departures in stop_departures:
+      departures.sort()
+      day.append(tuple(array.array('i', column) for column in (
+          zip(*departures) if departures else [()] * 3)))
+    logging.debug('Indexed departures of %s', date.strftime(_DATE_REPR))
+    with self._days_lock:
+      self._days[date] = day
+      while len(self._days) > _BOARD_DAYS_CACHED:
+        self._days.popitem(last=False)
+    return day
+
+  def _Scan(self, stop_code, date, start_time):
+    # yields departure (int_departure, trip_code, position, day_shift) from start_time on, in
+    # departure order; day_shift 1 is a departure of the day before that is after midnight
+    return heapq.merge(*(self._ScanDay(stop_code, date - day_shift * _ONE_DAY, start_time,
+                                       day_shift) for day_shift in (0, 1)))
+
+  def _ScanDay(self, stop_code, service_date, start_time, day_shift):  # see _Scan()
+    departures, trip_codes, positions = self._Day(service_date)[stop_code]
+    shift_seconds = day_shift * _DAY_SECONDS
+    for i in range(bisect.bisect_left(departures, start_time + shift_seconds), len(departures)):
+      yield (departures[i] - shift_seconds, trip_codes[i], positions[i], day_shift)
+
+  def Next(self, stop_codes, date, start_time, count, route_ids=None, destination_codes=None):
+    """The next departures from stop_codes."""
+    # like [(int_departure, trip_code, position, day_shift, int_arrival_or_None, int_delay), ...],
+    # the next count departures from any of stop_codes at or after start_time on date, predicted
+    # if there are realtime delays; only of route_ids and only for trips that go on to any of
+    # destination_codes (with the arrival there), if given
+    calendar, timetable = self.feed.calendar, self.feed.timetable
+    if not calendar.first_date <= date <= calendar.last_date:
+      raise Error('Date %s is outside dates in the feed calendar (%s to %s)!' % (
+          date.strftime(_DATE_REPR), calendar.first_date.strftime(_DATE_REPR),
+          calendar.last_date.strftime(_DATE_REPR)))
+    min_delay, max_delay = (0, 0) if timetable.delays is None else (
+        timetable.delays.min_delay, timetable.delays.max_delay)
+    found = []  # sorted, as delays can change the order
+    for scheduled, trip_code, position, day_shift in heapq.merge(
+        *(self._Scan(stop_code, date, start_time - max_delay) for stop_code in sorted(stop_codes))):
+      if len(found) >= count and scheduled + min_delay >= found[count - 1][0]:
+        break
+      service_date = date - day_shift * _ONE_DAY
+      if timetable.Cancelled(trip_code, service_date):
+        continue
+      trip_delays = timetable.Delays(trip_code, service_date)
+      delay = 0 if trip_delays is None else trip_delays[1][position]
+      if scheduled + delay < start_time:
+        continue
+      if route_ids is not None and (
+          self.feed.trips[timetable.trip_ids[trip_code]][0] not in route_ids):
+        continue
+      arrival = None
+      if destination_codes is not None:
+        trip_stops = timetable.Stops(trip_code)
+        arrival_position = next((n for n in range(position + 1, len(trip_stops))
+                                 if trip_stops[n] in destination_codes), None)
+        if arrival_position is None:
+          continue
+        arrival = (timetable.Arrivals(trip_code, service_date)[arrival_position] -
+                   day_shift * _DAY_SECONDS)
+      bisect.insort(found, (scheduled + delay, trip_code, position, day_shift, arrival, delay))
+    return found[:count]
+
+
+def _Departures(board, stop_name, date, start_time, count, route_ids=None, destination_name=None):
+  # like [{'departure': 'HH:MM', 'route': route_name, 'destination': last_stop_name,
+  #        'trip_id': trip_id, 'stop_id': stop_id, 'arrival': 'HH:MM' or None,
+  #        'delay': int_delay_seconds}, ...]
+  feed = board.feed
+  timetable = feed.timetable
+  destination_codes = None if destination_name is None else feed.StopCodes(destination_name)
+  departures = []
+  for departure, trip_code, position, _, arrival, delay in board.Next(
+      feed.StopCodes(stop_name), date, start_time, count, route_ids, destination_codes):
+    trip_id, trip_stops = timetable.trip_ids[trip_code], timetable.Stops(trip_code)
+    departures.append({
+        'departure': _SecondsRepr(departure),
+        'route': feed.routes[feed.trips[trip_id][0]],
+        'destination': feed.stops[timetable.stop_ids[trip_stops[-1]]],
+        'trip_id': trip_id,
+        'stop_id': timetable.stop_ids[trip_stops[position]],
+        'arrival': None if arrival is None else _SecondsRepr(arrival),
+        'delay': delay,
+    })
+  return departures
+
+
+def _PrintDepartures(stop_name, destination_name, date, departures, idcol_out):
   click.echo()
-  s_obj = prettytable.PrettyTable(['Official Station Name'])
-  for name in sorted({n for n in stops_names.values()}):
-    s_obj.add_row([name])
-  click.echo(s_obj)
+  click.echo('Departures from %r%s on %s' % (
+      stop_name, '' if destination_name is None else ' to %r' % destination_name,
+      date.strftime(_DATE_REPR)))
+  click.echo()
+  if not departures:
+    click.echo('No departure found')
+    return
+  with_delays = any(departure['delay'] for departure in departures)
+  columns = ['Depart', 'Route', 'Destination']
+  if with_delays:
+    columns.append('Delay')
+  if destination_name is not None:
+    columns.append('Arrive')
+  if idcol_out:
+    columns.append('Trip ID')
+  d_obj = prettytable.PrettyTable(columns)
+  d_obj.align['Destination'] = 'l'
+  for departure in departures:
+    row = [departure['departure'], departure['route'], departure['destination']]
+    if with_delays:
+      row.append('%+dmin' % round(departure['delay'] / 60) if departure['delay'] else '')
+    if destination_name is not None:
+      row.append(departure['arrival'])
+    if idcol_out:
+      row.append(departure['trip_id'])
+    d_obj.add_row(row)
+  click.echo(d_obj)
+
+
+class _Delays:
+  """Sparse realtime overlay on a _StopTimes(): the predicted delays of the trips that have them.
+
+  Keys are (service_date, trip_code), so a trip of the day before that still runs after midnight
+  is told apart from the same trip today, and values are tuples of arrival delays and departure
+  delays, in seconds, one per stop in stop sequence order. `min_delay` and `max_delay` bound all
+  the departure delays, so the scheduled order of departures is off by at most that much (see
+  _DepartureBoard()). `sources` has the TripUpdate each trip came from, so trips that come again
+  unchanged in the next realtime message are skipped at once.
+  """
+
+  __slots__ = ('trips', 'cancelled', 'sources', 'min_delay', 'max_delay')
+
+  def __init__(self):
+    self.trips, self.cancelled, self.sources, self.min_delay, self.max_delay = {}, set(), {}, 0, 0
+
+  def Update(self, updates):
+    """Applies updates to the delays; the number of trips that changed."""
+    # updates like {(service_date, trip_code): (arrival_delays, departure_delays), _CANCELLED or
+    # None to drop it}; returns the number of trips that changed and only looks at those; readers
+    # in other threads see the old or the new delays of a trip, always within the bounds
+    changed, tighten = [], False
+    for key, trip_delays in updates.items():
+      old_delays = _CANCELLED if key in self.cancelled else self.trips.get(key)
+      if trip_delays == old_delays:
+        continue
+      changed.append((key, trip_delays))
+      if isinstance(trip_delays, tuple):  # widen the bounds *before* the new delays are visible
+        self.min_delay = min((self.min_delay,) + trip_delays[1])
+        self.max_delay = max((self.max_delay,) + trip_delays[1])
+      if isinstance(old_delays, tuple):
+        tighten = tighten or min(old_delays[1]) == self.min_delay or (
+            max(old_delays[1]) == self.max_delay)
+    for key, trip_delays in changed:
+      if trip_delays == _CANCELLED:
+        self.cancelled.add(key)
+        self.trips.pop(key, None)
+      elif trip_delays is None:
+        self.cancelled.discard(key)
+        self.trips.pop(key, None)
+      else:
+        self.trips[key] = trip_delays
+        self.cancelled.discard(key)
+    if tighten:  # a trip that set a bound changed: only now is a full pass needed
+      self.min_delay = min([0] + [min(d[1]) for d in self.trips.values()])
+      self.max_delay = max([0] + [max(d[1]) for d in self.trips.values()])
+    return len(changed)
+
+
+def _ReadRealtime(source):  # like {'header': {...}, 'entity': [...]}, a GTFS-Realtime FeedMessage
+  if urllib.parse.urlsplit(source).scheme in ('http', 'https'):
+    try:
+      with urllib.request.urlopen(source, timeout=_REALTIME_TIMEOUT) as response:
+        data = response.read()
+    except OSError as err:  # includes urllib.error.URLError
+      raise Error('Could not read realtime feed %r: %s' % (source, err)) from err
+  else:
+    with open(source, 'rb') as realtime_file:
+      data = realtime_file.read()
+  if data.lstrip()[:1] == b'{':
+    try:
+      return json.loads(data.decode('utf-8'))
+    except ValueError as err:
+      raise Error('Realtime feed %r is not valid JSON: %s' % (source, err)) from err
+  gtfs_realtime_pb2 = _OptionalImport('google.transit.gtfs_realtime_pb2')
+  if gtfs_realtime_pb2 is None:
+    raise Error('Realtime feed %r is protobuf, which needs the gtfs-realtime-bindings package; '
+                'install it or use the JSON form of the feed' % source)
+  message = gtfs_realtime_pb2.FeedMessage()
+  try:
+    message.ParseFromString(data)
+  except _OptionalImport('google.protobuf.message').DecodeError as err:
+    raise Error('Realtime feed %r is not a valid FeedMessage: %s' % (source, err)) from err
+  return _OptionalImport('google.protobuf.json_format').MessageToDict(
+      message, preserving_proto_field_name=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _CamelCase(name):  # like 'tripUpdate' for 'trip_update'
+  return name.split('_')[0] + ''.join(part.capitalize() for part in name.split('_')[1:])
+
+
+def _RealtimeField(message, name, default=None):  # message[name], for snake or camel case JSON
+  value = message.get(name)
+  return message.get(_CamelCase(name), default) if value is None else value
+
+
+def _TripUpdates(message):
+  # like (bool_full_dataset, [(trip_id, 'YYYYMMDD' or '', bool_deleted, bool_cancelled,
+  #                            [(int_stop_sequence or None, stop_id or None, arrival_event,
+  #                              departure_event, bool_skipped), ...]), ...])
+  # for a FeedMessage like _ReadRealtime(); events like {'delay': int} or {'time': int} or None
+  if not isinstance(message, dict) or not isinstance(message.get('entity', []), list):
+    raise Error('Realtime feed is not a GTFS-Realtime FeedMessage')
+  header = message.get('header') or {}
+  full_dataset = header.get('incrementality', 'FULL_DATASET') in ('FULL_DATASET', 0)
+  trip_updates = []
+  for entity in message.get('entity', []):
+    trip_update = _RealtimeField(entity, 'trip_update')
+    if not trip_update:
+      continue  # vehicle positions and alerts are not used
+    trip = trip_update.get('trip') or {}
+    trip_id = _RealtimeField(trip, 'trip_id')
+    if not trip_id:
+      continue  # trips only identified by route and start time are not supported
+    stop_updates = []
+    for stop_update in _RealtimeField(trip_update, 'stop_time_update', []):
+      stop_sequence = _RealtimeField(stop_update, 'stop_sequence')
+      stop_updates.append((
+          None if stop_sequence is None else int(stop_sequence),
+          _RealtimeField(stop_update, 'stop_id'),
+          stop_update.get('arrival'), stop_update.get('departure'),
+          _RealtimeField(stop_update, 'schedule_relationship') in ('SKIPPED', 1)))
+    trip_updates.append((
+        trip_id, _RealtimeField(trip, 'start_date', ''),
+        bool(_RealtimeField(entity, 'is_deleted', False)),
+        _RealtimeField(trip, 'schedule_relationship') in ('CANCELED', 3), stop_updates))
+  return (full_dataset, trip_updates)
+
+
+def _EventDelay(event, scheduled_time, service_date):  # like int_delay or None
+  if not event:
+    return None
+  if event.get('delay') is not None:
+    return int(event['delay'])
+  if event.get('time') is not None:  # POSIX time, in local time like the feed
+    event_time = datetime.datetime.fromtimestamp(int(event['time']))
+    return ((event_time.date() - service_date).days * _DAY_SECONDS +
+            _TimeToSeconds(event_time.strftime('%H:%M:%S')) - scheduled_time)
+  return None
+
+
+def _TripDelays(timetable, trip_code, service_date, stop_updates):
+  # like ((int_arrival_delay, ...), (int_departure_delay, ...)), one per stop of trip_code, for
+  # stop_updates like _TripUpdates(); a delay holds for the next stops until another update, and
+  # stops before the first update (or skipped) keep their times
+  stop_codes, sequences, arrivals, departures = timetable.Trip(timetable.trip_ids[trip_code])
+  updates, position = {}, 0
+  for stop_sequence, stop_id, arrival_event, departure_event, skipped in stop_updates:
+    if stop_sequence is not None:
+      positions = [n for n, sequence in enumerate(sequences) if sequence == stop_sequence]
+    else:
+      stop_code = timetable.stop_codes.get(stop_id)
+      positions = [n for n in range(position, len(stop_codes)) if stop_codes[n] == stop_code]
+    if not positions:
+      logging.debug('Realtime update for unknown stop %r/%r of trip %r', stop_sequence, stop_id,
+                    timetable.trip_ids[trip_code])
+      continue
+    position = positions[0]
+    if not skipped:
+      updates[position] = (arrival_event, departure_event)
+  arrival_delays, departure_delays, delay = [], [], 0
+  for position in range(len(stop_codes)):
+    if position in updates:
+      arrival_event, departure_event = updates[position]
+      arrival_delay = _EventDelay(arrival_event, arrivals[position], service_date)
+      departure_delay = _EventDelay(departure_event, departures[position], service_date)
+      if arrival_delay is None:
+        arrival_delay = delay if departure_delay is None else departure_delay
+      delay = arrival_delay if departure_delay is None else departure_delay
+      arrival_delays.append(arrival_delay)
+    else:
+      arrival_delays.append(delay)
+    departure_delays.append(delay)
+  return (tuple(arrival_delays), tuple(departure_delays))
+
+
+def _ApplyTripUpdates(timetable, message, today=None):
+  # applies the TripUpdates of message (like _ReadRealtime()) to timetable's _Delays(), returns
+  # the number of trips that changed; trips with no start_date run on today (Default: the date)
+  full_dataset, trip_updates = _TripUpdates(message)
+  today = today or datetime.date.today()
+  if timetable.delays is None:
+    timetable.delays = _Delays()
+  delays, updates, seen, dates = timetable.delays, {}, set(), {'': today}
+  for trip_id, start_date, deleted, cancelled, stop_updates in trip_updates:
+    trip_code = timetable.trip_codes.get(trip_id)
+    if trip_code is None:
+      logging.debug('Realtime update for unknown trip %r', trip_id)
+      continue
+    if start_date not in dates:
+      dates[start_date] = _ParseDate(start_date)
+    key = (dates[start_date], trip_code)
+    seen.add(key)
+    source = (deleted, cancelled, stop_updates)
+    if delays.sources.get(key) == source:
+      continue  # same as last time: nothing to compute
+    delays.sources[key] = source
+    if deleted:
+      updates[key] = None
+    elif cancelled:
+      updates[key] = _CANCELLED
+    else:
+      trip_delays = _TripDelays(timetable, trip_code, key[0], stop_updates)
+      # a trip that is on time again is dropped, so the overlay only has the delayed ones
+      updates[key] = trip_delays if any(trip_delays[0] + trip_delays[1]) else None
+  if full_dataset:  # trips that are not in the message have no predictions anymore
+    for key in set(delays.sources) - seen:
+      del delays.sources[key]
+      updates[key] = None
+  return delays.Update(updates)
+
+
+def _CompleteNames(ctx, names_n, incomplete):
+  # like ['Tara St', ...]: the route (names_n == 0) or stop (names_n == 1) official names that
+  # start like incomplete, case and accent insensitive, for the --feed and --db already given;
+  # completion must never fail, so a feed that can't be read just has no names
+  try:
+    if ctx.params.get('db_path'):
+      _SetFeedDB(ctx.params['db_path'], (ctx.params.get('feed_version') or '').strip())
+    else:
+      _SetFeed(ctx.params.get('feed_path') or _DATA_DIR)
+    names = _LoadNames()[names_n]
+  except (Error, OSError, ValueError, sqlite3.Error):
+    return []
+  prefix = _NormalizeName(incomplete)
+  return sorted({name for name in names.values() if _NormalizeName(name).startswith(prefix)})
+
+
+def _CompleteRoutes(ctx, unused_param, incomplete):  # click shell_complete for --route
+  return _CompleteNames(ctx, 0, incomplete)
+
+
+def _CompleteStops(ctx, unused_param, incomplete):
+  # click shell_complete for --stop, --alias and --fake; click does not say which of the values
+  # of an --alias or --fake is being completed, so all of them get stop names
+  return _CompleteNames(ctx, 1, incomplete)
 
 
 @click.command()
@@ -255,24 +3258,33 @@ def _PrintStops(stops_names):
 #   http://click.pocoo.org/5/quickstart/
 #   http://click.pocoo.org/5/options/
 #   http://click.pocoo.org/5/documentation/#help-texts
-@click.argument('operation', type=click.Choice(['list', 'print']))
+@click.argument(
+    'operation',
+    type=click.Choice(
+        ['list', 'search', 'print', 'plan', 'departures', 'compile', 'import', 'batch', 'refresh',
+         'serve']))
 @click.option(
     '--route', '-r', 'routes_tuple', type=click.STRING, multiple=True,
-    help='Case-sensitive Irish Rail route/service name (ex: "DART"); '
+    shell_complete=_CompleteRoutes,
+    help='Irish Rail route/service name, case and accent insensitive (ex: "DART"); '
     'can be given more than once for multiple routes/services; at least one required.')
 @click.option(
     '--stop', '-s', 'stops_tuple', type=click.STRING, multiple=True,
-    help='Case-sensitive Irish Rail stop name to include in output (ex: "Grand Canal Dock"); '
+    shell_complete=_CompleteStops,
+    help='Irish Rail stop name to include in output, case and accent insensitive '
+    '(ex: "Grand Canal Dock"); for "search" it is the name, prefix or misspelling to look for; '
     'can be given more than once for multiple stops, and at least 2 are required.')
 @click.option(
     '--alias', '-a', 'aliases_tuple', type=(click.STRING, click.STRING), multiple=True,
-    help='Station alias as 2 strings, the first is the case-sensitive Irish Rail name and the '
+    shell_complete=_CompleteStops,
+    help='Station alias as 2 strings, the first is the Irish Rail name and the '
     'second is the alias (ex: -a "Bray Daly" "Bray"); can be given more than once.')
 @click.option(
     '--fake', '-f', 'fakes_tuple', type=(click.STRING, click.STRING, click.INT), multiple=True,
+    shell_complete=_CompleteStops,
     help='Fake (inserted) station to display in output as 2 strings and an int delta in number '
     'of minutes before or after; the first string is the alias for the fake station, the second '
-    'string is the Irish Rail case-sensitive station to count the delta from, and the integer is '
+    'string is the Irish Rail station to count the delta from, and the integer is '
     'the delta, in whole minutes (ex: -f "Home" "Bray Daly" -10, meaning "Home" is 10 min south '
     'of Bray); this delta is counted towards the bool_direction_id==False direction of the data '
     'table (on the DART service this means the NORTH directon); can be given more than once.')
@@ -282,6 +3294,20 @@ def _PrintStops(stops_names):
 @click.option(
     '--csv-out/--no-csv-out', 'csv_out', default=False,
     help='Save CSV file? Default is no (--no-csv-out).')
+@click.option(
+    '--output', '-o', 'output_path', type=click.Path(dir_okay=False, allow_dash=True), default=None,
+    help='For "print": also write all the tables to this file ("-" is stdout, instead of '
+    '--print-out) in --format, as they are made, so big exports only ever have the trips of one '
+    'date in memory (not the formatted tables) and can be read while being written; gzipped if it '
+    'ends in ".gz" (or with --gzip).')
+@click.option(
+    '--format', 'output_format', type=click.Choice(sorted(_OUTPUT_WRITERS)), default=None,
+    help='Format of --output: "text" (like --print-out), "csv", "jsonl" (JSON Lines, a row per '
+    'line), "html" or "parquet" (needs pyarrow); Default is from the --output file extension, '
+    'or "text".')
+@click.option(
+    '--gzip/--no-gzip', 'compress_output', default=False,
+    help='Gzip --output? Default is no (--no-gzip), unless it ends in ".gz".')
 @click.option(
     '--idcol/--no-idcol', 'idcol_out', default=False,
     help='Add Irish Rail trip ID column to output? Default is no (--no-idcol).')
@@ -289,6 +3315,21 @@ def _PrintStops(stops_names):
     '--date', '-d', 'date_to_use', type=click.STRING, default='',
     help='If given, the date that will be used for producing timetables; '
     'Format has to be YYYYMMDD; If not given, current date will be used.')
+@click.option(
+    '--end-date', '-e', 'end_date', type=click.STRING, default='',
+    help='If given, timetables are produced for every date from --date up to this one (inclusive), '
+    'loading the feed only once; Format has to be YYYYMMDD.')
+@click.option(
+    '--time', '-t', 'time_to_use', type=click.STRING, default='',
+    help='For "plan" and "departures": departure time, as HH:MM; If not given, current time will '
+    'be used.')
+@click.option(
+    '--until', '-u', 'until_time', type=click.STRING, default='',
+    help='For "plan": if given, show all the best journeys departing from --time up to this time '
+    '(HH:MM) instead of just the one arriving first.')
+@click.option(
+    '--count', '-n', 'departures_count', type=click.IntRange(1, _MAX_DEPARTURES), default=10,
+    help='For "departures": number of next departures to show; Default is 10.')
 @click.option(
     '--irregular/--no-irregular', 'allow_irregulars', default=False,
     help='Dangerous; Allow for irregular schedules; By default (--no-irregular) will skip all '
@@ -298,19 +3339,145 @@ def _PrintStops(stops_names):
 @click.option(
     '--max-trips', 'max_trips', type=click.IntRange(0, 50000, clamp=True), default=0,
     help='Dangerous; If given, will limit the number of trips (rows) in the output, for debugging.')
+@click.option(
+    '--config', '-c', 'config_path', type=click.Path(exists=True, dir_okay=False), default=None,
+    help='For "batch": JSON (or TOML, with Python 3.11+) file with a "timetables" list, each entry '
+    'like {"name": "...", "routes": [...], "stops": [...], "aliases": [["Bray Daly", "Bray"]], '
+    '"fakes": [["Home", "Bray Daly", -10]], "date": "YYYYMMDD", "end_date": "YYYYMMDD", '
+    '"irregular": false, "idcol": false, "max_trips": 0}; only "routes" and "stops" are required.')
+@click.option(
+    '--manifest', 'manifest_path', type=click.Path(dir_okay=False),
+    default='timetables.manifest.json',
+    help='For "refresh": JSON file that keeps track of the timetables produced, the feed they were '
+    'produced from (a copy of its snapshot is kept in the same path plus ".feed") and the last '
+    'feed diff; Default is "timetables.manifest.json".')
+@click.option(
+    '--jobs', '-j', 'jobs', type=click.IntRange(1, 256), default=os.cpu_count() or 1,
+    help='For "batch": number of worker processes; also the number of processes that parse big '
+    'feed files (like stop_times.txt) in parallel, for all operations but "serve"; Default is the '
+    'number of CPUs.')
+@click.option(
+    '--host', 'host', type=click.STRING, default='127.0.0.1',
+    help='For "serve": address to listen on; Default is 127.0.0.1 (local only).')
+@click.option(
+    '--port', 'port', type=click.IntRange(0, 65535), default=8080,
+    help='For "serve": TCP port to listen on; Default is 8080.')
+@click.option(
+    '--cache-size', 'cache_size', type=click.IntRange(1, 1000000), default=256,
+    help='For "serve": number of query results to keep in the LRU cache; Default is 256.')
+@click.option(
+    '--reload-interval', 'reload_interval', type=click.FloatRange(0.1, 86400.0), default=10.0,
+    help='For "serve": seconds between checks for feed file changes (a reload happens once the '
+    'files stop changing); Default is 10.')
+@click.option(
+    '--realtime', 'realtime_source', type=click.STRING, default=None,
+    help='GTFS-Realtime TripUpdates feed (a file or an http(s) URL, as JSON or, with the '
+    'gtfs-realtime-bindings package, protobuf) whose delays and cancellations are applied on top '
+    'of the timetable for "print", "departures", "batch" and "serve" ("plan" is not affected).')
+@click.option(
+    '--realtime-interval', 'realtime_interval', type=click.FloatRange(1.0, 86400.0), default=30.0,
+    help='For "serve" with --realtime: seconds between reads of the realtime feed; Default is 30.')
+@click.option(
+    '--feed', 'feed_path', type=click.Path(), default=_DATA_DIR,
+    help='GTFS feed to use: a directory with the .txt files or the published .zip, which is read '
+    'as is, with no extraction; the feed snapshot of a .zip is saved next to it, with the same '
+    'name (see "compile"); not used with --db, but by "compile", "import" and "refresh"; Default '
+    'is %r.' % _DATA_DIR)
+@click.option(
+    '--db', 'db_path', type=click.Path(dir_okay=False), default=None,
+    help='SQLite feed database: "import" adds the --feed to it, and all other operations (but '
+    '"compile") read the feed from it, with indexed queries, instead of from --feed.')
+@click.option(
+    '--feed-version', 'feed_version', type=click.STRING, default='',
+    help='With --db, the feed version: "import" saves the feed as this version (replacing it if '
+    'it is there; Default is the current date, YYYYMMDD) and the other operations use it (Default '
+    'is the last one imported).')
+@click.option(
+    '--profile', 'profile_path', type=click.Path(dir_okay=False, writable=True), default=None,
+    help='If given, save to this file a JSON report with the wall time, CPU time, rows and peak '
+    'memory of every pipeline stage (feed load, trip filter, timetable load, calendar build, '
+    'service filter, table assembly, sort, table format, output) and of the whole run; the rows '
+    'of "print" are made as they are written, so their formatting is part of output.')
+@click.option(
+    '--profile-memory/--no-profile-memory', 'profile_memory', default=False,
+    help='With --profile, also trace the peak Python allocations of every stage? Slow; Default is '
+    'no (--no-profile-memory).')
+@click.option(
+    '--profile-stats', 'profile_stats_path', type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help='With --profile, also run cProfile and save its stats to this file (see `pstats`).')
+@click.option(
+    '--profile-collapsed', 'profile_collapsed_path',
+    type=click.Path(dir_okay=False, writable=True), default=None,
+    help='With --profile, also run cProfile and save its collapsed stacks to this file, for '
+    'flamegraph.pl and compatible tools.')
 @click.option(
     '--verbose', '-v', 'verbosity_level', count=True,
     help='Verbose level; default is errors only; -v includes info/warning; -vv includes debug.')
 def tables(
-    operation, routes_tuple, stops_tuple, aliases_tuple, fakes_tuple,
-    print_out, csv_out, idcol_out, date_to_use, allow_irregulars, max_trips, verbosity_level):
+    operation,
+    routes_tuple,
+    stops_tuple,
+    aliases_tuple,
+    fakes_tuple,
+    print_out,
+    csv_out,
+    output_path,
+    output_format,
+    compress_output,
+    idcol_out,
+    date_to_use,
+    end_date,
+    time_to_use,
+    until_time,
+    departures_count,
+    allow_irregulars,
+    max_trips,
+    config_path,
+    manifest_path,
+    jobs,
+    host,
+    port,
+    cache_size,
+    reload_interval,
+    realtime_source,
+    realtime_interval,
+    feed_path,
+    db_path,
+    feed_version,
+    profile_path,
+    profile_memory,
+    profile_stats_path,
+    profile_collapsed_path,
+    verbosity_level):
   """Load Irish Rail route data and output custom timetables. OPERATION is either "list" to
-  show Irish Rail official route and station names or "print" to produce a custom timetable
-  for certain stops. Typical examples:
+  show Irish Rail official route and station names, "search" to look up the --route and
+  --stop names (by name, prefix, or approximately), "print" to produce a custom timetable
+  for certain stops (also streamed to an --output file as text, CSV, JSON Lines, HTML or
+  Parquet), "plan" to find the best journeys between two --stop across all routes,
+  with changes (--time, or all between --time and --until), "departures" to list the next
+  --count departures from a --stop after --time (optionally only of --route, and only to a
+  second --stop), "compile" to save a binary snapshot of the feed that makes all later
+  runs skip CSV parsing (it is ignored, with a warning, once the feed files change), "import"
+  to add the feed to a SQLite --db as a --feed-version, that later runs can query instead,
+  "batch" to save the CSVs of all timetables in a --config file, loading the feed only once,
+  "refresh" to compile a new feed and save again only the "batch" timetables whose data changed
+  since the feed of the last "refresh", with a report of the changes, or "serve" to answer "print"
+  (as JSON or CSV) and "departures" queries over HTTP, from an in-memory feed that
+  is reloaded when the files in the data directory change. The shell can complete --route,
+  --stop, --alias and --fake with official names (see the "eval" example, for bash; zsh and fish
+  have "zsh_source" and "fish_source"). To start fast, "list" and the completion keep the
+  names in an index next to the feed ("feed.names" in its directory, or the .zip name with
+  ".names"), that they (or "compile") write when it is missing or the feed changed; if the feed
+  directory is read-only they just parse the feed every time. Typical examples:
 
   \b
+  ./irish_rail.py compile
+  ./irish_rail.py compile --feed google_transit_irishrail.zip
+  ./irish_rail.py import --feed google_transit_irishrail.zip --db feeds.sqlite --feed-version 201809
   ./irish_rail.py list
-  ./irish_rail.py print --csv-out --route DART \\
+  ./irish_rail.py search --stop "tara" --stop "grand canal" --route "dart"
+  ./irish_rail.py print --csv-out --profile profile.json --route DART \\
       --stop "Howth Junction and Donaghmede" \\
       --stop "Tara St" \\
       --stop "Grand Canal Dock" \\
@@ -319,6 +3486,16 @@ def tables(
       --alias "Grand Canal Dock" "Grand Canal" \\
       --fake "Home" "Howth Junction and Donaghmede" 24 \\
       --fake "Work Desk" "Grand Canal Dock" -9
+  ./irish_rail.py print --no-print-out --route DART --stop "Tara St" --stop "Bray Daly" \\
+      --date 20180901 --end-date 20180930 -o september.jsonl.gz
+  ./irish_rail.py plan --stop "Howth" --stop "Maynooth" --date 20180917 -t 07:00 -u 10:00
+  ./irish_rail.py departures --stop "Tara St" --stop "Bray Daly" --route DART -t 08:00 -n 5
+  ./irish_rail.py batch --config commuters.json --jobs 4
+  ./irish_rail.py refresh --config commuters.json --manifest commuters.manifest.json
+  ./irish_rail.py serve --port 8080 --realtime http://127.0.0.1:9000/tripupdates.json
+  curl 'http://127.0.0.1:8080/timetable?route=DART&stop=Tara+St&stop=Pearse&format=csv'
+  curl 'http://127.0.0.1:8080/departures?stop=Tara+St&to=Bray+Daly&count=5'
+  eval "$(_IRISH_RAIL_PY_COMPLETE=bash_source ./irish_rail.py)"
   """
   # set logging level
   logging.basicConfig(
@@ -328,180 +3505,178 @@ def tables(
   logging.info('This program comes with ABSOLUTELY NO WARRANTY; '
                'this is free software, and you are welcome to redistribute it under certain '
                'conditions; see LICENSE file for details.')
+  if (profile_stats_path or profile_collapsed_path) and not profile_path:
+    raise Error('--profile-stats and --profile-collapsed need --profile')
+  if profile_path:
+    global _PROFILER  # pylint: disable=global-statement
+    _PROFILER = _Profiler(profile_memory, bool(profile_stats_path or profile_collapsed_path))
+    click.get_current_context().call_on_close(functools.partial(
+        _SaveProfile, operation, profile_path, profile_stats_path, profile_collapsed_path))
+  if not db_path or operation in _FEED_OPERATIONS:  # the others read it all from the --db
+    _SetFeed(feed_path)
+  if operation != 'serve':  # forking while the server threads run is not safe
+    global _PARSE_JOBS  # pylint: disable=global-statement
+    _PARSE_JOBS = jobs
+  if operation == 'compile':
+    logging.info('OPERATION: compile feed snapshot')
+    _CompileSnapshot()
+    return
+  if operation == 'refresh':
+    logging.info('OPERATION: refresh batch timetables')
+    if not config_path:
+      click.echo('With no --config there is nothing to do!')
+      return
+    summary, statuses = _RunRefresh(config_path, manifest_path, jobs)
+    _PrintRefresh(summary, statuses)
+    failed_count = sum(1 for status in statuses.values() if status.startswith('ERROR'))
+    if failed_count:
+      raise Error('%d of %d refreshed timetables failed' % (failed_count, len(statuses)))
+    logging.info('DONE')
+    return
+  if operation == 'import':
+    logging.info('OPERATION: import feed into database')
+    if not db_path:
+      click.echo('With no --db there is nowhere to import to!')
+      return
+    db = _ImportFeed(db_path, feed_version.strip() or datetime.date.today().strftime(_DATE_REPR))
+    _PrintFeedVersions(db_path, db)
+    return
+  if db_path:
+    _SetFeedDB(db_path, feed_version.strip())
+  if realtime_source:
+    global _REALTIME_SOURCE  # pylint: disable=global-statement
+    _REALTIME_SOURCE = realtime_source
+  if operation == 'serve':
+    logging.info('OPERATION: serve timetables over HTTP')
+    server = _NewTimetableServer((host, port), cache_size, reload_interval, realtime_interval)
+    click.echo('Serving timetables on http://%s:%d/timetable (Ctrl-C to stop)' % (
+        host, server.server_address[1]))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+    logging.info('DONE')
+    return
   # load oficial routes and stops first, as we might need to print those
-  routes, stops_names = _LoadRoutes(), _LoadStops()
+  with _Stage('feed_load') as stage:
+    routes, stops_names = _LoadNames()
+    stage['rows'] = len(routes) + len(stops_names)
   if operation == 'list':
     logging.info('OPERATION: list routes & stops')
     _PrintRoutes(routes)
     _PrintStops(stops_names)
     return
+  routes_index, stops_index = _NameIndex(routes), _NameIndex(stops_names)
+  if operation == 'search':
+    logging.info('OPERATION: search routes & stops')
+    if not any(r.strip() for r in routes_tuple) and not any(s.strip() for s in stops_tuple):
+      click.echo('With no --route and no --stop there is nothing to search for!')
+      return
+    _PrintSearch('Route', routes_index, [r.strip() for r in routes_tuple if r.strip()])
+    _PrintSearch('Station', stops_index, [s.strip() for s in stops_tuple if s.strip()])
+    return
+  if operation == 'plan':
+    logging.info('OPERATION: plan journeys')
+    stops_list = [s.strip() for s in stops_tuple if s.strip()]
+    if len(stops_list) != 2:
+      click.echo('Give exactly two --stop (origin and destination) to plan a journey!')
+      return
+    date_to_use = date_to_use.strip()
+    plan_date = _ParseDate(date_to_use) if date_to_use else datetime.date.today()
+    first_time = (_TimeToSeconds(time_to_use.strip() + ':00') if time_to_use.strip() else
+                  _TimeToSeconds(datetime.datetime.now().strftime('%H:%M:%S')))
+    feed = _LoadFeed()
+    planner = _JourneyPlanner(feed, _LoadConnections(feed.timetable))
+    origin_codes, target_codes = feed.StopCodes(stops_list[0]), feed.StopCodes(stops_list[1])
+    if until_time.strip():
+      journeys = planner.Profile(origin_codes, target_codes, plan_date, first_time,
+                                 _TimeToSeconds(until_time.strip() + ':00'))
+    else:
+      journey = planner.EarliestArrival(origin_codes, target_codes, plan_date, first_time)
+      journeys = [journey] if journey else []
+    _PrintJourneys(planner, stops_list[0], stops_list[1], plan_date, journeys)
+    logging.info('DONE')
+    return
+  if operation == 'departures':
+    logging.info('OPERATION: next departures')
+    stops_list = [s.strip() for s in stops_tuple if s.strip()]
+    if len(stops_list) not in (1, 2):
+      click.echo('Give one --stop to list its departures (and optionally a second one, as the '
+                 'destination)!')
+      return
+    destination_name = stops_list[1] if len(stops_list) == 2 else None
+    route_names = {r.strip() for r in routes_tuple if r.strip()}
+    route_ids = set().union(*(_RouteIDByName(routes_index, r) for r in sorted(route_names))) if (
+        route_names) else None
+    date_to_use = date_to_use.strip()
+    board_date = _ParseDate(date_to_use) if date_to_use else datetime.date.today()
+    start_time = (_TimeToSeconds(time_to_use.strip() + ':00') if time_to_use.strip() else
+                  _TimeToSeconds(datetime.datetime.now().strftime('%H:%M:%S')))
+    feed = _LoadFeed(route_ids)
+    departures = _Departures(feed.Board(), stops_list[0], board_date, start_time,
+                             departures_count, route_ids, destination_name)
+    _PrintDepartures(stops_list[0], destination_name, board_date, departures, idcol_out)
+    logging.info('DONE')
+    return
+  if operation == 'batch':
+    logging.info('OPERATION: batch timetables')
+    if not config_path:
+      click.echo('With no --config there is nothing to do!')
+      return
+    results = _RunBatch(routes_index, config_path, jobs)
+    _PrintBatchResults(results)
+    failed_count = sum(1 for error_message in results.values() if error_message is not None)
+    if failed_count:
+      raise Error('%d of %d batch timetables failed' % (failed_count, len(results)))
+    logging.info('DONE')
+    return
   logging.info('OPERATION: print custom timetable')
   # process basic flags
-  if not print_out and not csv_out:
-    click.echo('With --no-print-out and --no-csv-out there is nothing to do!')
+  if output_path == '-':
+    print_out = False  # the --output tables already go to stdout; both would mix their lines
+  if not print_out and not csv_out and not output_path:
+    click.echo('With --no-print-out, --no-csv-out and no --output there is nothing to do!')
     return
-  desired_rout_names = {r.strip() for r in routes_tuple if r.strip()}
-  desired_route_ids = set()
-  for route_name in desired_rout_names:
-    desired_route_ids.update(_RouteIDByName(routes, route_name))
-  stops_set = {s.strip() for s in stops_tuple if s.strip()}
-  if not desired_rout_names or len(stops_set) < 2:
+  if not {r.strip() for r in routes_tuple if r.strip()} or len(
+      {s.strip() for s in stops_tuple if s.strip()}) < 2:
     click.echo('With less than one --route and two --stop there is nothing to do!')
     return
-  aliases_dict = {s.strip(): a.strip() for s, a in aliases_tuple if s.strip()}
-  fakes_dict = {a.strip(): (s.strip(), d) for a, s, d in fakes_tuple if s.strip()}
-  # compute date and some date utils
-  date_to_use = date_to_use.strip()
-  timetable_date_to_use = (datetime.datetime.strptime(date_to_use, _DATE_REPR).date()
-                           if date_to_use else datetime.date.today())
-  timetable_date_repr = timetable_date_to_use.strftime(_DATE_REPR)
-  timetable_datetime = datetime.datetime.combine(timetable_date_to_use, datetime.time(hour=0))
-  add_minutes_to_time = lambda t, m: (datetime.datetime.combine(timetable_date_to_use, t) +
-                                      datetime.timedelta(minutes=m)).time()
-  # log the options
-  logging.info('Routes: %s', ', '.join(repr(n) for n in sorted(desired_rout_names)))
-  logging.info('Stations: %s', ', '.join(repr(n) for n in sorted(stops_set)))
-  logging.info(
-      'Aliases: %s', ', '.join('%r=%r' % (n, aliases_dict[n]) for n in sorted(aliases_dict)))
-  logging.info(
-      'Fake Stations: %s', ', '.join(
-          '%r=%r/%dmin' % (n, fakes_dict[n][0], fakes_dict[n][1]) for n in sorted(fakes_dict)))
-  logging.info('Date: %s', timetable_date_repr)
-  # get stops and find the interesting ones; note one stop name can translate to multiple IDs
-  station_aliases = {
-      stop_id: stop_alias
-      for stop_name, stop_alias in aliases_dict.items()
-      for stop_id in _StopIDsByName(stops_names, stop_name) if stop_alias}
-  translate_stop_name = lambda stop_id: station_aliases.get(stop_id, None) or stops_names[stop_id]
-  interesting_stops = {stop_name: _StopIDsByName(stops_names, stop_name) for stop_name in stops_set}
-  desired_stops_count = len(stops_set)
-  interesting_stops_ids = {stop_id for stops in interesting_stops.values() for stop_id in stops}
-  # add "fake stops" and then monkey-patch the fake stops into the structures above
-  fake_stops = {stop_id: (fake_name, rel_min)
-                for fake_name, (rel_stop_name, rel_min) in fakes_dict.items()  # pylint: disable=not-an-iterable
-                for stop_id in _StopIDsByName(stops_names, rel_stop_name)}
-  for fake_name, rel_min in fake_stops.values():
-    interesting_stops[fake_name] = {fake_name}  # NOTE: for fake stops the ID and name are the same!
-    stops_names[fake_name] = fake_name
-    interesting_stops_ids.add(fake_name)
-    if not rel_min:
-      raise Error(
-          'Fake stations cannot have zero delay from an actual station (on %r)' % fake_name)
-  desired_stops_count += len(fakes_dict)
-  # get the calendar
-  service_dates, service_exclusions = _LoadServiceDates(timetable_datetime)
-  # load trips and timetables, filtered by the desired route
+  spec = _TimetableSpec(
+      routes_index, routes_tuple, stops_tuple, aliases_tuple, fakes_tuple, date_to_use, end_date,
+      allow_irregulars, idcol_out, max_trips)
+  _LogSpec(spec)
+  # load trips and timetables, filtered by the desired route; they are shared by all dates
   # TODO: include feature to allow multiple desired routes so user can look at more complete data
-  trips = _LoadTripsForRoute(desired_route_ids, service_exclusions)
-  timetable = _LoadTimetableForTrips(set(trips))
-  # get all the trips (but only for the interesting stops)
-  trip_starts = _GetTripStarts(trips, timetable)
-  # now we calculate the data to be output, which is like:
-  #   {bool_direction_id: [
-  #       {'id': trip_id, 'week': week_type,
-  #        'start': (stop_id, arrival_time), 'end': (stop_id, arrival_time),
-  #        'stops': [(stop_id, arrival_time), ...more stops...]}, ...more trips...]}
-  output_dict = {False: [], True: []}
-  for bool_direction_id in sorted(output_dict):
-    trips_table = output_dict[bool_direction_id]
-    for week_index in sorted(_WEEK_TYPE):
-      for trip_start in sorted(trip_starts):
-        for trip_id in sorted(trip_starts[trip_start]):  # we sort by trip start
-          # get service dates and filter by them
-          trip = trips[trip_id]
-          service_id = trip[0]
-          week_schedule = service_dates[service_id]
-          if not allow_irregulars and week_schedule[3]:
-            logging.debug('Skipping trip %s because it has an irregular schedule', trip_id)
-            continue
-          if trip[1] == bool_direction_id and week_schedule[week_index]:
-            # here we have a trip we may want to output, so go figure it out
-            trip_timetable = timetable[trip_id]
-            from_station, to_station = trip_timetable[0], trip_timetable[-1]
-            filtered_stations = tuple(s for s in trip_timetable if s[1] in interesting_stops_ids)
-            if len(filtered_stations) >= 2:
-              # this trip has at least 2 stops from our list, so it is to be output
-              trip_stops = []
-              for _, stop_id, arrival_time in filtered_stations:
-                # we have a stop to add, but it might have a fake stop associated to it, so here
-                # is where we will add it as if it was part of the line's schedule; we have to be
-                # careful to add it either before or after the master station
-                fake_name, rel_min = fake_stops.get(stop_id, (None, None))
-                if fake_name is not None and (bool_direction_id == (rel_min > 0)):
-                  # fake stop before master
-                  trip_stops.append((fake_name, add_minutes_to_time(arrival_time, -abs(rel_min))))
-                trip_stops.append((stop_id, arrival_time))  # master stop
-                if fake_name is not None and (bool_direction_id != (rel_min > 0)):
-                  # fake stop after master
-                  trip_stops.append((fake_name, add_minutes_to_time(arrival_time, abs(rel_min))))
-              trips_table.append({
-                  'id': trip_id, 'week': week_index,
-                  'start': from_station[1:], 'end': to_station[1:], 'stops': trip_stops})
-  # having the data to output we generate the output
-  # first we have to find out the order of the stations for each direction and make sure this
-  # is consistent across all data, by checking them and adding None values in the missing ones
-  stop_ordering = {}  # like {bool_direction_id: (stop1, stop2, ...)}
-  for bool_direction_id in sorted(output_dict):
-    trips_table = output_dict[bool_direction_id]
-    # find first trip who's stop list has all the desired stops to use as a template
-    for trip in trips_table:
-      if len(trip['stops']) == desired_stops_count:
-        # this is it!
-        stop_ordering[bool_direction_id] = tuple(s[0] for s in trip['stops'])
-        break
-    else:
-      raise Error('No trip was found that had all desired stops!')
-    # go through all trips to be output and add (stop_id, None) value paddings to missing stations
-    # raise if we find a discrepancy in the order
-    for trip_id, trip_stops in ((trip['id'], trip['stops']) for trip in trips_table):
-      original_i = 0
-      for desired_i, desired_stop in enumerate(stop_ordering[bool_direction_id]):
-        # compare to what is the expected
-        if original_i >= len(trip_stops) or trip_stops[original_i][0] != desired_stop:
-          # we found a missing station
-          trip_stops.insert(desired_i, (desired_stop, None))
-        original_i += 1
-      # if we had an inverted order, the side effect of the above is to end up with a trip_stops
-      # that is larger than desired_stops_count
-      if len(trip_stops) > desired_stops_count:
-        raise Error('Found trip with iverted directionality: %s' % trip_id)
-    # now we can re-sort so we have the first available stop
-    trips_table.sort(key=functools.cmp_to_key(_CmpStopsByFirstAvailableTime))
-  # now we can build the actual output tables
-  output_tables = {False: [], True: []}
-  for bool_direction_id in sorted(output_tables):
-    trips_table = output_tables[bool_direction_id]
-    trips_dict_table = output_dict[bool_direction_id]
-    # put the header in as the first line
-    header = ['Trip ID', 'Days', 'Origin'] if idcol_out else ['Days', 'Origin']
-    for stop_id in stop_ordering[bool_direction_id]:
-      header.append(translate_stop_name(stop_id))
-    header.append('Destination')
-    trips_table.append(tuple(header))
-    # add trips data
-    for output_trips_count, trip in enumerate(trips_dict_table):
-      # check for row cap
-      if max_trips and output_trips_count >= max_trips:
-        logging.warning('Trips count was capped at %d, but there were more.', max_trips)
-        break
-      # add type and start
-      row = [trip['id']] if idcol_out else []
-      row.append(_WEEK_TYPE[trip['week']])
-      row.append(translate_stop_name(trip['start'][0]))
-      # add stops data
-      for stop_n, (stop_id, arrival_time) in enumerate(trip['stops']):
-        if stop_id != stop_ordering[bool_direction_id][stop_n]:
-          raise Error('Inconsistency found in trip %s' % trip['id'])  # should not happen!
-        row.append('X' if arrival_time is None else arrival_time.strftime('%H:%M'))
-      # add end data
-      row.append(translate_stop_name(trip['end'][0]))
-      # put row in
-      trips_table.append(tuple(row))
-  # finally, we save the data to CSV, print it, or both
-  if csv_out:
-    _WriteCSVs(desired_rout_names, timetable_date_to_use, output_tables)
-  if print_out:
-    _PrintTables(desired_rout_names, output_tables)
+  if _FEED_DB is None:
+    with _Stage('feed_load') as stage:  # the snapshot (if any), that the stages below read from
+      snapshot = _LoadSnapshot()
+      stage['rows'] = 0 if snapshot is None else snapshot['stop_times'].rows_count
+  with _Stage('trip_filter') as stage:
+    trips = _LoadTripsForRoute(spec['route_ids'], set())
+    stage['rows'] = len(trips)
+  with _Stage('timetable_load') as stage:
+    timetable = _LoadTimetableForTrips(set(trips))
+    stage['rows'] = timetable.rows_count
+  with _Stage('calendar_build') as stage:
+    calendar = _LoadServiceCalendar()
+    stage['rows'] = len(calendar.days)
+  # finally, we stream the tables to all outputs at once, as their rows are made
+  with contextlib.ExitStack() as stack:
+    writers = []
+    if print_out:
+      writers.append(_TextWriter(sys.stdout))
+    if csv_out:
+      writers.append(_CSVFilesWriter(spec['name']))
+      stack.callback(writers[-1].Close)
+    if output_path:
+      writers.append(stack.enter_context(_OpenOutput(
+          output_path, _OutputFormat(output_path, output_format),
+          compress_output or output_path.endswith('.gz'))))
+    for output_table in _SpecOutputTables(spec, stops_index, trips, timetable, calendar):
+      with _Stage('output') as stage:
+        stage['rows'] = _WriteTables([output_table], writers)
   logging.info('DONE')
 
 
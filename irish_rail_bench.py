@@ -0,0 +1,522 @@
+#!/usr/bin/python3 -O
+#
+# Copyright (C) 2018 Daniel Balparda de Carvalho (balparda@gmail.com).
+# This file is part of Irish Rail Timetable.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/gpl-3.0.txt.
+#
+"""Irish Rail data converter benchmarks, over a synthetic GTFS feed of any size."""
+
+import contextlib
+import datetime
+import functools
+import io
+import json
+import logging
+import os
+import os.path
+import random
+import resource
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+
+import irish_rail
+
+
+_BENCH_DATE = datetime.date(2018, 6, 1)  # a Friday, well inside the synthetic calendar
+_BENCH_ROUTE = 'Route 0'
+_FEED_PERIOD = ('20180101', '20181231')
+_SERVICE_WEEKS = (  # like (service_suffix, (monday, ..., sunday))
+    ('WK', (1, 1, 1, 1, 1, 0, 0)),
+    ('SA', (0, 0, 0, 0, 0, 1, 0)),
+    ('SU', (0, 0, 0, 0, 0, 0, 1)),
+)
+_FIRST_START = 5 * 3600       # first trip of the day, in seconds
+_STARTS_SPREAD = 19 * 3600    # trips start in [_FIRST_START, _FIRST_START + _STARTS_SPREAD)
+_STOP_INTERVAL = 150          # seconds between stops
+_EXPRESS_SAVING = 90          # seconds an express trip saves on every stop it skips
+# the DART-sized feed, from the real Irish Rail data: ~14 routes, ~200 trips/route, ~20 stops/trip
+_DEFAULT_SCALE = {'routes': 14, 'trips': 200, 'stops': 20, 'exceptions': 50}
+
+
+def _TimeRepr(seconds):  # like 90600 -> '25:10:00', as GTFS hours can go past 24
+  return '%02d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def _StopName(route_n, stop_n):  # like 'Route 3 Station 7'
+  return 'Route %d Station %d' % (route_n, stop_n)
+
+
+def _WriteFeedFile(data_dir, file_name, header, rows):
+  # rows like iter((str_value1, str_value2, ...), ...); written like Irish Rail does: BOM + quotes
+  with open(os.path.join(data_dir, file_name), 'wt', encoding='utf-8-sig', newline='') as out:
+    out.write(header + '\r\n')
+    out.writelines(','.join('"%s"' % v for v in row) + '\r\n' for row in rows)
+
+
+def _GenerateFeed(
+    data_dir, routes_count, trips_per_route, stops_per_trip, exceptions, seed, express=0.0):
+  # writes a deterministic GTFS feed into data_dir; returns the stop_times row count; a share
+  # express (0 to 1) of the trips skips about half of its stations, the ends included (like the
+  # trips that start or end short), and overtakes the trips that stop everywhere
+  rnd = random.Random(seed)
+  _WriteFeedFile(
+      data_dir, 'routes.txt', 'route_id,agency_id,route_short_name,route_long_name,route_type',
+      (('R%d' % r, '01', '', 'Route %d' % r, '2') for r in range(routes_count)))
+  # every route is a line with its own stations, all connected at station 0 (a hub, for transfers)
+  _WriteFeedFile(
+      data_dir, 'stops.txt', 'stop_id,stop_name,stop_lat,stop_lon',
+      (('S%d_%d' % (r, s), _StopName(r, s), '53.%06d' % (r * 1000 + s), '-6.%06d' % s)
+       for r in range(routes_count) for s in range(stops_per_trip)))
+  _WriteFeedFile(
+      data_dir, 'transfers.txt', 'from_stop_id,to_stop_id,transfer_type,min_transfer_time',
+      (('S%d_0' % r1, 'S%d_0' % r2, '2', '180')
+       for r1 in range(routes_count) for r2 in range(routes_count) if r1 != r2))
+  _WriteFeedFile(
+      data_dir, 'calendar.txt',
+      'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date',
+      (('R%d%s' % (r, suffix),) + tuple(str(d) for d in week) + _FEED_PERIOD
+       for r in range(routes_count) for suffix, week in _SERVICE_WEEKS))
+  # exceptions are kept out of the look-ahead window of the benchmark date, so the benchmark
+  # output does not depend on the seed, but they still have to be loaded and indexed
+  # pylint: disable=protected-access
+  first_date, last_date = (irish_rail._ParseDate(d) for d in _FEED_PERIOD)
+  quiet_days = range(
+      (_BENCH_DATE - first_date).days - 1,
+      (_BENCH_DATE - first_date).days + irish_rail._LOOK_AHEAD_IN_DAYS + 2)
+  exception_days = [d for d in range((last_date - first_date).days + 1) if d not in quiet_days]
+  _WriteFeedFile(
+      data_dir, 'calendar_dates.txt', 'service_id,date,exception_type',
+      (('R%d%s' % (rnd.randrange(routes_count), rnd.choice(_SERVICE_WEEKS)[0]),
+        (first_date + datetime.timedelta(days=rnd.choice(exception_days))).strftime('%Y%m%d'),
+        rnd.choice('12')) for _ in range(exceptions)))
+  # trips: alternate services and directions, and spread the starts over the day
+  trips = []  # like [(route_n, trip_id, service_id, direction_id, start_seconds), ...]
+  for r in range(routes_count):
+    for t in range(trips_per_route):
+      trips.append((r, 'T%d_%d' % (r, t), 'R%d%s' % (r, _SERVICE_WEEKS[t % 3][0]), (t // 3) % 2,
+                    _FIRST_START + rnd.randrange(_STARTS_SPREAD // 60) * 60))
+  _WriteFeedFile(
+      data_dir, 'trips.txt', 'route_id,service_id,trip_id,shape_id,trip_headsign,direction_id',
+      (('R%d' % r, service_id, trip_id, 'SH%d_%d' % (r, direction_id), '', str(direction_id))
+       for r, trip_id, service_id, direction_id, _ in trips))
+
+  # the skipped stops have their own random sequence, so the other files do not depend on express
+  express_rnd = random.Random(seed)
+
+  def _Skipped():  # like {skipped_stop_n, ...}, stop_n in the trip's order; leaves 2 stops or more
+    if express_rnd.random() >= express:
+      return set()
+    trip_skipped = {n for n in range(stops_per_trip) if express_rnd.random() < 0.5}
+    return trip_skipped if len(trip_skipped) <= stops_per_trip - 2 else set()
+
+  skipped = [_Skipped() for _ in trips]  # one for each trip
+
+  def _StopTimesRows():
+    for (r, trip_id, _, direction_id, start), trip_skipped in zip(trips, skipped):
+      stations = range(stops_per_trip) if direction_id else range(stops_per_trip - 1, -1, -1)
+      arrival, seq = start - _STOP_INTERVAL, 0
+      for stop_n, s in enumerate(stations):
+        if stop_n in trip_skipped:
+          arrival += _STOP_INTERVAL - _EXPRESS_SAVING
+          continue
+        arrival, seq = arrival + _STOP_INTERVAL, seq + 1
+        yield (trip_id, _TimeRepr(arrival), _TimeRepr(arrival + 30), 'S%d_%d' % (r, s),
+               str(seq), '', '0', '0', '')
+
+  _WriteFeedFile(
+      data_dir, 'stop_times.txt',
+      'trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign,pickup_type,'
+      'drop_off_type,shape_dist_traveled', _StopTimesRows())
+  return len(trips) * stops_per_trip - sum(len(trip_skipped) for trip_skipped in skipped)
+
+
+def _Bench(phases, phase_name, rows, func, *args):
+  # runs func(*args), appending to phases[phase_name] like {'seconds': [...], ...}; returns result
+  phase = phases.setdefault(phase_name, {'seconds': [], 'rows': 0, 'tracemalloc_peak_bytes': 0})
+  if tracemalloc.is_tracing():
+    tracemalloc.reset_peak()
+  start = time.perf_counter()
+  result = func(*args)
+  phase['seconds'].append(time.perf_counter() - start)
+  phase['rows'] = rows(result) if callable(rows) else rows
+  if tracemalloc.is_tracing():
+    phase['tracemalloc_peak_bytes'] = max(
+        phase['tracemalloc_peak_bytes'], tracemalloc.get_traced_memory()[1])
+  phase['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB, on Linux
+  return result
+
+
+def _RunTables(phases, spec, out_dir, stop_times_count):
+  # the same sequence of calls as the "tables" command, each phase timed on its own; throughput
+  # of the loaders is over the rows they have to read, not over the (filtered) rows they return
+  # pylint: disable=protected-access
+  routes = _Bench(phases, '_LoadRoutes', len, irish_rail._LoadRoutes)
+  stops = _Bench(phases, '_LoadStops', len, irish_rail._LoadStops)
+  _Bench(phases, '_LoadNames', lambda n: len(n[0]) + len(n[1]), irish_rail._LoadNames)
+  _Bench(phases, '_NameIndex', len(routes) + len(stops),
+         lambda: (irish_rail._NameIndex(routes), irish_rail._NameIndex(stops)))
+  stops_index = irish_rail._NameIndex(stops)
+  trips = _Bench(phases, '_LoadTripsForRoute', len,
+                 irish_rail._LoadTripsForRoute, spec['route_ids'], set())
+  timetable = _Bench(phases, '_LoadTimetableForTrips', stop_times_count,
+                     irish_rail._LoadTimetableForTrips, set(trips))
+  calendar = _Bench(phases, '_LoadServiceCalendar', lambda c: len(c.days),
+                    irish_rail._LoadServiceCalendar)
+  _Bench(phases, '_LoadTransfers', len, irish_rail._LoadTransfers)
+  stations = _Bench(phases, '_ResolveStations', len(spec['stops']) + len(spec['fakes']),
+                    irish_rail._ResolveStations, spec, stops_index)
+  interesting_stops_ids, fake_stops, desired_stops_count, translate_stop_name = stations
+  service_dates, service_exclusions = _Bench(
+      phases, '_ServiceDates', len(calendar.days), irish_rail._ServiceDates, calendar, _BENCH_DATE)
+  trips = {trip_id: trip for trip_id, trip in trips.items() if trip[0] not in service_exclusions}
+  output_dict = _Bench(
+      phases, '_SelectTrips', lambda o: sum(len(t) for t in o.values()),
+      irish_rail._SelectTrips, trips, timetable, _BENCH_DATE, service_dates, interesting_stops_ids,
+      fake_stops, spec['irregular'])
+  trips_count = sum(len(t) for t in output_dict.values())
+  matrices = _Bench(phases, '_PadStops', trips_count,
+                    irish_rail._PadStops, output_dict, desired_stops_count)
+  _Bench(phases, '_SortTrips', trips_count, irish_rail._SortTrips, matrices)
+  output_tables = _Bench(
+      phases, '_AssembleRows', trips_count, irish_rail._AssembleRows, matrices, translate_stop_name,
+      spec['idcol'], spec['max_trips'])
+  _Bench(phases, '_WriteCSVs', trips_count, irish_rail._WriteCSVs,
+         os.path.join(out_dir, spec['name']), _BENCH_DATE, output_tables)
+  with contextlib.redirect_stdout(io.StringIO()):
+    _Bench(phases, '_PrintTables', trips_count,
+           irish_rail._PrintTables, spec['routes'], _BENCH_DATE, output_tables)
+  return output_tables
+
+
+def _Summary(phases):  # like {phase_name: {'seconds': best, 'rows_per_second': ..., ...}}
+  summary = {}
+  for phase_name, phase in phases.items():
+    best = min(phase['seconds'])
+    summary[phase_name] = {
+        'seconds': best,
+        'median_seconds': statistics.median(phase['seconds']),
+        'rows': phase['rows'],
+        'rows_per_second': phase['rows'] / best if best else None,
+        'max_rss_kb': phase['max_rss_kb'],
+    }
+    if phase['tracemalloc_peak_bytes']:
+      summary[phase_name]['tracemalloc_peak_bytes'] = phase['tracemalloc_peak_bytes']
+  return summary
+
+
+def _RunMode(mode, repeat, stop_times_count):  # like _Summary(), mode in ('csv', 'snapshot')
+  # pylint: disable=protected-access
+  phases = {}
+  if os.path.exists(irish_rail._SNAPSHOT_PATH):
+    os.remove(irish_rail._SNAPSHOT_PATH)
+  irish_rail._LoadSnapshot.cache_clear()
+  if mode == 'snapshot':
+    _Bench(phases, '_CompileSnapshot', stop_times_count, irish_rail._CompileSnapshot)
+  for _ in range(repeat):
+    irish_rail._LoadSnapshot.cache_clear()  # every repetition starts from the files on disk
+    if mode == 'snapshot':
+      _Bench(phases, '_LoadSnapshot', stop_times_count, irish_rail._LoadSnapshot)
+    routes_index = irish_rail._NameIndex(irish_rail._LoadRoutes())
+    spec = irish_rail._TimetableSpec(
+        routes_index, [_BENCH_ROUTE], [_StopName(0, 0), _StopName(0, 1), _StopName(0, 2)],
+        [(_StopName(0, 0), 'Hub')], [('Home', _StopName(0, 1), 3)],
+        _BENCH_DATE.strftime(irish_rail._DATE_REPR), '', False, True, 0)
+    with tempfile.TemporaryDirectory() as out_dir:
+      _RunTables(phases, spec, out_dir, stop_times_count)
+  return _Summary(phases)
+
+
+def _LookAheadExclusions(calendar_rows, date_inclusions, date_exclusions, date):
+  # like {service_id1, ...}: the original, per day, look-ahead rule of _LoadServiceDates(), that
+  # _ServiceCalendar.Disrupted() has to reproduce exactly
+  # pylint: disable=protected-access
+  look_ahead_days = set(irish_rail._AllDatesInPeriod(
+      date, date + datetime.timedelta(days=irish_rail._LOOK_AHEAD_IN_DAYS)))
+  service_exclusions = set()
+  for service_id, *_, start_date, end_date in calendar_rows:
+    period_dates = set(irish_rail._AllDatesInPeriod(
+        irish_rail._ParseDate(start_date), irish_rail._ParseDate(end_date))).union(
+            date_inclusions.get(service_id, set())) - date_exclusions.get(service_id, set())
+    if any(d not in period_dates for d in look_ahead_days):
+      service_exclusions.add(service_id)
+  return service_exclusions
+
+
+def _CheckLookAhead(feed_path):
+  # like [date1, ...] where the service exclusions of the feed differ from the original rule,
+  # for every date of the feed validity window (and a look-ahead more on either side)
+  # pylint: disable=protected-access
+  irish_rail._SetFeed(feed_path)
+  calendar_rows = irish_rail._ParseCalendar()
+  date_inclusions, date_exclusions = irish_rail._ParseCalendarDates()
+  calendar = irish_rail._ServiceCalendar(calendar_rows, date_inclusions, date_exclusions)
+  look_ahead = datetime.timedelta(days=irish_rail._LOOK_AHEAD_IN_DAYS)
+  return [date for date in irish_rail._AllDatesInPeriod(
+              calendar.first_date - look_ahead, calendar.last_date + look_ahead)
+          if calendar.Disrupted(date, date + look_ahead) != _LookAheadExclusions(
+              calendar_rows, date_inclusions, date_exclusions, date)]
+
+
+def _CmpStopsByFirstAvailableTime(a, b):
+  # the original comparator of the trips of a timetable, that _TripsMatrix.Sort() has to
+  # reproduce exactly; a and b like {'week': week_type, 'stops': [(stop_id, time_or_None), ...]}
+  # first we compare by 'week' type
+  if a['week'] != b['week']:
+    return 1 if a['week'] > b['week'] else -1
+  # then we compare by stop times
+  for i, (_, time_a) in enumerate(a['stops']):
+    time_b = b['stops'][i][1]
+    # skip the None times and the ones that are equal
+    if time_a is not None and time_b is not None and time_a != time_b:
+      # this is the one to compare by
+      return 1 if time_a > time_b else -1
+  # they were all missing or equal (happens: a and b can be the same)
+  return 0
+
+
+def _CheckTripOrder(feed_path, stops_per_trip):
+  # like [(date1, bool_direction_id1), ...] where the trips of the timetable of _BENCH_ROUTE, over
+  # all its stations, are not in the order of the original comparator, for a week of dates
+  # pylint: disable=protected-access
+  irish_rail._SetFeed(feed_path)
+  routes_index = irish_rail._NameIndex(irish_rail._LoadRoutes())
+  stops_index = irish_rail._NameIndex(irish_rail._LoadStops())
+  spec = irish_rail._TimetableSpec(
+      routes_index, [_BENCH_ROUTE], [_StopName(0, s) for s in range(stops_per_trip)], [], [],
+      _BENCH_DATE.strftime(irish_rail._DATE_REPR),
+      (_BENCH_DATE + datetime.timedelta(days=6)).strftime(irish_rail._DATE_REPR), False, True, 0)
+  all_trips = irish_rail._LoadTripsForRoute(spec['route_ids'], set())
+  timetable = irish_rail._LoadTimetableForTrips(set(all_trips))
+  calendar = irish_rail._LoadServiceCalendar()
+  interesting_stops_ids, fake_stops, desired_stops_count, _ = irish_rail._ResolveStations(
+      spec, stops_index)
+  mismatches = []
+  for date in irish_rail._AllDatesInPeriod(*spec['dates']):
+    service_dates, service_exclusions = irish_rail._ServiceDates(calendar, date)
+    trips = {trip_id: trip for trip_id, trip in all_trips.items()
+             if trip[0] not in service_exclusions}
+    output_dict = irish_rail._SelectTrips(
+        trips, timetable, date, service_dates, interesting_stops_ids, fake_stops, False)
+    for direction_id, matrix in irish_rail._PadStops(output_dict, desired_stops_count).items():
+      original = [
+          {'id': trip['id'], 'week': trip['week'],
+           'stops': [(stop_id, None if arrival == irish_rail._NEVER else arrival)
+                     for stop_id, arrival in zip(matrix.stops, matrix.Row(trip_n))]}
+          for trip_n, trip in enumerate(matrix.trips)]
+      original.sort(key=functools.cmp_to_key(_CmpStopsByFirstAvailableTime))
+      matrix.Sort()
+      if [trip['id'] for trip in matrix.trips] != [trip['id'] for trip in original]:
+        mismatches.append((date, direction_id))
+  return mismatches
+
+
+def _RunStartup(repeat, data_dir):
+  # like {command_name: {'seconds': best, ...}}, every command a new process, as the shell starts
+  # one for every run and for every completion; "list", "complete_stop" and "list_script" also
+  # have their 'overhead_seconds' over "import_click", the part that is up to irish_rail.py; the
+  # first run of each command is not timed, so the names index (and the bytecode) is saved;
+  # "list" and "complete_stop" run the module from its cached bytecode, like an installed
+  # command, while "list_script" runs the file, that Python compiles again on every run
+  script_path = os.path.abspath(irish_rail.__file__)
+  module_env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+      [os.path.dirname(script_path)] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+  module_env.pop('PYTHONDONTWRITEBYTECODE', None)
+  completion_env = dict(
+      module_env, _IRISH_RAIL_PY_COMPLETE='bash_complete', COMP_CWORD='5',
+      COMP_WORDS='irish_rail.py print --feed %s --stop %s' % (
+          shlex.quote(data_dir), shlex.quote(_StopName(0, 0)[:-3].lower())))
+  commands = (  # like (command_name, args, env)
+      ('python', ['-c', 'pass'], module_env),
+      ('import_click', ['-c', 'import click'], module_env),
+      ('list', ['-m', 'irish_rail', 'list', '--feed', data_dir], module_env),
+      ('complete_stop', ['-m', 'irish_rail'], completion_env),
+      ('list_script', [script_path, 'list', '--feed', data_dir], module_env),
+  )
+  summary = {}
+  for command_name, args, env in commands:
+    seconds = []
+    for run_n in range(repeat + 1):
+      start = time.perf_counter()
+      result = subprocess.run(
+          [sys.executable] + args, env=env, check=True, stdout=subprocess.PIPE, text=True)
+      if run_n:
+        seconds.append(time.perf_counter() - start)
+    if env is completion_env and _StopName(0, 0) not in result.stdout:
+      raise click.ClickException('Completion did not suggest %r: %r' % (
+          _StopName(0, 0), result.stdout))
+    summary[command_name] = {'seconds': min(seconds), 'median_seconds': statistics.median(seconds)}
+  for command_name in ('list', 'complete_stop', 'list_script'):
+    summary[command_name]['overhead_seconds'] = (
+        summary[command_name]['seconds'] - summary['import_click']['seconds'])
+  return summary
+
+
+@click.command()
+@click.option(
+    '--routes', 'routes_count', type=click.IntRange(1, 100000), default=_DEFAULT_SCALE['routes'],
+    help='Number of routes in the synthetic feed; Default is %d.' % _DEFAULT_SCALE['routes'])
+@click.option(
+    '--trips', 'trips_per_route', type=click.IntRange(3, 10000000),
+    default=_DEFAULT_SCALE['trips'],
+    help='Number of trips per route; Default is %d.' % _DEFAULT_SCALE['trips'])
+@click.option(
+    '--stops', 'stops_per_trip', type=click.IntRange(3, 10000), default=_DEFAULT_SCALE['stops'],
+    help='Number of stops per trip (and stations per route); Default is %d; '
+    'stop_times.txt will have routes*trips*stops rows (ex: --routes 100 --trips 10000 --stops 20 '
+    'for 20M rows).' % _DEFAULT_SCALE['stops'])
+@click.option(
+    '--exceptions', 'exceptions', type=click.IntRange(0, 10000000),
+    default=_DEFAULT_SCALE['exceptions'],
+    help='Number of calendar_dates.txt exceptions; Default is %d.' % _DEFAULT_SCALE['exceptions'])
+@click.option(
+    '--seed', 'seed', type=click.INT, default=1, help='Random seed for the feed; Default is 1.')
+@click.option(
+    '--mode', 'modes', type=click.Choice(['csv', 'snapshot']), multiple=True,
+    help='Feed loading mode to benchmark: "csv" reads the text files, "snapshot" compiles then '
+    'loads the feed snapshot; can be given more than once; Default is both.')
+@click.option(
+    '--repeat', '-n', 'repeat', type=click.IntRange(1, 1000), default=3,
+    help='Times to repeat each benchmark; the best time is reported; Default is 3.')
+@click.option(
+    '--jobs', '-j', 'jobs', type=click.IntRange(1, 256), default=1,
+    help='Number of processes to parse big feed files with (see irish_rail.py --jobs); '
+    'Default is 1.')
+@click.option(
+    '--phases/--no-phases', 'phases', default=True,
+    help='Benchmark the phases of the "tables" operation, in every --mode? Default is yes '
+    '(--phases); --no-phases just runs the startup timing test and the exclusions and trip '
+    'order checks.')
+@click.option(
+    '--startup/--no-startup', 'startup', default=True,
+    help='Also time "list" and the shell completion of a --stop, as new processes, like the '
+    'shell runs them, and fail if they are over --max-startup-ms? Default is yes (--startup).')
+@click.option(
+    '--max-startup-ms', 'max_startup_ms', type=click.FloatRange(1), default=50.0,
+    help='Fail (after writing the report) if "list" or the completion of an installed '
+    'irish_rail (from its cached bytecode) take longer than this many milliseconds over '
+    '`python -c "import click"`, that is the part that is up to irish_rail.py; Default is 50.')
+@click.option(
+    '--check-feed', 'check_feeds', type=click.Path(exists=True), multiple=True,
+    help='Also check, for every date of this feed (directory or .zip), that the service '
+    'exclusions are the same as the original per day rule; the synthetic feed is always '
+    'checked; can be given more than once (ex: --check-feed data/irish_rail/).')
+@click.option(
+    '--tracemalloc/--no-tracemalloc', 'trace_memory', default=False,
+    help='Also measure the peak Python allocations of each phase? Slow; Default is no.')
+@click.option(
+    '--data-dir', 'data_dir', type=click.Path(file_okay=False), default=None,
+    help='Where to write the synthetic feed (it is kept); Default is a temporary directory that '
+    'is removed at the end.')
+@click.option(
+    '--output', '-o', 'output_path', type=click.Path(dir_okay=False, writable=True), default='-',
+    help='Where to write the JSON report; Default is stdout.')
+@click.option(
+    '--verbose', '-v', 'verbosity_level', count=True,
+    help='Verbose level; default is errors only; -v includes info/warning; -vv includes debug.')
+def bench(routes_count, trips_per_route, stops_per_trip, exceptions, seed, modes, repeat, jobs,
+          phases, startup, max_startup_ms, check_feeds, trace_memory, data_dir, output_path,
+          verbosity_level):
+  """Irish Rail data converter benchmarks.
+
+  Generates a deterministic synthetic GTFS feed, runs the phases of the "tables" operation over
+  it, and writes a JSON report with the best time, throughput and peak memory of every phase,
+  so runs can be compared. Examples:
+
+  ./irish_rail_bench.py -o bench.json
+
+  ./irish_rail_bench.py --routes 100 --trips 10000 --stops 20 --mode snapshot -n 1
+
+  ./irish_rail_bench.py --no-phases -n 10
+  """
+  # pylint: disable=protected-access
+  logging.basicConfig(
+      level=(logging.DEBUG if verbosity_level > 1 else
+             (logging.INFO if verbosity_level == 1 else logging.ERROR)),
+      format='%(asctime)-15s: %(message)s')
+  keep_data = data_dir is not None
+  data_dir = data_dir or tempfile.mkdtemp(prefix='irish_rail_bench_')
+  os.makedirs(data_dir, exist_ok=True)
+  irish_rail._SetFeed(data_dir)
+  irish_rail._PARSE_JOBS = jobs
+  try:
+    start = time.perf_counter()
+    stop_times_count = _GenerateFeed(
+        data_dir, routes_count, trips_per_route, stops_per_trip, exceptions, seed)
+    report = {
+        'feed': {
+            'routes': routes_count, 'trips_per_route': trips_per_route,
+            'stops_per_trip': stops_per_trip, 'exceptions': exceptions, 'seed': seed,
+            'stop_times_rows': stop_times_count,
+            'stop_times_bytes': os.path.getsize(os.path.join(data_dir, 'stop_times.txt')),
+            'generate_seconds': time.perf_counter() - start,
+        },
+        'jobs': jobs,
+        'python': sys.version.split()[0],
+        'repeat': repeat,
+        'modes': {},
+    }
+    if trace_memory:
+      tracemalloc.start()
+    for mode in (modes or ('csv', 'snapshot')) if phases else ():
+      logging.info('Benchmarking %r mode', mode)
+      report['modes'][mode] = _RunMode(mode, repeat, stop_times_count)
+    if trace_memory:
+      tracemalloc.stop()
+    if startup:
+      logging.info('Benchmarking startup')
+      report['startup'] = _RunStartup(repeat, data_dir)
+    for feed_path in (data_dir,) + check_feeds:
+      logging.info('Checking service exclusions of %r', feed_path)
+      mismatches = _CheckLookAhead(feed_path)
+      if mismatches:
+        raise click.ClickException('Service exclusions of %r differ on %d dates, like %s' % (
+            feed_path, len(mismatches), mismatches[0].strftime('%Y%m%d')))
+    # the trip order is checked on the synthetic feed, where every trip stops everywhere, and on
+    # a small feed where half the trips skip stops, as that is where the two sorts can differ
+    express_dir = os.path.join(data_dir, 'express')
+    os.makedirs(express_dir, exist_ok=True)
+    _GenerateFeed(express_dir, 2, 300, stops_per_trip, 0, seed, express=0.5)
+    for feed_path in (data_dir, express_dir):
+      logging.info('Checking trip order of %r', feed_path)
+      mismatches = _CheckTripOrder(feed_path, stops_per_trip)
+      if mismatches:
+        raise click.ClickException('Trip order of %r differs on %d tables, like %s %s' % (
+            feed_path, len(mismatches), mismatches[0][0].strftime('%Y%m%d'),
+            'up' if mismatches[0][1] else 'down'))
+  finally:
+    if not keep_data:
+      shutil.rmtree(data_dir, ignore_errors=True)
+  with click.open_file(output_path, 'wt') as report_file:
+    json.dump(report, report_file, indent=2, sort_keys=True)
+    report_file.write('\n')
+  if startup:
+    overheads_ms = {command_name: report['startup'][command_name]['overhead_seconds'] * 1000
+                    for command_name in ('list', 'complete_stop')}
+    slow = ['%s (+%.1fms)' % (command_name, overhead_ms)
+            for command_name, overhead_ms in overheads_ms.items() if overhead_ms > max_startup_ms]
+    if slow:
+      raise click.ClickException('Startup over %.1fms: %s' % (max_startup_ms, ', '.join(slow)))
+
+
+# only execute main() if used directly --- not sure how robust this is...
+if __name__ == '__main__':
+  bench()  # pylint: disable=no-value-for-parameter